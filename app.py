@@ -12,52 +12,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
 import streamlit as st
 import pandas as pd
-from google.cloud import bigquery
-from main import run
+from main import _RUN_STATE_TABLE, estimate, run
 from utils.bq import BigQueryInteractor
+from utils.metadata import MetadataBrowser
+from utils.progress import RunProgress
+from utils.vertex import MAX_CHAR_LIMIT
 
 _CHAR_COUNT_COL_NAME = 'Character Count'
 _SHORT_TITLE_COL_NAME = 'Short Title'
+_STRATIFY_COLUMN_HELP = 'Optional column, such as the category, whose different values the examples should cover.'
+_TABLE_SEARCH_HELP = 'Type part of the table name to narrow down the tables of large datasets. Table names are refreshed every 10 minutes.'
+_REFRESH_HELP = 'Reads the table and column names of the dataset again, i.e. to find a table created in the last 10 minutes.'
 _COLUMN_SELECT_HELP = 'Select relevant columns from the feed, from which Shrinkify will generate short titles. Select informative columns, where values vary between entries.'
-# Initialize the BigQuery client
-client = bigquery.Client()
-
-# Function to fetch all available datasets
-
-
-@st.cache_data
-def get_datasets():
-    return st.session_state.bq_client.get_datasets()
-
-# Function to fetch tables within a dataset
+_CONCURRENT_JOBS_HELP = 'Number of batch prediction jobs to keep running at the same time. Higher values finish large feeds faster, as long as the project quota allows it.'
+_KEY_COLUMN_HELP = 'Column that uniquely identifies an entry in the feed, such as the product id.'
+_INCREMENTAL_HELP = 'Requires a key column. Only entries that are new or changed since the last run are shortened, and "shrinkify_final" is updated in place.'
+_RUN_ID_HELP = 'Optional name of the run, i.e. the market or feed. Runs with different IDs can run at the same time and write to their own "shrinkify_output_<run ID>" dataset.'
+_EXPORT_URI_HELP = 'Optional gs:// folder. Results are exported there part by part as soon as each part is predicted, so downstream feeds can start before the run is done.'
+_EXPORT_TITLE_ONLY_HELP = 'Requires a key column. Only export the key and the short title.'
+_VARIANTS_HELP = 'Optional comma separated extra short titles to generate in the same run, as a max length and an optional language, i.e. "45, 30 German". Each gets its own "short_title_<length>[_<language>]" column.'
+_DERIVE_VARIANTS_HELP = 'Every length and language is predicted on its own and costs about as much as the main one. When checked, shorter lengths in the same language are cut from the longest one at word boundaries instead, and cost nothing.'
+_TITLE_COLUMN_HELP = 'The column holding the product title. Choose it to use titles that need no shortening without the model, and as the fallback short title when a prediction is missing.'
+_ROUTING_HELP = 'Titles (the title column) that already fit the max length, or fit after dropping repeated words, bracketed text or trailing qualifiers, are used without the model.'
+_MAX_COST_HELP = 'Optional. The run is stopped before any prediction if it is estimated to cost more. 0 means no limit.'
+_PROGRESS_POLL_SECONDS = 15
+
+
+@st.cache_resource
+def get_metadata_browser():
+    """Shared by all sessions, so dataset and table names are only read once per TTL"""
+    return MetadataBrowser(BigQueryInteractor())
 
 
-@st.cache_data
-def get_tables(dataset_id):
-    return st.session_state.bq_client.get_tables(dataset_id)
-
-# Function to fetch column names from a table
-
-
-@st.cache_data
-def get_column_names(dataset_id, table_id):
-    return st.session_state.bq_client.get_column_names(dataset_id, table_id)
-
 # Function to fetch random rows from the selected table
 
 
-def get_random_rows(dataset_id, table_id, selected_columns, num_rows=5):
-    query = f"SELECT {', '.join(selected_columns)} FROM `{dataset_id}.{table_id}` ORDER BY RAND() LIMIT {num_rows}"
-    results = st.session_state.bq_client.run_query(query)
+def get_random_rows(dataset_id, table_id, selected_columns, num_rows=5, stratify_column=None):
+    results = st.session_state.bq_client.sample_rows(
+        dataset_id, table_id, selected_columns, num_rows, stratify_column)
     rows = [list(row.values()) for row in results]
     return rows
 
 
 def create_examples():
-    examples = get_random_rows(st.session_state.selected_dataset,
-                               st.session_state.selected_table, st.session_state.selected_columns)
+    examples = get_random_rows(st.session_state.selected_dataset, st.session_state.selected_table,
+                               st.session_state.selected_columns, stratify_column=st.session_state.stratify_column)
     # Create a DataFrame with the selected columns and add a "Short Title" column
     st.session_state.df = pd.DataFrame(
         examples, columns=st.session_state.selected_columns)
@@ -65,20 +68,59 @@ def create_examples():
         "name", '')  # Initialize Short Title column
 
 
-def run_shrinkify():
-    st.session_state.run_clicked = True
+def get_config_params():
     examples_df = st.session_state.edited_df
     examples_df.drop('Character Count', axis=1)
-    conifg_params = {
+    return {
         "industry": st.session_state.industry,
         "product_type": st.session_state.product_type,
         "char_limit": st.session_state.char_limit,
         "source_dataset": st.session_state.selected_dataset,
         "source_table": st.session_state.selected_table,
         "columns": st.session_state.selected_columns,
-        "examples_df": examples_df
+        "examples_df": examples_df,
+        "concurrent_jobs": st.session_state.concurrent_jobs,
+        "key_column": st.session_state.key_column,
+        "incremental": st.session_state.incremental,
+        "run_id": st.session_state.run_id,
+        "export_uri": st.session_state.export_uri,
+        "export_format": st.session_state.export_format,
+        "export_title_only": st.session_state.export_title_only,
+        "max_cost_usd": st.session_state.max_cost_usd,
+        "variants": parse_variants(st.session_state.variants),
+        "routing": st.session_state.routing,
+        "derive_variants": st.session_state.derive_variants,
+        "title_column": st.session_state.title_column
     }
-    run(conifg_params)
+
+
+def parse_variants(text):
+    """"45, 30 German" to [{'char_limit': 45}, {'char_limit': 30, 'language': 'German'}]"""
+    variants = []
+    for variant in filter(None, (part.strip() for part in text.split(','))):
+        char_limit, _, language = variant.partition(' ')
+        variants.append({'char_limit': int(char_limit), 'language': language.strip() or None})
+    return variants
+
+
+def estimate_shrinkify():
+    try:
+        st.session_state.estimate = estimate(get_config_params())
+        st.session_state.error = None
+    except ValueError as e:
+        st.session_state.error = str(e)
+
+
+def run_shrinkify():
+    # The run page is only shown once the run started, i.e. not when it's over the max cost
+    try:
+        config = run(get_config_params())
+    except ValueError as e:
+        st.session_state.error = str(e)
+        return
+    st.session_state.error = None
+    st.session_state.config = config
+    st.session_state.run_clicked = True
 
 
 def initialize_session_state():
@@ -104,6 +146,38 @@ def initialize_session_state():
         st.session_state.run_clicked = False
     if "char_limit" not in st.session_state:
         st.session_state.char_limit = 0
+    if "concurrent_jobs" not in st.session_state:
+        st.session_state.concurrent_jobs = 4
+    if "key_column" not in st.session_state:
+        st.session_state.key_column = None
+    if "incremental" not in st.session_state:
+        st.session_state.incremental = False
+    if "stratify_column" not in st.session_state:
+        st.session_state.stratify_column = None
+    if "run_id" not in st.session_state:
+        st.session_state.run_id = ""
+    if "export_uri" not in st.session_state:
+        st.session_state.export_uri = ""
+    if "export_format" not in st.session_state:
+        st.session_state.export_format = "parquet"
+    if "export_title_only" not in st.session_state:
+        st.session_state.export_title_only = False
+    if "title_column" not in st.session_state:
+        st.session_state.title_column = None
+    if "routing" not in st.session_state:
+        st.session_state.routing = False
+    if "variants" not in st.session_state:
+        st.session_state.variants = ""
+    if "derive_variants" not in st.session_state:
+        st.session_state.derive_variants = False
+    if "max_cost_usd" not in st.session_state:
+        st.session_state.max_cost_usd = 0
+    if "estimate" not in st.session_state:
+        st.session_state.estimate = None
+    if "config" not in st.session_state:
+        st.session_state.config = None
+    if "error" not in st.session_state:
+        st.session_state.error = None
 
 st.set_page_config(
     page_title="Shrinkify🤏",
@@ -132,23 +206,54 @@ if st.session_state.df is None:
 
     with col3:
         st.session_state.char_limit = st.number_input(
-            label=":rainbow[Max Length]", max_value=60, value=30, help="It is recommended to use a slightly lower limit than you require. i.e. if you need a maximum of 30 chars, use a limit of 28")
+            label=":rainbow[Max Length]", max_value=MAX_CHAR_LIMIT, value=30, help="It is recommended to use a slightly lower limit than you require. i.e. if you need a maximum of 30 chars, use a limit of 28")
     # Step 2: Select a dataset
+    metadata = get_metadata_browser()
     st.session_state.selected_dataset = st.selectbox(
-        "Select a BigQuery Dataset", get_datasets())
+        "Select a BigQuery Dataset", metadata.get_datasets())
 
     if st.session_state.selected_dataset:
         # Step 3: Select a table from the chosen dataset
+        search_column, refresh_column = st.columns([4, 1])
+        with search_column:
+            table_search = st.text_input("Search Tables", value="", help=_TABLE_SEARCH_HELP)
+        with refresh_column:
+            # Aligns the button with the search field
+            st.write("")
+            st.button("Refresh", on_click=metadata.refresh, args=(st.session_state.selected_dataset,),
+                      help=_REFRESH_HELP)
         st.session_state.selected_table = st.selectbox(
-            "Select a Table from the Dataset", get_tables(st.session_state.selected_dataset))
+            "Select a Table from the Dataset", metadata.search_tables(st.session_state.selected_dataset, table_search))
 
         if st.session_state.selected_table:
             # Step 4: Select Columns
-            st.session_state.selected_columns = st.multiselect("Select Relevant Columns from the Table", get_column_names(
-                st.session_state.selected_dataset, st.session_state.selected_table),help=_COLUMN_SELECT_HELP)
+            column_names = metadata.get_column_names(st.session_state.selected_dataset, st.session_state.selected_table)
+            st.session_state.selected_columns = st.multiselect(
+                "Select Relevant Columns from the Table", column_names, help=_COLUMN_SELECT_HELP)
 
             if st.session_state.selected_columns:
+                st.session_state.concurrent_jobs = st.number_input(
+                    label="Parallel Prediction Jobs", min_value=1, max_value=8, value=4, help=_CONCURRENT_JOBS_HELP)
+                st.session_state.key_column = st.selectbox(
+                    "Key Column (Optional)", [None] + column_names, help=_KEY_COLUMN_HELP)
+                st.session_state.incremental = bool(st.session_state.key_column) and st.checkbox(
+                    "Only process new or changed rows", help=_INCREMENTAL_HELP)
+                st.session_state.run_id = st.text_input("Run ID (Optional)", value="", help=_RUN_ID_HELP)
+                st.session_state.title_column = st.selectbox(
+                    "Title Column (Optional)", [None] + st.session_state.selected_columns, help=_TITLE_COLUMN_HELP)
+                st.session_state.routing = bool(st.session_state.title_column) and st.checkbox(
+                    "Only use the model for titles that need it", value=True, help=_ROUTING_HELP)
+                st.session_state.variants = st.text_input("Extra Lengths and Languages (Optional)", value="", help=_VARIANTS_HELP)
+                st.session_state.derive_variants = bool(st.session_state.variants) and st.checkbox(
+                    "Cut shorter lengths from the longest one", help=_DERIVE_VARIANTS_HELP)
+                st.session_state.export_uri = st.text_input("Export to Cloud Storage (Optional)", value="", help=_EXPORT_URI_HELP)
+                if st.session_state.export_uri:
+                    st.session_state.export_format = st.selectbox("Export Format", ["parquet", "csv", "jsonl"])
+                    st.session_state.export_title_only = bool(st.session_state.key_column) and st.checkbox(
+                        "Only export key and short title", help=_EXPORT_TITLE_ONLY_HELP)
                 # Step 5: Create Examples
+                st.session_state.stratify_column = st.selectbox(
+                    "Cover Values of (Optional)", [None] + column_names, help=_STRATIFY_COLUMN_HELP)
                 st.button("Create Examples", on_click=create_examples)
 
 elif not st.session_state.run_clicked:
@@ -165,8 +270,33 @@ elif not st.session_state.run_clicked:
     )
 
     st.session_state.edited_df = edited_df
+    st.session_state.max_cost_usd = st.number_input(
+        "Max Cost in $", min_value=0.0, value=0.0, step=10.0, help=_MAX_COST_HELP)
+    st.button("Estimate Cost and Time", on_click=estimate_shrinkify)
+    if st.session_state.estimate:
+        st.info(f'Estimated {st.session_state.estimate}. Rows already shortened by an earlier run cost nothing.')
     st.text("")
     st.button("RUN", on_click=run_shrinkify)
+    if st.session_state.error:
+        st.error(st.session_state.error)
 
 else:
-    st.write("Shrinkify Running")
+    config = st.session_state.config
+    progress = RunProgress(st.session_state.bq_client.get_run_state(
+        config.output_dataset, _RUN_STATE_TABLE), config.concurrent_jobs)
+    st.progress(progress.fraction_done, text=f'Shrinkify Running: {progress}')
+    if progress.eta_seconds is None and config.run_plan:
+        st.caption(f'Planned: {config.run_plan}')
+    for sub_table, error in progress.errors.items():
+        st.error(f'Sub table {sub_table} could not be predicted: {error}')
+
+    # Shows which stage takes the longest on large feeds
+    stage_seconds = {stage: seconds for stage, seconds in progress.stage_seconds.items() if seconds is not None}
+    if stage_seconds:
+        st.dataframe(pd.DataFrame({'Average Seconds per Sub Table': stage_seconds}), use_container_width=True)
+
+    if progress.finalized:
+        st.write(f'Done, the short titles are in "{config.output_table}" of the "{config.output_dataset}" dataset.')
+    else:
+        time.sleep(_PROGRESS_POLL_SECONDS)
+        st.rerun()
@@ -0,0 +1,83 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import time / cold start benchmark of the Cloud Function and the app modules.
+# Every measurement runs in a fresh interpreter, so nothing is already imported.
+#
+#   python -m benchmarks.cold_start [--repeat 5]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loads the Cloud Function source and sends it an event that takes the idle trigger path
+_IDLE_TRIGGER = '''
+import importlib.util, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('cloud_function_main', 'cloud_function/main.py')
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+loaded = time.perf_counter()
+
+class IdleEvent(dict):
+    data = {'protoPayload': {'metadata': {}}}
+
+module.cloud_agent(IdleEvent(type='google.cloud.audit.log.v1.written'))
+done = time.perf_counter()
+print(loaded - start, done - loaded)
+'''
+
+_IMPORT = '''
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+'''
+
+
+def _measure(code):
+    output = subprocess.run([sys.executable, '-c', code], cwd=_ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    # The timings are on the last line, after anything the code under test printed
+    return [float(value) for value in output.strip().splitlines()[-1].split()]
+
+
+def _median_ms(samples):
+    return round(statistics.median(samples) * 1000, 1)
+
+
+def run_benchmark(repeat):
+    results = {}
+    idle = [_measure(_IDLE_TRIGGER) for _ in range(repeat)]
+    results['cloud_function_import_ms'] = _median_ms([sample[0] for sample in idle])
+    results['cloud_function_idle_trigger_ms'] = _median_ms([sample[1] for sample in idle])
+    for module in ['main', 'google.cloud.aiplatform']:
+        try:
+            results[f'import_{module}_ms'] = _median_ms(
+                [_measure(_IMPORT.format(module=module))[-1] for _ in range(repeat)])
+        except subprocess.CalledProcessError:
+            results[f'import_{module}_ms'] = 'not installed'
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.repeat), indent=2))
@@ -0,0 +1,48 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline latency/throughput benchmark of the online micro-batcher against the fake model.
+#
+#   python -m benchmarks.online_latency [--requests 2000] [--clients 64]
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.online import FakeTextModel, MicroBatcher
+
+
+def run_benchmark(requests, clients, max_batch_size, max_wait_seconds, max_concurrent_calls, model_latency):
+    model = FakeTextModel(char_limit=30, latency_seconds=model_latency)
+    batcher = MicroBatcher(model, max_batch_size, max_wait_seconds, max_concurrent_calls)
+    prompt = 'Context: {title: Acme Ultra Comfort Running Shoes Men Size 42 Blue} Short title: '
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(lambda _: batcher.predict([prompt]), range(requests)))
+    return batcher.stats.to_dict()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=int, default=50)
+    parser.add_argument('--max-concurrent-calls', type=int, default=4)
+    parser.add_argument('--model-latency-ms', type=int, default=200)
+    args = parser.parse_args()
+
+    stats = run_benchmark(args.requests, args.clients, args.max_batch_size, args.max_wait_ms / 1000,
+                          args.max_concurrent_calls, args.model_latency_ms / 1000)
+    print(json.dumps(stats, indent=2))
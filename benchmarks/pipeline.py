@@ -0,0 +1,241 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# End to end pipeline benchmark on synthetic feeds, fully offline.
+# Runs main.run_async and cloud_function/main.py, from cloud_agent through the
+# work topic to process_work, on the local backends of utils/local.py
+# and reports rows/sec, per stage timings and the chars each stage read.
+# Only the SQL the function sends to BigQuery is swapped for LocalCloudBackend,
+# so loading the function needs functions-framework installed.
+#
+#   python -m benchmarks.pipeline [--rows 10000 100000 1000000] [--variants 3] [--runs 1]
+#                                 [--export-format jsonl] [--export-title-only]
+#                                 [--extra-char-limits 20 15]
+#                                 [--max-project-jobs 6] [--tokens-per-minute 1000000]
+#                                 [--short-titles 0.3] [--work-failure-rate 0.2]
+#
+# With --runs, several runs with their own run ID process the feed at the same time.
+# With --export-format, results are exported shard by shard to a temporary directory.
+# With --extra-char-limits, every row also gets a short title for each of those limits.
+# With --max-project-jobs and --tokens-per-minute, launches go through a LaunchScheduler
+# with that quota. Local jobs only run once all runs started, so launches over the job
+# quota fail right away and are picked up by main.resume_async, like resume.py would.
+# With --short-titles, that share of the products has titles the model isn't needed for.
+# With --work-failure-rate, that share of the worker steps fails and is redelivered.
+# With --verbose, the logs of the Cloud Function are printed.
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+import main
+from utils.config import Config
+from utils.progress import RunProgress
+from utils.local import (LocalBigQueryInteractor, LocalCloudBackend, LocalPublisher, LocalWorkQueue,
+                         create_local_model, local_prediction_handler)
+from utils.scheduler import LaunchScheduler
+
+_SOURCE_DATASET = 'feeds'
+_SOURCE_TABLE = 'synthetic_feed'
+_BRANDS = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Stark', 'Wayne', 'Wonka']
+_PRODUCTS = ['Running Shoes', 'Hiking Boots', 'Rain Jacket', 'Backpack', 'Water Bottle', 'Yoga Mat']
+_QUALIFIERS = ['Ultra', 'Comfort', 'Pro', 'Lightweight', 'Classic', 'Premium', 'Waterproof', 'Breathable']
+_COLORS = ['Black', 'White', 'Blue', 'Red', 'Green', 'Grey']
+_SIZES = ['XS', 'S', 'M', 'L', 'XL', 'XXL']
+_EXPORT_URI = 'gs://local-bucket/shrinkify'
+_CLOUD_FUNCTION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cloud_function', 'main.py')
+_WORK_TOPIC = 'projects/local-project/topics/shrinkify-work'
+
+
+def create_synthetic_feed(bq, rows, variants, short_titles=0, seed=0):
+    """Writes a feed where every product comes in several size variants. The size
+    isn't a selected column, so variants share a prompt like in real feeds."""
+    rng = random.Random(seed)
+    feed = []
+    while len(feed) < rows:
+        brand = rng.choice(_BRANDS)
+        if short_titles and rng.random() < short_titles:
+            # Fits the char limit as is, or once the trailing qualifier is dropped
+            title = ' '.join([brand, rng.choice(_PRODUCTS)] + rng.choice([[], ['-', rng.choice(_QUALIFIERS), 'Edition']]))
+        else:
+            title = ' '.join([brand] + rng.sample(_QUALIFIERS, 3) + [rng.choice(_PRODUCTS), 'for Men and Women'])
+        color = rng.choice(_COLORS)
+        for size in _SIZES[:variants]:
+            feed.append({'id': str(len(feed)), 'title': title, 'brand': brand, 'color': color, 'size': size})
+    bq.create_table(_SOURCE_DATASET, _SOURCE_TABLE, ['id', 'title', 'brand', 'color', 'size'], feed[:rows])
+
+
+def create_config(concurrent_jobs, run_id=None, export_format=None, export_title_only=False,
+                  extra_char_limits=(), derive_variants=False):
+    examples_df = pd.DataFrame([
+        {'title': 'Acme Ultra Pro Comfort Running Shoes for Men and Women', 'brand': 'Acme',
+         'color': 'Blue', 'Short Title': 'Acme Ultra Pro Running Shoes'},
+        {'title': 'Globex Lightweight Classic Waterproof Rain Jacket for Men and Women', 'brand': 'Globex',
+         'color': 'Red', 'Short Title': 'Globex Waterproof Rain Jacket'},
+    ])
+    return Config('Outdoor Retail', 'Apparel', 30, _SOURCE_DATASET, _SOURCE_TABLE,
+                  ['title', 'brand', 'color'], examples_df, concurrent_jobs, key_column='id', run_id=run_id,
+                  export_uri=_EXPORT_URI if export_format else None, export_format=export_format or 'parquet',
+                  export_title_only=export_title_only,
+                  variants=[{'char_limit': char_limit} for char_limit in extra_char_limits],
+                  derive_variants=derive_variants, routing=True, title_column='title')
+
+
+def load_cloud_function():
+    """cloud_function/main.py is deployed on its own, so it isn't importable as a package"""
+    spec = importlib.util.spec_from_file_location('cloud_function_main', _CLOUD_FUNCTION)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class AuditLogEvent(dict):
+    """The parts of the InsertJob audit log event of a results table that cloud_agent reads"""
+    def __init__(self, event_id, project_id, dataset_id, table_id, rows):
+        super().__init__(id=event_id, type='google.cloud.audit.log.v1.written')
+        self.data = {'protoPayload': {
+            'resourceName': f'projects/{project_id}/datasets/{dataset_id}/tables/{table_id}',
+            'metadata': {'tableDataChange': {'insertedRowsCount': str(rows)}}}}
+
+
+class PushEvent(dict):
+    """The Pub/Sub push event of a work message that process_work reads"""
+    def __init__(self, work, message_id):
+        super().__init__(id=message_id, type='google.cloud.pubsub.topic.v1.messagePublished')
+        self.data = {'message': {'data': base64.b64encode(json.dumps(work).encode('utf-8')).decode('ascii'),
+                                 'messageId': message_id}}
+
+
+def local_worker(cloud_function, length_checks, failure_rate=0, seed=0):
+    """Returns a handler passing the work to cloud_function.process_work.
+    With failure_rate, that share of the steps fails before doing anything, to be redelivered."""
+    rng = random.Random(seed)
+
+    def handle_work(work, message_id):
+        if rng.random() < failure_rate:
+            raise RuntimeError('Injected failure')
+        run_length_checks = cloud_function.process_work(PushEvent(work, message_id))
+        if run_length_checks is not None:
+            length_checks[work['dataset_id']] = run_length_checks
+    return handle_work
+
+
+async def run_all(configs, bq, prediction_handler, scheduler):
+    await asyncio.gather(*(main.run_async(config, bq, prediction_handler, scheduler) for config in configs))
+
+
+def run_benchmark(rows, variants, concurrent_jobs, runs=1, export_format=None, export_title_only=False,
+                  extra_char_limits=(), max_project_jobs=None, tokens_per_minute=None, short_titles=0,
+                  work_failure_rate=0, verbose=False, derive_variants=False):
+    bq = LocalBigQueryInteractor(export_dir=tempfile.mkdtemp())
+    create_synthetic_feed(bq, rows, variants, short_titles)
+    configs = [create_config(concurrent_jobs, f'run_{run}' if runs > 1 else None, export_format, export_title_only,
+                             extra_char_limits, derive_variants) for run in range(runs)]
+    model = create_local_model(configs[0].char_limit)
+    prediction_handler = local_prediction_handler(bq)
+    scheduler = LaunchScheduler(max_project_jobs, tokens_per_minute, max_wait_seconds=0)
+    work_queue = LocalWorkQueue()
+    length_checks = {}
+    # The function publishes its work on the topic, like it's deployed with the worker
+    cloud_function = load_cloud_function()
+    cloud_function._BACKEND = LocalCloudBackend(bq, prediction_handler)
+    cloud_function._PUBLISHER = LocalPublisher(work_queue)
+    # The handovers of the function count against the same job quota
+    cloud_function._SCHEDULER = scheduler
+    os.environ['WORK_TOPIC'] = _WORK_TOPIC
+    handle_work = local_worker(cloud_function, length_checks, work_failure_rate)
+
+    start = time.perf_counter()
+    asyncio.run(run_all(configs, bq, prediction_handler, scheduler))
+    prediction_jobs = 0
+    resumes = 0
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+        while True:
+            while (job := bq.run_prediction_job(model)) is not None:
+                prediction_jobs += 1
+                dataset_id, _, results_table_id = job
+                cloud_function.cloud_agent(AuditLogEvent(
+                    str(prediction_jobs), bq.get_project_id(), dataset_id, results_table_id,
+                    bq.get_table_row_count(dataset_id, results_table_id)))
+                work_queue.process(handle_work)
+            stopped = [config.output_dataset for config in configs
+                       if cloud_function.has_sub_tables(cloud_function._BACKEND, config.output_dataset)]
+            if not stopped:
+                break
+            for dataset_id in stopped:
+                resumes += 1
+                asyncio.run(main.resume_async(bq, dataset_id, prediction_handler, scheduler))
+    seconds = time.perf_counter() - start
+
+    return {
+        'rows': rows,
+        'runs': runs,
+        'sub_tables': sum(config.num_sub_tables for config in configs),
+        'prediction_jobs': prediction_jobs,
+        'predicted_rows': sum(bq.get_table_row_count(config.output_dataset, main._CACHE_TABLE)
+                              for config in configs),
+        'output_rows': {config.output_dataset: bq.get_table_row_count(config.output_dataset, config.output_table)
+                        for config in configs},
+        'length_checks': length_checks,
+        'route_counts': {config.output_dataset: config.route_counts for config in configs},
+        'progress': {config.output_dataset: RunProgress(
+            bq.get_run_state(config.output_dataset, main._RUN_STATE_TABLE), concurrent_jobs).to_dict()
+            for config in configs},
+        'exported_rows': sum(bq.exported_rows.values()),
+        'scheduler': scheduler.to_dict(),
+        'resumes': resumes,
+        'work_queue': {'published': work_queue.published, 'redelivered': work_queue.redelivered,
+                       'dropped': work_queue.dropped},
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows * runs / seconds),
+        'stage_seconds': {stage: round(value, 3) for stage, value in bq.stage_seconds.items()},
+        'chars_read': dict(bq.chars_read),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--variants', type=int, default=3, help='Size variants per product, 1 means no duplicates')
+    parser.add_argument('--concurrent-jobs', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=1, help='Runs with their own run ID processing the feed at once')
+    parser.add_argument('--export-format', choices=['parquet', 'csv', 'jsonl'])
+    parser.add_argument('--export-title-only', action='store_true')
+    parser.add_argument('--extra-char-limits', type=int, nargs='*', default=[],
+                        help='Char limits of the short title variants generated besides the 30 char one')
+    parser.add_argument('--max-project-jobs', type=int, help='Job quota of the launch scheduler, no limit by default')
+    parser.add_argument('--tokens-per-minute', type=int, help='Token budget of the launch scheduler, no limit by default')
+    parser.add_argument('--short-titles', type=float, default=0, help='Share of products with titles that need no model')
+    parser.add_argument('--work-failure-rate', type=float, default=0, help='Share of worker steps that fail once delivered')
+    parser.add_argument('--derive-variants', action='store_true',
+                        help='Cut the shorter variants from the longest one instead of predicting them')
+    parser.add_argument('--verbose', action='store_true', help='Print the logs of the Cloud Function')
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        print(json.dumps(run_benchmark(rows, args.variants, args.concurrent_jobs, args.runs,
+                                       args.export_format, args.export_title_only, args.extra_char_limits,
+                                       args.max_project_jobs, args.tokens_per_minute, args.short_titles,
+                                       args.work_failure_rate, args.verbose, args.derive_variants),
+                     indent=2))
@@ -0,0 +1,224 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Prompt quality vs. cost benchmark over labeled rows. Every pipeline variant builds
+# the prompts of the labeled rows the way a run does, routing included, predicts
+# the model rows and reports latency, tokens, cost, how often the model output is
+# within the char limit and how close the final short titles are to the references.
+#
+#   python -m benchmarks.quality [--labels benchmarks/quality_labels.json]
+#                                [--variants variants.json] [--backend fake|vertex]
+#                                [--recording recording.json] [--record]
+#
+# The labels file holds the same values as online.py's config.json, plus "labels":
+# rows with a "Reference" short title. A variants file is a list of objects with a
+# "name" and any of the overrides of _DEFAULT_VARIANTS. With --recording, predictions
+# are replayed from the file, or with --record made by the backend and saved to it,
+# so prompt changes are compared on the same model outputs and without GCP.
+
+import argparse
+import copy
+import difflib
+import hashlib
+import json
+import os
+import time
+
+from online import load_config
+from utils.online import _MODEL_PARAMETERS, FakeTextModel, VertexOnlineModel, _percentile
+from utils.planner import prediction_usd
+from utils.prompt import (create_prompt, create_prompt_base, estimate_tokens, fit_to_length, max_context_chars,
+                          tokens_for_chars)
+from utils.routing import MODEL, ROUTES, route_title
+
+_LABELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quality_labels.json')
+_REFERENCE_COLUMN = 'Reference'
+_BATCH_SIZE = 16
+_DEFAULT_VARIANTS = [
+    {'name': 'current'},
+    {'name': 'no_routing', 'routing': False},
+    {'name': 'one_example', 'examples': 1},
+    {'name': 'token_budget_250', 'token_budget': 250},
+    {'name': 'max_output_tokens_16', 'max_output_tokens': 16},
+    {'name': 'temperature_0', 'temperature': 0},
+]
+
+
+class RecordedModel():
+    """Replays the predictions and latencies saved in a recording, keyed by prompt and
+    model parameters. With a model, prompts missing from the recording are predicted
+    and added to it."""
+    def __init__(self, path, model=None):
+        self.path = path
+        self.model = model
+        self.model_parameters = dict(_MODEL_PARAMETERS)
+        self.recording = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.recording = json.load(f)
+
+    def _key(self, prompt):
+        return hashlib.sha256(json.dumps([prompt, self.model_parameters], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def predict_batch_timed(self, prompts):
+        """Returns the predictions and the seconds the model took to make them"""
+        missing = [prompt for prompt in prompts if self._key(prompt) not in self.recording]
+        if missing:
+            if not self.model:
+                raise KeyError(f'{len(missing)} prompts are not in {self.path}, run with --record')
+            self.model.model_parameters = self.model_parameters
+            predictions, seconds = predict_batch_timed(self.model, missing)
+            for prompt, prediction in zip(missing, predictions):
+                self.recording[self._key(prompt)] = {'prediction': prediction,
+                                                     'seconds': seconds / len(missing)}
+        entries = [self.recording[self._key(prompt)] for prompt in prompts]
+        return [entry['prediction'] for entry in entries], sum(entry['seconds'] for entry in entries)
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.recording, f, indent=1, sort_keys=True)
+
+
+def predict_batch_timed(model, prompts):
+    if isinstance(model, RecordedModel):
+        return model.predict_batch_timed(prompts)
+    started = time.perf_counter()
+    predictions = model.predict_batch(prompts)
+    return predictions, time.perf_counter() - started
+
+
+def create_variant_config(config, variant):
+    """Copy of the config with the prompt overrides of the variant"""
+    variant_config = copy.copy(config)
+    if 'examples' in variant:
+        variant_config.examples_df = config.examples_df.head(variant['examples'])
+    variant_config.token_budget = variant.get('token_budget', config.token_budget)
+    variant_config.max_value_chars = variant.get('max_value_chars', config.max_value_chars)
+    variant_config.routing = variant.get('routing', config.routing)
+    return variant_config
+
+
+def similarity(short_title, reference):
+    return difflib.SequenceMatcher(None, short_title.lower(), reference.lower()).ratio()
+
+
+def run_variant(config, labels, model, variant, batch_size):
+    variant_config = create_variant_config(config, variant)
+    model.model_parameters = {
+        **_MODEL_PARAMETERS,
+        'maxOutputTokens': variant.get('max_output_tokens', _MODEL_PARAMETERS['maxOutputTokens']),
+        'temperature': variant.get('temperature', _MODEL_PARAMETERS['temperature']),
+    }
+    prompt_base = create_prompt_base(variant_config)
+
+    routes = []
+    short_titles = []
+    for row in labels:
+        route, short_title = route_title(row.get(config.title_column), config.char_limit) \
+            if variant_config.routing else (MODEL, None)
+        routes.append(route)
+        short_titles.append(short_title)
+    model_rows = [i for i, route in enumerate(routes) if route == MODEL]
+    context_chars = max_context_chars(variant_config.token_budget, [prompt_base])
+    prompts = [create_prompt(prompt_base, labels[i], config.columns, variant_config.max_value_chars, context_chars)
+               for i in model_rows]
+
+    predictions = []
+    batch_seconds = []
+    for start in range(0, len(prompts), batch_size):
+        batch, seconds = predict_batch_timed(model, prompts[start:start + batch_size])
+        predictions.extend(batch)
+        batch_seconds.append(seconds)
+    for i, prediction in zip(model_rows, predictions):
+        # The finalize SQL cuts the model outputs that are too long
+        short_titles[i] = fit_to_length(prediction, config.char_limit)
+
+    input_chars = sum(len(prompt) for prompt in prompts)
+    output_chars = sum(len(prediction) for prediction in predictions)
+    similarities = [similarity(short_title, row[_REFERENCE_COLUMN]) for short_title, row in zip(short_titles, labels)]
+    sorted_seconds = sorted(batch_seconds)
+    return {
+        'name': variant['name'],
+        'rows': len(labels),
+        'routes': {route: routes.count(route) for route in ROUTES},
+        'prompt_base_tokens': estimate_tokens(prompt_base),
+        'input_tokens': tokens_for_chars(input_chars),
+        'output_tokens': tokens_for_chars(output_chars),
+        'usd_per_1m_rows': round(prediction_usd(input_chars, output_chars) / len(labels) * 1000000, 2),
+        'model_seconds': round(sum(batch_seconds), 3),
+        'p50_batch_ms': round(_percentile(sorted_seconds, 50) * 1000, 1),
+        'p99_batch_ms': round(_percentile(sorted_seconds, 99) * 1000, 1),
+        # Share of the model outputs that didn't need cutting
+        'within_limit': round(sum(0 < len(prediction) <= config.char_limit for prediction in predictions)
+                              / len(predictions), 3) if predictions else None,
+        'similarity': round(sum(similarities) / len(similarities), 3),
+        'exact_match': round(sum(short_title.lower() == row[_REFERENCE_COLUMN].lower()
+                                 for short_title, row in zip(short_titles, labels)) / len(labels), 3),
+    }
+
+
+def run_benchmark(config, labels, model, variants, batch_size=_BATCH_SIZE):
+    return [run_variant(config, labels, model, variant, batch_size) for variant in variants]
+
+
+def create_model(backend, config, recording=None, record=False):
+    if backend == 'vertex':
+        model = VertexOnlineModel(os.environ['GOOGLE_CLOUD_PROJECT'])
+    else:
+        model = FakeTextModel(config.char_limit, latency_seconds=0)
+    if recording:
+        return RecordedModel(recording, model if record else None)
+    return model
+
+
+def print_results(results):
+    print(f"{'variant':<24}{'model rows':>11}{'tokens/row':>11}{'$/1M rows':>11}"
+          f"{'within limit':>13}{'similarity':>11}{'exact':>7}")
+    for result in results:
+        within_limit = '-' if result['within_limit'] is None else f"{result['within_limit']:.0%}"
+        print(f"{result['name']:<24}{result['routes'][MODEL]:>11}"
+              f"{result['input_tokens'] / max(result['routes'][MODEL], 1):>11.0f}"
+              f"{result['usd_per_1m_rows']:>11.2f}{within_limit:>13}"
+              f"{result['similarity']:>11.3f}{result['exact_match']:>7.0%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--labels', default=_LABELS)
+    parser.add_argument('--variants', help='JSON file with the pipeline variants to compare')
+    parser.add_argument('--backend', choices=['fake', 'vertex'], default='fake')
+    parser.add_argument('--recording', help='JSON file the predictions are replayed from')
+    parser.add_argument('--record', action='store_true', help='Add missing predictions to the recording')
+    parser.add_argument('--batch-size', type=int, default=_BATCH_SIZE)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    if args.record and not args.recording:
+        parser.error('--record requires --recording')
+
+    config = load_config(args.labels)
+    with open(args.labels) as f:
+        labels = json.load(f)['labels']
+    variants = _DEFAULT_VARIANTS
+    if args.variants:
+        with open(args.variants) as f:
+            variants = json.load(f)
+    model = create_model(args.backend, config, args.recording, args.record)
+
+    results = run_benchmark(config, labels, model, variants, args.batch_size)
+    if args.record:
+        model.save()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -12,27 +12,121 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# Triggered every time a results table is created in the Shrinkify dataset.
-# This Cloud Function takes the rows from the created result table that triggered it
-# and appends it's rows in a unified final results table named "shrinkify_final".
-# This then deletes the triggering 'results' table and the sub_table that created it, 
-# and creates a new batch prediction job for the next sub_table if one exists. 
+# Triggered every time a results table is created in a Shrinkify dataset. Every run
+# ID has its own "shrinkify_output_<run_id>" dataset, so all the tables below are
+# those of the dataset the results table was created in.
+# This Cloud Function takes the rows from the created result table that triggered it,
+# along with any other results table that is already complete, and merges the predicted
+# short titles into the persistent "prediction_cache" table in a single MERGE.
+# This then creates a new batch prediction job for the next unclaimed sub_table of
+# each, and only then deletes the merged 'results' tables and the sub_tables that
+# created them, so a step that stops halfway is redone in full when it's retried.
+# A next job that is already running or done is not launched again.
+# Before merging, a step claims each results table by creating an empty
+# "claim_<results table>" table, which only one step can do. A results table
+# claimed by another step is left to it, so two steps never both merge it and
+# launch the same next job. A step redelivered by Pub/Sub keeps its claims, they
+# are recorded under its message ID. Finalizing is claimed the same way. The run
+# drops the claims of an earlier run in the dataset when it starts.
+# With a window of K jobs in flight, results_N always hands over to sub_table_N+K,
+# where K is read from the "concurrent_jobs" label of the dataset.
+# Once no sub_table is left, it calls the "finalize_shrinkify" procedure created by
+# the run, which joins the cached short titles back to every feed row in "shrinkify_final".
+# When the run exports its results, the "export_shrinkify" procedure it created is
+# called for every merged results table, streaming the export shard by shard.
+# Every merge, launch and failed launch is appended to the "run_state" table,
+# which the app polls for progress (see utils/progress.py). Launches go through
+# the same LaunchScheduler as the app's (see utils/scheduler.py), so they wait for
+# a slot of the project's job quota and for the token budget, and launches rejected
+# for quota are retried with jittered backoff before they are recorded as failed.
+# The token budget is per instance, the job quota is read from Vertex AI.
+#
+# When the WORK_TOPIC environment variable is set, cloud_agent only publishes a
+# "merge" message to that Pub/Sub topic and returns, and process_work handles it
+# from a push subscription. A merge that fails is redelivered by Pub/Sub, up to a
+# maximum of attempts before it goes to a dead letter topic, and finalizing is a
+# message of its own, so each invocation only does one bounded step of the run.
+# Steps claim what they work on, so the worker can run several at once.
+# Without WORK_TOPIC, cloud_agent runs the steps itself, under the ID of the
+# triggering event, and is deployed with a single instance.
 
-import functions_framework
-from google.cloud import bigquery
-from vertexai.preview.language_models import TextGenerationModel
+# Only functions_framework is imported at load time. Most InsertJob events end up as
+# idle triggers, so the BigQuery and Vertex AI SDKs are imported on first use.
+# The steps only reach BigQuery and Vertex AI through the backend, so
+# benchmarks/pipeline.py runs them offline on utils/local.py:LocalCloudBackend.
+import base64
+import datetime
+import json
+import asyncio
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as JobTimeoutError
 
-_TEXT_MODEL = TextGenerationModel.from_pretrained("text-bison")
-_MODEL_PARAMETERS = {
-    "maxOutputTokens": "8",
-    "temperature": "0.2",
-    "topP": "0.95",
-    "topK": "40",
-}
+import functions_framework
 
 _SUB_TABLE_PREFIX = 'sub_table_'
 _SUB_RESULTS_TABLE_PREFIX = 'results_'
-_OUTPUT_TABLE = 'shrinkify_final'
+_CACHE_TABLE = 'prediction_cache'
+_FINALIZE_PROCEDURE = 'finalize_shrinkify'
+_CONCURRENT_JOBS_LABEL = 'concurrent_jobs'
+_RUN_STATE_TABLE = 'run_state'
+_EXPORT_PROCEDURE = 'export_shrinkify'
+_CLAIM_TABLE_PREFIX = 'claim_'
+# Handing a slot over doesn't add jobs, so quota errors are usually short lived
+_LAUNCH_ATTEMPTS = 4
+# Launches that get no job slot in this time, well within the worker's 540s timeout,
+# are recorded as failed for resume.py to pick up
+_MAX_SLOT_WAIT_SECONDS = 240
+# Next jobs of a merge are launched in parallel, up to this many at once
+_MAX_PARALLEL_LAUNCHES = 4
+# Finalizing keeps running in BigQuery after this, only its report is skipped
+_FINALIZE_WAIT_SECONDS = 300
+_MERGE = 'merge'
+_FINALIZE = 'finalize'
+
+# Reused across invocations served by the same instance
+_BQ_CLIENT = None
+_BACKEND = None
+_PUBLISHER = None
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_bigquery_client():
+    global _BQ_CLIENT
+    if _BQ_CLIENT is None:
+        from google.cloud import bigquery
+        _BQ_CLIENT = bigquery.Client()
+    return _BQ_CLIENT
+
+
+def get_backend():
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = BigQueryBackend(get_bigquery_client())
+    return _BACKEND
+
+
+def get_publisher():
+    global _PUBLISHER
+    if _PUBLISHER is None:
+        from google.cloud import pubsub_v1
+        _PUBLISHER = pubsub_v1.PublisherClient()
+    return _PUBLISHER
+
+
+def get_scheduler():
+    global _SCHEDULER
+    # The next jobs of a merge are launched from several threads
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            # utils/, zipped next to this file when the function is deployed
+            from utils.scheduler import LaunchScheduler
+            _SCHEDULER = LaunchScheduler(max_wait_seconds=_MAX_SLOT_WAIT_SECONDS, attempts=_LAUNCH_ATTEMPTS)
+        return _SCHEDULER
+
 
 @functions_framework.cloud_event
 def cloud_agent(cloudevent):
@@ -43,61 +137,193 @@ def cloud_agent(cloudevent):
 
     dataset_id = resource_name.split('/')[3]
     results_table_id = resource_name.split('/')[-1]
-    current_table_index = int(results_table_id.split('results_')[1])
-    sub_table_id = _SUB_TABLE_PREFIX + str(current_table_index)
 
-    client = bigquery.Client()
-    append_results(client, dataset_id, results_table_id)
-    delete_finished_tables(client, dataset_id, results_table_id, sub_table_id)
+    work = {'action': _MERGE, 'dataset_id': dataset_id, 'results_table_id': results_table_id}
+    if os.environ.get('WORK_TOPIC'):
+        publish_work(work)
+    else:
+        handle_work(work, cloudevent['id'])
+    return 0
+
+
+@functions_framework.cloud_event
+def process_work(cloudevent):
+    """Runs a step published by cloud_agent. Raising makes Pub/Sub redeliver the message."""
+    message = cloudevent.data['message']
+    work = json.loads(base64.b64decode(message['data']))
+    print(f'Work: {work}')
+    return handle_work(work, message['messageId'])
+
+
+def publish_work(work):
+    get_publisher().publish(os.environ['WORK_TOPIC'], json.dumps(work).encode('utf-8')).result()
+    print(f'Published {work}')
+
+
+def handle_work(work, claimant):
+    """Runs the step, claiming what it works on for claimant.
+    Returns the length checks if it finalized the run."""
+    backend = get_backend()
+    if work['action'] == _MERGE:
+        if merge_step(backend, work['dataset_id'], work['results_table_id'], claimant):
+            finalize = {'action': _FINALIZE, 'dataset_id': work['dataset_id']}
+            if os.environ.get('WORK_TOPIC'):
+                publish_work(finalize)
+            else:
+                return handle_work(finalize, claimant)
+    elif work['action'] == _FINALIZE:
+        return finalize_run(backend, work['dataset_id'], claimant)
+
+
+def merge_step(backend, dataset_id, results_table_id, claimant):
+    """Merges the completed results tables claimant could claim and launches
+    the next jobs, returns whether the run is ready to be finalized"""
+    results_table_ids = [table_id for table_id in get_completed_results_tables(backend, dataset_id, results_table_id)
+                         if claim(backend, dataset_id, table_id, claimant)]
+    if not results_table_ids:
+        print(f'{results_table_id} was already merged or is claimed by another step.')
+        return False
+
+    merge_started_at = now()
+    backend.merge_results(dataset_id, results_table_ids, _CACHE_TABLE)
+    events = [{'sub_table': get_table_index(table_id), 'status': 'merged',
+               'started_at': merge_started_at, 'finished_at': now()} for table_id in results_table_ids]
+    export_results(backend, dataset_id, results_table_ids)
+    concurrent_jobs = get_concurrent_jobs(backend, dataset_id)
+    next_table_indexes = [get_table_index(table_id) + concurrent_jobs for table_id in results_table_ids]
+    with ThreadPoolExecutor(_MAX_PARALLEL_LAUNCHES) as executor:
+        events += [event for event in executor.map(
+            lambda index: launch_next_batch_prediction(backend, dataset_id, index), next_table_indexes) if event]
+    record_run_state(backend, dataset_id, events)
+    # Only once the next jobs are launched, so a retried step still finds what to launch
+    delete_finished_tables(backend, dataset_id, results_table_ids)
+
+    return not has_sub_tables(backend, dataset_id)
+
+
+def launch_next_batch_prediction(backend, dataset_id, next_table_index):
+    """Returns the run state event of the launch, None if there was no sub table
+    left or its job was already launched"""
     try:
-        trigger_next_batch_prediction(client.project, dataset_id, current_table_index)
+        if trigger_next_batch_prediction(backend, dataset_id, next_table_index):
+            return {'sub_table': next_table_index, 'status': 'predicting', 'started_at': now()}
     except Exception as e:
-        f'Did not trigger prediction for sub table {str(current_table_index + 1)}'
+        print(f'Did not trigger prediction for sub table {next_table_index}: {e}')
+        traceback.print_exc()
+        return {'sub_table': next_table_index, 'status': 'failed',
+                'error': f'{type(e).__name__}: {e}', 'started_at': now()}
 
 
-def trigger_next_batch_prediction(project_id, dataset_id, current_table_index):
-    i = str(current_table_index + 1)
-    print('start prediction ' + i)
-    dataset = f'bq://{project_id}.{dataset_id}.{_SUB_TABLE_PREFIX}{i}'
-    destination_uri_prefix = f'bq://{project_id}.{dataset_id}.{_SUB_RESULTS_TABLE_PREFIX}{i}'
-    batch_predictions = VertexBatchPredictionHandler(dataset, destination_uri_prefix)
-    batch_predictions.init_batch_prediction()
+def claim(backend, dataset_id, name, claimant):
+    """Whether claimant holds the claim on name, taking it if nobody does"""
+    return backend.claim_table(dataset_id, _CLAIM_TABLE_PREFIX + name, claimant)
 
 
-def delete_finished_tables(client, dataset_id, results_table_id, sub_table_id):
-    """Deletes the triggering 'results' table and the 'sub_table' that created it"""
+def get_table_index(table_id):
+    return int(table_id.split('_')[-1])
 
-    results_table_ref = client.dataset(dataset_id).table(results_table_id)
-    sub_table_ref = client.dataset(dataset_id).table(sub_table_id)
 
-    try:
-        # Use the delete_table method to delete the table.
-        client.delete_table(results_table_ref)
-        print(f"Table {results_table_ref} deleted.")
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
 
-        # Use the delete_table method to delete the table.
-        client.delete_table(sub_table_ref)
-        print(f"Table {sub_table_ref} deleted.")
 
+def record_run_state(backend, dataset_id, events):
+    """Appends the events to the run state table. A failure here only costs progress reporting."""
+    try:
+        backend.record_run_state(dataset_id, _RUN_STATE_TABLE, events)
     except Exception as e:
-        print(f"Error in deleting table: {e}")
-    
-    
-def append_results(client, dataset_id, results_table_id):
-    project = client.project
-    source_table = f"{project}.{dataset_id}.{results_table_id}"
-    output_table = f"{project}.{dataset_id}.{_OUTPUT_TABLE}"
+        print(f'Error in recording the run state: {e}')
+        traceback.print_exc()
+
+
+def get_completed_results_tables(backend, dataset_id, results_table_id):
+    """Returns the triggering results table, if it still exists, and every other
+    results table that holds a prediction for each row of its sub table"""
+    table_ids = backend.list_tables(dataset_id)
+    completed = []
+    for table_id in table_ids:
+        if not table_id.startswith(_SUB_RESULTS_TABLE_PREFIX):
+            continue
+        if table_id == results_table_id:
+            completed.append(table_id)
+            continue
+        sub_table_id = _SUB_TABLE_PREFIX + str(get_table_index(table_id))
+        if sub_table_id not in table_ids:
+            continue
+        results_rows = backend.get_table_row_count(dataset_id, table_id)
+        sub_table_rows = backend.get_table_row_count(dataset_id, sub_table_id)
+        if results_rows and results_rows >= sub_table_rows:
+            completed.append(table_id)
+    return completed
+
 
-    # Create a job configuration to append data
-    job_config = bigquery.QueryJobConfig(destination=output_table)
-    job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+def has_sub_tables(backend, dataset_id):
+    """Whether any sub table is still waiting for or going through prediction"""
+    return any(table_id.startswith(_SUB_TABLE_PREFIX) for table_id in backend.list_tables(dataset_id))
 
-        # Create a query to append data
-    query = f"SELECT *, TRIM(STRING(predictions[0].content)) AS short_title FROM `{source_table}`"
-    append_job = client.query(query, job_config=job_config)
 
-    # Wait for the job to complete
-    append_job.result()
+def finalize_run(backend, dataset_id, claimant):
+    """Returns how many short titles passed the length check or had to be shortened,
+    None if the run wasn't finalized or finalizing is still going on"""
+    if has_sub_tables(backend, dataset_id):
+        print('Sub tables were left to predict, not finalizing.')
+        return
+    if not claim(backend, dataset_id, _FINALIZE, claimant):
+        print('Another step is finalizing the run.')
+        return
+    print('All sub tables predicted, writing final results.')
+    length_checks = backend.call_procedure(dataset_id, _FINALIZE_PROCEDURE, _FINALIZE_WAIT_SECONDS)
+    for length_check, row_count in (length_checks or {}).items():
+        print(f'Length check {length_check}: {row_count} rows')
+    return length_checks
+
+
+def get_concurrent_jobs(backend, dataset_id):
+    """Returns the number of batch prediction jobs the run keeps in flight"""
+    return int(backend.get_dataset_labels(dataset_id).get(_CONCURRENT_JOBS_LABEL, 1))
+
+
+def trigger_next_batch_prediction(backend, dataset_id, next_table_index):
+    """Submits the job of the next sub table, returns whether it was submitted.
+    A retried step finds the job of its first attempt running or done."""
+    i = str(next_table_index)
+    if not backend.table_exists(dataset_id, _SUB_TABLE_PREFIX + i):
+        print(f'No sub table {i} left to predict.')
+        return False
+    if backend.table_exists(dataset_id, _SUB_RESULTS_TABLE_PREFIX + i):
+        print(f'Sub table {i} was already predicted.')
+        return False
+    dataset = f'bq://{backend.project}.{dataset_id}.{_SUB_TABLE_PREFIX}{i}'
+    destination_uri_prefix = f'bq://{backend.project}.{dataset_id}.{_SUB_RESULTS_TABLE_PREFIX}{i}'
+    batch_predictions = backend.prediction_handler(dataset, destination_uri_prefix)
+    if batch_predictions.is_running():
+        print(f'Sub table {i} is already being predicted.')
+        return False
+    tokens = backend.get_token_count(dataset_id, _RUN_STATE_TABLE, next_table_index)
+    print('start prediction ' + i)
+    asyncio.run(get_scheduler().launch(batch_predictions, tokens))
+    return True
+
+
+def export_results(backend, dataset_id, results_table_ids):
+    """Exports the feed rows of the merged results tables in one job, if the run exports
+    its results. Errors are raised before the tables are dropped, so the step is retried,
+    by Pub/Sub or by resume, with the results tables still there to export."""
+    if not backend.procedure_exists(dataset_id, _EXPORT_PROCEDURE):
+        return
+    backend.export_results(dataset_id, _EXPORT_PROCEDURE, results_table_ids)
+    print(f"Exported {', '.join(results_table_ids)}.")
+
+
+def delete_finished_tables(backend, dataset_id, results_table_ids):
+    """Deletes the merged 'results' tables and the 'sub_tables' that created them in one job"""
+    table_ids = results_table_ids + [_SUB_TABLE_PREFIX + str(get_table_index(table_id))
+                                     for table_id in results_table_ids]
+    try:
+        backend.drop_tables(dataset_id, table_ids)
+        print(f"Tables {', '.join(table_ids)} deleted.")
+    except Exception as e:
+        print(f"Error in deleting tables: {e}")
 
 
 def log_and_get_resource(cloudevent):
@@ -121,17 +347,137 @@ def log_and_get_resource(cloudevent):
     return resource_name
 
 
-class VertexBatchPredictionHandler():
-    def __init__(self, dataset, destination_uri_prefix):
-        self.text_model = _TEXT_MODEL
-        self.dataset = dataset
-        self.destination_uri_prefix = destination_uri_prefix
-        self.model_parameters = _MODEL_PARAMETERS
-    
-    def init_batch_prediction(self):
-        self.text_model.batch_predict(
-            dataset=self.dataset,
-            destination_uri_prefix=self.destination_uri_prefix,
-            model_parameters=self.model_parameters
-        )
-    
\ No newline at end of file
+class BigQueryBackend():
+    """The BigQuery and Vertex AI calls of the steps, named after the
+    LocalBigQueryInteractor methods that stand in for them offline"""
+    def __init__(self, client):
+        self.client = client
+        self.project = client.project
+
+    def _table(self, dataset_id, table_id):
+        return self.client.dataset(dataset_id).table(table_id)
+
+    def list_tables(self, dataset_id):
+        return [table.table_id for table in self.client.list_tables(dataset_id)]
+
+    def table_exists(self, dataset_id, table_id):
+        from google.cloud.exceptions import NotFound
+
+        try:
+            self.client.get_table(self._table(dataset_id, table_id))
+            return True
+        except NotFound:
+            return False
+
+    def get_table_row_count(self, dataset_id, table_id):
+        return self.client.get_table(self._table(dataset_id, table_id)).num_rows
+
+    def get_dataset_labels(self, dataset_id):
+        return self.client.get_dataset(dataset_id).labels
+
+    def claim_table(self, dataset_id, table_id, claimant):
+        """Creates the empty table, described by claimant. Returns whether it
+        was created, or was already created by the same claimant."""
+        from google.cloud import bigquery
+        from google.cloud.exceptions import Conflict
+
+        table = bigquery.Table(self._table(dataset_id, table_id))
+        table.description = claimant
+        try:
+            self.client.create_table(table)
+            return True
+        except Conflict:
+            return self.client.get_table(table.reference).description == claimant
+
+    def procedure_exists(self, dataset_id, procedure_id):
+        from google.cloud.exceptions import NotFound
+
+        try:
+            self.client.get_routine(f'{self.project}.{dataset_id}.{procedure_id}')
+            return True
+        except NotFound:
+            return False
+
+    def merge_results(self, dataset_id, results_table_ids, cache_table_id):
+        source_tables = '\n        UNION ALL\n        '.join(
+            f"SELECT cache_key, predictions FROM `{self.project}.{dataset_id}.{table_id}`"
+            for table_id in results_table_ids)
+
+        # Only add predictions that aren't cached yet, so a retried event is a no-op
+        query = f"""
+        MERGE `{self.project}.{dataset_id}.{cache_table_id}` AS cache
+        USING (
+            SELECT cache_key, ANY_VALUE(TRIM(STRING(predictions[0].content))) AS short_title
+            FROM (
+            {source_tables}
+            )
+            WHERE STRING(predictions[0].content) IS NOT NULL
+            GROUP BY cache_key
+        ) AS results
+        ON cache.cache_key = results.cache_key
+        WHEN NOT MATCHED THEN
+            INSERT (cache_key, short_title) VALUES (results.cache_key, results.short_title)
+        """
+        self.client.query(query).result()
+
+    def export_results(self, dataset_id, procedure_id, results_table_ids):
+        """Calls the export procedure for every results table in one job"""
+        procedure = f'{self.project}.{dataset_id}.{procedure_id}'
+        query = '\n'.join(f"CALL `{procedure}`('{table_id}', '{table_id}');" for table_id in results_table_ids)
+        self.client.query(query).result()
+
+    def drop_tables(self, dataset_id, table_ids):
+        query = '\n'.join(f"DROP TABLE IF EXISTS `{self.project}.{dataset_id}.{table_id}`;"
+                          for table_id in table_ids)
+        self.client.query(query).result()
+
+    def record_run_state(self, dataset_id, run_state_table_id, events):
+        from google.cloud import bigquery
+
+        query = f"""
+        INSERT INTO `{self.project}.{dataset_id}.{run_state_table_id}`
+            (sub_table, status, row_count, token_count, error, started_at, finished_at)
+        SELECT
+            CAST(JSON_VALUE(event, '$.sub_table') AS INT64),
+            JSON_VALUE(event, '$.status'),
+            CAST(JSON_VALUE(event, '$.row_count') AS INT64),
+            CAST(JSON_VALUE(event, '$.token_count') AS INT64),
+            JSON_VALUE(event, '$.error'),
+            TIMESTAMP(JSON_VALUE(event, '$.started_at')),
+            TIMESTAMP(JSON_VALUE(event, '$.finished_at'))
+        FROM UNNEST(JSON_QUERY_ARRAY(@events)) AS event
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('events', 'STRING', json.dumps(events))])
+        self.client.query(query, job_config=job_config).result()
+
+    def call_procedure(self, dataset_id, procedure_id, timeout):
+        """Returns the (length_check, row_count) rows of the procedure as a dict,
+        None if it is still running after timeout seconds"""
+        job = self.client.query(f"CALL `{self.project}.{dataset_id}.{procedure_id}`()")
+        try:
+            rows = job.result(timeout=timeout)
+        except (TimeoutError, JobTimeoutError):
+            # The procedure records the run as finalized in run_state once it's done
+            print(f'Finalizing continues in BigQuery job {job.job_id}.')
+            return None
+        return {row.length_check: row.row_count for row in rows}
+
+    def get_token_count(self, dataset_id, run_state_table_id, sub_table):
+        """Prompt tokens of the sub table, as recorded by the sharding job"""
+        from google.cloud import bigquery
+
+        query = f"""
+        SELECT IFNULL(MAX(token_count), 0) AS token_count
+        FROM `{self.project}.{dataset_id}.{run_state_table_id}`
+        WHERE sub_table = @sub_table AND status = 'queued'
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('sub_table', 'INT64', sub_table)])
+        return next(iter(self.client.query(query, job_config=job_config).result())).token_count
+
+    def prediction_handler(self, dataset, destination_uri_prefix):
+        # utils/, zipped next to this file when the function is deployed
+        from utils.vertex import VertexBatchPredictionHandler
+
+        return VertexBatchPredictionHandler(dataset, destination_uri_prefix)
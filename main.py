@@ -12,70 +12,352 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import datetime
 import json
+import uuid
+from collections import defaultdict
 from utils.config import Config
+from utils.planner import RunEstimate, plan_run
+from utils.progress import FAILED, MERGED, PREDICTING, QUEUED, RunProgress
+from utils.prompt import create_prompt_base, estimate_tokens, max_context_chars, serialize_context, tokens_for_chars
+from utils.routing import FITS, MODEL, RULES, route_title
 from utils.bq import BigQueryInteractor
-from utils.vertex import VertexBatchPredictionHandler
+from utils.scheduler import get_launch_scheduler
+from utils.vertex import VertexBatchPredictionHandler, get_prompt_fingerprint
 
 
-_MAX_ROW_PER_SUB_TABLE = 25000
 _SUB_TABLE_PREFIX = 'sub_table_'
 _SUB_RESULTS_TABLE_PREFIX = 'results_'
+_CONCURRENT_JOBS_LABEL = 'concurrent_jobs'
+_FEED_TABLE = 'shrinkify_feed'
+_CACHE_TABLE = 'prediction_cache'
+_FINALIZE_PROCEDURE = 'finalize_shrinkify'
+_EXPORT_PROCEDURE = 'export_shrinkify'
+# Export part holding the rows that were served from the cache
+_CACHED_EXPORT_PART = 'cached'
+_RUN_STATE_TABLE = 'run_state'
+# The Cloud Function claims a results table or finalizing by creating "claim_<name>"
+_CLAIM_TABLE_PREFIX = 'claim_'
+_FINALIZE_CLAIM = _CLAIM_TABLE_PREFIX + 'finalize'
+# The Cloud Function normally merges a complete results table within a minute,
+# resume only takes over results tables that were left alone for longer
+_RESULTS_GRACE_SECONDS = 900
+# Rows sampled from the feed to estimate the context size before a run
+_ESTIMATE_SAMPLE_ROWS = 200
+# The feed table is read again to count cache misses, shard and finalize
+_FEED_TABLE_READS = 3
+# Bytes of a feed table row besides its context, mostly the cache key
+_FEED_ROW_OVERHEAD_BYTES = 64
 
-def create_prompt_base(config):
-    examples = json.loads(config.examples_df.to_json(orient='records'))
-    
-    prompt = f"""You are a leading digital marketer working for a top {config.industry} company. You are an expert at generating high-performing short search ad titles ensuring that the ad titles only contain the important {config.product_type} information while keeping the title as short as possible and always less than  {config.char_limit} characters long. A user needs your help to shorten these {config.product_type} titles. Generate Short Title using the given "Context".
-When you're done, check the length of the suggested {config.product_type} title, and if it's longer than {config.char_limit} characters try to make it even shorter by removing more words.
-"""
-    for example in examples:
-            short_title = example.pop('Short Title')
-            try:
-                example.pop('Character Count')
-            except:
-                pass
-            prompt += f"""
-Context:
-{str(example)}
-Short Title: {short_title}
-"""
-    
-    return prompt
-
-
-def create_prediction_sub_tables(config, bq):
-    """Split the main feed to sub tables in BQ, each holding
-    up to 30k rows, and holding the prompt for the predictions"""
-    feed_row_count = bq.get_table_row_count(config.source_dataset, config.source_table)
-    config.num_sub_tables = int(feed_row_count / _MAX_ROW_PER_SUB_TABLE) + 1
-    prompt_base = create_prompt_base(config)
-
-    for sub_table in range(config.num_sub_tables):
-        table_name = _SUB_TABLE_PREFIX + str(sub_table)
-        start_index = sub_table * _MAX_ROW_PER_SUB_TABLE
-        end_index = (sub_table + 1) * _MAX_ROW_PER_SUB_TABLE - 1
-        bq.extract_and_save_to_new_table(prompt_base, config.source_dataset, config.source_table,
-                                         config.output_dataset, table_name, config.columns, start_index, end_index)
-        print(f'Created sub_table_{sub_table}')
-
-def init_first_bulk_prediction_job(config, bq):
-    # TODO: b/313370000
+def prepare_variants(config):
+    """Sets the prompt base, cache key fingerprint, routing and title column of every variant of the run.
+    Titles can't be translated by rules, so variants in another language always use the model.
+
+    Every predicted variant pays for the prompt and context of the row again. With
+    derive_variants, shorter variants take the prompt of the longest variant in their
+    language instead, so they share its cache key and prediction, which the length
+    check cuts to their char limit."""
+    for variant in config.variants:
+        variant.prompt_base = create_prompt_base(config, variant)
+        variant.fingerprint = get_prompt_fingerprint(variant.prompt_base)
+        variant.routing = config.routing and not variant.language
+        variant.title_column = config.title_column
+    if config.derive_variants:
+        for variant in config.variants:
+            longest = max((other for other in config.variants
+                           if (other.language or '').lower() == (variant.language or '').lower()),
+                          key=lambda other: other.char_limit)
+            variant.prompt_base = longest.prompt_base
+            variant.fingerprint = longest.fingerprint
+    return config.variants
+
+
+def average_char_limit(config):
+    return sum(variant.char_limit for variant in config.variants) / len(config.variants)
+
+
+async def create_prediction_sub_tables(config, bq, variants):
+    """Split the prompts of all variants of the feed that have no cached
+    prediction to sub tables in BQ, sized by the run plan for the prompt
+    size and concurrency. All sub tables are written by a single sharding job."""
+    previous_table = config.output_table if config.incremental else None
+    context_chars = max_context_chars(config.token_budget, [variant.prompt_base for variant in variants])
+    await asyncio.gather(
+        bq.create_cache_table(config.output_dataset, _CACHE_TABLE),
+        bq.create_run_state_table(config.output_dataset, _RUN_STATE_TABLE),
+        bq.create_feed_table(variants, config.source_dataset, config.source_table,
+                             config.output_dataset, _FEED_TABLE, config.columns,
+                             config.key_column, previous_table, config.max_value_chars, context_chars))
+
+    # Report the routes and the prompt size before paying for any prediction
+    context_chars, config.route_counts = await asyncio.gather(
+        bq.get_average_length(config.output_dataset, _FEED_TABLE, 'column_values_dict'),
+        bq.get_route_counts(config.output_dataset, _FEED_TABLE, variants))
+    print_route_counts(config.route_counts)
+    base_tokens = round(sum(estimate_tokens(variant.prompt_base) for variant in variants) / len(variants))
+    context_tokens = tokens_for_chars(context_chars or 0)
+    config.tokens_per_row = base_tokens + context_tokens
+    print(f'~{config.tokens_per_row} prompt tokens per row '
+          f'({base_tokens} instructions and examples, {context_tokens} context)')
+
+    cache_misses = await bq.get_cache_miss_count(config.output_dataset, _FEED_TABLE, _CACHE_TABLE, variants)
+    config.run_plan = plan_run(cache_misses, config.tokens_per_row, config.concurrent_jobs)
+    print(f'Run plan: {config.run_plan}')
+    prediction_usd = RunEstimate(config.run_plan, 0, average_char_limit(config)).prediction_usd
+    if config.max_cost_usd and prediction_usd > config.max_cost_usd:
+        raise ValueError(f'Predictions would cost ~${prediction_usd:.2f}, more than the '
+                         f'${config.max_cost_usd:.2f} limit. Nothing was predicted.')
+    config.num_sub_tables = config.run_plan.num_sub_tables
+    if not config.num_sub_tables:
+        return
+
+    await bq.extract_and_save_to_sub_tables(variants, config.output_dataset, _FEED_TABLE,
+                                            _CACHE_TABLE, _SUB_TABLE_PREFIX, config.num_sub_tables,
+                                            _RUN_STATE_TABLE)
+    print(f'Created {config.num_sub_tables} sub tables')
+
+async def init_bulk_prediction_jobs(config, bq, prediction_handler=VertexBatchPredictionHandler, scheduler=None):
+    """Start the first batch prediction jobs, keeping up to
+    config.concurrent_jobs in flight. The Cloud Function picks up
+    the next sub table each time one of them finishes. Launches wait
+    for the project's quota, those that fail are left for resume.py."""
+    scheduler = scheduler or get_launch_scheduler()
     project_id = bq.get_project_id()
     output_dataset = config.output_dataset
-    
-    print('start prediction ' + str(0))
-    dataset = f'bq://{project_id}.{output_dataset}.{_SUB_TABLE_PREFIX}0'
-    destination_uri_prefix = f'bq://{project_id}.{output_dataset}.{_SUB_RESULTS_TABLE_PREFIX}0'
-    batch_predictions = VertexBatchPredictionHandler(dataset, destination_uri_prefix)
-    batch_predictions.init_batch_prediction()
+
+    # The Cloud Function reads the window size from the dataset labels
+    bq.set_dataset_labels(output_dataset, {_CONCURRENT_JOBS_LABEL: str(config.concurrent_jobs)})
+
+    tokens = get_queued_tokens(bq, output_dataset)
+    launches = []
+    for sub_table in range(min(config.concurrent_jobs, config.num_sub_tables)):
+        print('start prediction ' + str(sub_table))
+        dataset = f'bq://{project_id}.{output_dataset}.{_SUB_TABLE_PREFIX}{sub_table}'
+        destination_uri_prefix = f'bq://{project_id}.{output_dataset}.{_SUB_RESULTS_TABLE_PREFIX}{sub_table}'
+        batch_predictions = prediction_handler(dataset, destination_uri_prefix)
+        launches.append(launch_sub_table(scheduler, batch_predictions, sub_table, tokens.get(sub_table, 0)))
+    events = await asyncio.gather(*launches)
+    print(f'Launch scheduler: {scheduler}')
+
+    await bq.record_run_state(output_dataset, _RUN_STATE_TABLE, events)
+    if any(event['status'] == FAILED for event in events):
+        print('Some prediction jobs could not be started, run resume.py once the quota allows it.')
+
+
+async def launch_sub_table(scheduler, batch_predictions, sub_table, tokens):
+    """Launches the job of the sub table through the scheduler, returns its run state event"""
+    try:
+        await scheduler.launch(batch_predictions, tokens)
+        return {'sub_table': sub_table, 'status': PREDICTING, 'started_at': now().isoformat()}
+    except Exception as e:
+        print(f'Did not start prediction for sub table {sub_table}: {e}')
+        return {'sub_table': sub_table, 'status': FAILED, 'error': f'{type(e).__name__}: {e}',
+                'started_at': now().isoformat()}
+
+
+def get_queued_tokens(bq, dataset_id):
+    """Prompt tokens of every sub table, as recorded by the sharding job"""
+    return {event['sub_table']: event['token_count'] or 0
+            for event in bq.get_run_state(dataset_id, _RUN_STATE_TABLE) if event['status'] == QUEUED}
+
+
+async def run_async(config, bq, prediction_handler=VertexBatchPredictionHandler, scheduler=None):
+    """Runs the pipeline against any BigQueryInteractor compatible backend and
+    batch prediction handler, i.e. the local ones in utils/local.py"""
+    # Create shrinkify dataset
+    bq.create_dataset(config.output_dataset)
+    drop_claims(bq, config.output_dataset)
+
+    if config.incremental and not bq.table_exists(config.output_dataset, config.output_table):
+        print('No previous run found, processing the full feed.')
+        config.incremental = False
+
+    # The procedures don't depend on the sub tables, create them all at once
+    variants = prepare_variants(config)
+    await asyncio.gather(
+        create_prediction_sub_tables(config, bq, variants),
+        bq.create_finalize_procedure(config.output_dataset, _FINALIZE_PROCEDURE,
+                                     _FEED_TABLE, _CACHE_TABLE, config.output_table,
+                                     config.columns, config.key_column, config.incremental,
+                                     config.source_dataset, config.source_table, variants,
+                                     _RUN_STATE_TABLE),
+        bq.create_export_procedure(config.output_dataset, _EXPORT_PROCEDURE, _FEED_TABLE, _CACHE_TABLE,
+                                   config.columns, variants, config.export_uri,
+                                   config.export_format, config.export_columns))
+
+    # The rows served from the cache are ready, export them while the jobs run.
+    # The Cloud Function exports every other part as its results table is merged.
+    starts = []
+    if config.num_sub_tables:
+        starts.append(init_bulk_prediction_jobs(config, bq, prediction_handler, scheduler))
+    if config.export_uri:
+        print(f'Exporting results to {config.export_uri}')
+        starts.append(bq.call_export_procedure(
+            config.output_dataset, _EXPORT_PROCEDURE, _CACHED_EXPORT_PART, _CACHE_TABLE))
+    await asyncio.gather(*starts)
+
+    if not config.num_sub_tables:
+        # Everything was served from the cache
+        length_checks = await bq.call_procedure(config.output_dataset, _FINALIZE_PROCEDURE)
+        print_length_checks(dict(tuple(row) for row in length_checks))
+
+
+def drop_claims(bq, dataset_id):
+    """Claims left by an earlier run in the dataset would keep the Cloud Function
+    from merging the results tables of the same name"""
+    for table_id in bq.get_tables(dataset_id):
+        if table_id.startswith(_CLAIM_TABLE_PREFIX):
+            bq.drop_table(dataset_id, table_id)
+
+
+async def estimate_async(config, bq):
+    """Estimates the cost and duration of a run before starting it. The feed query
+    is dry run for the bytes it scans, and the prompt size is taken from the prompt
+    base and a sample of the feed. The share of prompts routed to the model is taken
+    from the same sample. Every such prompt is assumed to miss the cache, so the
+    estimate is an upper bound for re-runs and incremental runs."""
+    variants = prepare_variants(config)
+    previous_table = config.output_table if config.incremental and bq.table_exists(
+        config.output_dataset, config.output_table) else None
+    context_limit = max_context_chars(config.token_budget, [variant.prompt_base for variant in variants])
+    source_bytes, sample = await asyncio.gather(
+        bq.dry_run_feed_table(variants, config.source_dataset, config.source_table,
+                              config.output_dataset, config.columns, config.key_column, previous_table,
+                              config.max_value_chars, context_limit),
+        asyncio.to_thread(bq.sample_rows, config.source_dataset, config.source_table, config.columns,
+                          _ESTIMATE_SAMPLE_ROWS))
+
+    sample = [dict(row.items()) for row in sample]
+    contexts = [serialize_context(row, config.columns, config.max_value_chars, context_limit) for row in sample]
+    context_chars = sum(len(context) for context in contexts) / max(len(contexts), 1)
+    base_tokens = sum(estimate_tokens(variant.prompt_base) for variant in variants) / len(variants)
+    tokens_per_row = round(base_tokens + tokens_for_chars(context_chars))
+    rows = bq.get_table_row_count(config.source_dataset, config.source_table)
+    # Variants with the same prompt, see prepare_variants, share one prediction per row
+    routed_to_model = sum(len({
+        variant.fingerprint for variant in variants
+        if not variant.routing or route_title(row[config.title_column], variant.char_limit)[0] == MODEL})
+        for row in sample)
+    prompts = round(rows * routed_to_model / len(sample)) if sample else \
+        rows * len({variant.fingerprint for variant in variants})
+
+    feed_bytes = rows * (context_chars + _FEED_ROW_OVERHEAD_BYTES)
+    bytes_scanned = source_bytes + _FEED_TABLE_READS * round(feed_bytes)
+    return RunEstimate(plan_run(prompts, tokens_per_row, config.concurrent_jobs), bytes_scanned,
+                       average_char_limit(config))
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+async def resume_async(bq, dataset_id, prediction_handler=VertexBatchPredictionHandler, scheduler=None):
+    """Restarts the chains of sub tables that stopped, i.e. after a failed batch
+    prediction job or a missed Cloud Function trigger. Sub tables that were merged
+    are gone from the dataset, so finished work is never predicted again.
+    Returns whether the run is finalized."""
+    table_ids = bq.get_tables(dataset_id)
+    sub_tables = sorted(int(table_id[len(_SUB_TABLE_PREFIX):]) for table_id in table_ids
+                        if table_id.startswith(_SUB_TABLE_PREFIX) and table_id[len(_SUB_TABLE_PREFIX):].isdigit())
+
+    # The Cloud Function hands results_N over to sub_table_N+K, so the sub tables
+    # left form K chains and only the first sub table of a chain can be in flight
+    concurrent_jobs = int(bq.get_dataset_labels(dataset_id).get(_CONCURRENT_JOBS_LABEL, 1))
+    chains = defaultdict(list)
+    for sub_table in sub_tables:
+        chains[sub_table % concurrent_jobs].append(sub_table)
+    scheduler = scheduler or get_launch_scheduler()
+    tokens = get_queued_tokens(bq, dataset_id)
+    # Claims of the Cloud Function are only taken over once they are as old as the grace period
+    claimant = f'resume-{uuid.uuid4()}'
+    await asyncio.gather(*(resume_chain(bq, dataset_id, chain, table_ids, prediction_handler, scheduler, tokens,
+                                        claimant) for chain in chains.values()))
+
+    if any(table_id.startswith(_SUB_TABLE_PREFIX) for table_id in bq.get_tables(dataset_id)):
+        return False
+    if not RunProgress(bq.get_run_state(dataset_id, _RUN_STATE_TABLE), concurrent_jobs).finalized:
+        if not bq.claim_table(dataset_id, _FINALIZE_CLAIM, claimant, _RESULTS_GRACE_SECONDS):
+            print('The Cloud Function is finalizing the run.')
+            return False
+        print('All sub tables predicted, writing final results.')
+        length_checks = await bq.call_procedure(dataset_id, _FINALIZE_PROCEDURE)
+        print_length_checks(dict(tuple(row) for row in length_checks))
+    return True
+
+
+async def resume_chain(bq, dataset_id, chain, table_ids, prediction_handler, scheduler, tokens, claimant):
+    """Merges the results the Cloud Function missed, then relaunches the first
+    sub table of the chain unless its job is still running"""
+    project_id = bq.get_project_id()
+    for sub_table in chain:
+        sub_table_id = f'{_SUB_TABLE_PREFIX}{sub_table}'
+        results_table_id = f'{_SUB_RESULTS_TABLE_PREFIX}{sub_table}'
+        if results_table_id in table_ids and (
+                bq.get_table_row_count(dataset_id, results_table_id) >= bq.get_table_row_count(dataset_id, sub_table_id)):
+            if (now() - bq.get_table_modified(dataset_id, results_table_id)).total_seconds() < _RESULTS_GRACE_SECONDS:
+                print(f'{results_table_id} is complete, leaving it to the Cloud Function.')
+                return
+            if not bq.claim_table(dataset_id, _CLAIM_TABLE_PREFIX + results_table_id, claimant,
+                                  _RESULTS_GRACE_SECONDS):
+                print(f'{results_table_id} is being merged by the Cloud Function.')
+                return
+            merge_started_at = now().isoformat()
+            await bq.merge_results(dataset_id, [results_table_id], _CACHE_TABLE)
+            if bq.procedure_exists(dataset_id, _EXPORT_PROCEDURE):
+                await bq.call_export_procedure(dataset_id, _EXPORT_PROCEDURE, results_table_id, results_table_id)
+            bq.drop_table(dataset_id, results_table_id)
+            bq.drop_table(dataset_id, sub_table_id)
+            print(f'Merged {results_table_id}, which the Cloud Function missed.')
+            await bq.record_run_state(dataset_id, _RUN_STATE_TABLE, [{
+                'sub_table': sub_table, 'status': MERGED, 'started_at': merge_started_at,
+                'finished_at': now().isoformat()}])
+            continue
+
+        batch_predictions = prediction_handler(
+            f'bq://{project_id}.{dataset_id}.{sub_table_id}',
+            f'bq://{project_id}.{dataset_id}.{results_table_id}')
+        if await asyncio.to_thread(batch_predictions.is_running):
+            print(f'{sub_table_id} is still being predicted.')
+            return
+
+        # Partial results of a failed job would block the new job's destination
+        bq.drop_table(dataset_id, results_table_id)
+        print('restart prediction ' + str(sub_table))
+        event = await launch_sub_table(scheduler, batch_predictions, sub_table, tokens.get(sub_table, 0))
+        await bq.record_run_state(dataset_id, _RUN_STATE_TABLE, [event])
+        return
+
+
+def print_route_counts(route_counts):
+    for column, counts in route_counts.items():
+        print(f'{column}: {counts[FITS]} rows already fit, {counts[RULES]} shortened by rules, '
+              f'{counts[MODEL]} sent to the model')
+
+
+def print_length_checks(length_checks):
+    """Rows failing the length check of the model pass were shortened in a second, word dropping pass"""
+    passes = 2 if length_checks.get('shortened') or length_checks.get('missing') else 1
+    print(f'Length check in {passes} passes: {length_checks.get("passed", 0)} passed, '
+          f'{length_checks.get("shortened", 0)} shortened, {length_checks.get("missing", 0)} without prediction')
 
 
 def run(config_params): 
+    """Starts the run and returns its config, the Cloud Function takes it from there"""
     config = Config.from_dict(config_params)
     bq = BigQueryInteractor()
+    asyncio.run(run_async(config, bq))
+    return config
 
-    # Create shrinkify dataset
-    bq.create_dataset(config.output_dataset)
-    
-    create_prediction_sub_tables(config, bq)
-    init_first_bulk_prediction_job(config, bq)
+
+def estimate(config_params):
+    """Returns the RunEstimate of the run the config_params would start"""
+    config = Config.from_dict(config_params)
+    bq = BigQueryInteractor()
+    return asyncio.run(estimate_async(config, bq))
+
+
+def resume(dataset_id):
+    """Restarts the stopped parts of the run in dataset_id, returns whether it's finalized"""
+    bq = BigQueryInteractor()
+    return asyncio.run(resume_async(bq, dataset_id))
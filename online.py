@@ -0,0 +1,109 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Low latency HTTP endpoint for shortening a handful of titles, i.e. newly launched products.
+#
+#   python online.py --config config.json [--port 8081] [--fake-model]
+#
+# config.json holds the same values as the app: industry, product_type, char_limit,
+# columns and examples (a list of rows with a "Short Title").
+#
+#   POST /shorten  {"rows": [{"<column>": "<value>", ...}, ...]}  ->  {"short_titles": [...]}
+#   GET  /metrics  ->  p50/p99 latency and throughput
+
+import argparse
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from utils.prompt import create_prompt, create_prompt_base, fit_to_length, max_context_chars
+from utils.config import Config
+from utils.online import FakeTextModel, MicroBatcher, VertexOnlineModel
+
+_REQUEST_TIMEOUT_SECONDS = 30
+
+
+class ShrinkifyHandler(BaseHTTPRequestHandler):
+    config = None
+    prompt_base = None
+    max_context_chars = None
+    batcher = None
+
+    def do_POST(self):
+        if self.path != '/shorten':
+            return self._send_json(404, {'error': 'Not found'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            prompts = [create_prompt(
+                self.prompt_base, row, self.config.columns, self.config.max_value_chars, self.max_context_chars)
+                for row in body['rows']]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._send_json(400, {'error': f'Invalid request: {e}'})
+        try:
+            short_titles = self.batcher.predict(prompts, timeout=_REQUEST_TIMEOUT_SECONDS)
+        except Exception as e:
+            return self._send_json(500, {'error': str(e)})
+        # Outputs too long, or cut at maxOutputTokens, are shortened like in the final table
+        self._send_json(200, {'short_titles': [fit_to_length(short_title, self.config.char_limit)
+                                               for short_title in short_titles]})
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._send_json(404, {'error': 'Not found'})
+        self._send_json(200, self.batcher.stats.to_dict())
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def load_config(path):
+    with open(path) as f:
+        config_params = json.load(f)
+    config_params['examples_df'] = pd.DataFrame(config_params.pop('examples'))
+    return Config.from_dict(config_params)
+
+
+def serve(config, model, port, max_batch_size, max_wait_seconds, max_concurrent_calls):
+    ShrinkifyHandler.config = config
+    ShrinkifyHandler.prompt_base = create_prompt_base(config)
+    ShrinkifyHandler.max_context_chars = max_context_chars(config.token_budget, [ShrinkifyHandler.prompt_base])
+    ShrinkifyHandler.batcher = MicroBatcher(model, max_batch_size, max_wait_seconds, max_concurrent_calls)
+    server = ThreadingHTTPServer(('0.0.0.0', port), ShrinkifyHandler)
+    print(f'Serving Shrinkify on port {port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fake-model', action='store_true', help='Use a local fake model, no GCP needed')
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=int, default=50)
+    parser.add_argument('--max-concurrent-calls', type=int, default=4)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.fake_model:
+        model = FakeTextModel(config.char_limit)
+    else:
+        model = VertexOnlineModel(os.environ['GOOGLE_CLOUD_PROJECT'])
+    serve(config, model, args.port, args.max_batch_size, args.max_wait_ms / 1000, args.max_concurrent_calls)
@@ -0,0 +1,40 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Resumes a run whose chain of batch prediction jobs stopped, i.e. after a failed
+# job or a missed Cloud Function trigger. Only the sub tables left in the dataset
+# are predicted, finished ones are never paid for twice.
+#
+#   python resume.py [--run-id <run_id>] [--watch-minutes 10]
+#
+# With --watch-minutes, keeps checking the run until it's finalized.
+
+import argparse
+import time
+
+from main import resume
+from utils.config import get_output_dataset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--run-id', help='Run ID the run was started with, if any')
+    parser.add_argument('--watch-minutes', type=float, help='Check the run again every so many minutes until it is done')
+    args = parser.parse_args()
+
+    dataset_id = get_output_dataset(args.run_id)
+    finalized = resume(dataset_id)
+    while not finalized and args.watch_minutes:
+        time.sleep(args.watch_minutes * 60)
+        finalized = resume(dataset_id)
+    print('Run finalized.' if finalized else 'Run still in progress.')
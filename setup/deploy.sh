@@ -27,7 +27,9 @@ enable_apis() {
 
 zip_cf_source() {
     echo -e "${COLOR}Zipping cloud function source...${NC}"
+    # The function imports the Vertex AI handler and launch scheduler of the app, zipped next to it
     zip -j setup/shrinkify_cf.zip cloud_function/main.py cloud_function/requirements.txt
+    zip setup/shrinkify_cf.zip utils/vertex.py utils/scheduler.py utils/clients.py
 }
 
 create_image() {
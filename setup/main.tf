@@ -27,7 +27,8 @@ variable "service_name" {
 
 variable "dataset_id" {
   type = string
-  default = "shrinkify_output"
+  # Also matches the "shrinkify_output_<run_id>" datasets of runs with a run ID
+  default = "shrinkify_output*"
 }
 
 variable "table_id" {
@@ -35,6 +36,19 @@ variable "table_id" {
   default = "results_*"
 }
 
+variable "worker_instances" {
+  type = number
+  # Steps claim the tables they work on, so they can run at once. This bounds the
+  # steps in flight, each running one step at a time.
+  default = 10
+}
+
+variable "work_max_delivery_attempts" {
+  type = number
+  # A step failing this many times goes to the dead letter topic, resume.py picks up its tables
+  default = 5
+}
+
 locals {
   service_account = "${var.project_number}-compute@developer.gserviceaccount.com"
 }
@@ -96,6 +110,12 @@ resource "google_project_iam_member" "eventarc_admin" {
   member  = "serviceAccount:${local.service_account}"
 }
 
+resource "google_project_iam_member" "pubsub_publisher" {
+  project = var.project_id
+  role    = "roles/pubsub.publisher"
+  member  = "serviceAccount:${local.service_account}"
+}
+
 resource "google_project_iam_member" "pubsub_service_account_token_creator" {
   project = var.project_id
   role    = "roles/iam.serviceAccountTokenCreator"
@@ -167,6 +187,40 @@ resource "google_storage_bucket_object" "source" {
   bucket = google_storage_bucket.cf_zip_bucket.name
 }
 
+# Queue of merge and finalize steps, published by the trigger function
+# and processed by the worker function
+
+resource "google_pubsub_topic" "work" {
+  name    = "${var.service_name}-work"
+  project = var.project_id
+}
+
+# Steps that keep failing, kept for a week to be inspected
+resource "google_pubsub_topic" "work_dead_letter" {
+  name    = "${var.service_name}-work-dead-letter"
+  project = var.project_id
+}
+
+resource "google_pubsub_subscription" "work_dead_letter" {
+  name    = "${var.service_name}-work-dead-letter"
+  topic   = google_pubsub_topic.work_dead_letter.id
+  project = var.project_id
+  message_retention_duration = "604800s"
+}
+
+# The Pub/Sub service agent forwards dead letters and acks them on the work subscription
+resource "google_pubsub_topic_iam_member" "work_dead_letter_publisher" {
+  topic  = google_pubsub_topic.work_dead_letter.id
+  role   = "roles/pubsub.publisher"
+  member = "serviceAccount:service-${var.project_number}@gcp-sa-pubsub.iam.gserviceaccount.com"
+}
+
+resource "google_pubsub_subscription_iam_member" "work_subscriber" {
+  subscription = google_pubsub_subscription.work.id
+  role         = "roles/pubsub.subscriber"
+  member       = "serviceAccount:service-${var.project_number}@gcp-sa-pubsub.iam.gserviceaccount.com"
+}
+
 # Deploy Cloud Function 
 
 resource "google_cloudfunctions2_function" "function" {
@@ -175,6 +229,7 @@ resource "google_cloudfunctions2_function" "function" {
     google_project_iam_member.eventarc_admin,
     google_project_iam_member.eventarc_event_receiver,
     google_project_iam_member.function_viewer,
+    google_project_iam_member.pubsub_publisher,
     google_project_iam_member.pubsub_service_account_token_creator,
     google_project_iam_member.run_invoker,
     google_project_iam_member.service_account_token_creator,
@@ -195,10 +250,14 @@ resource "google_cloudfunctions2_function" "function" {
     }
   }
   service_config {
+    # Only publishes the merge step, see the worker function below
     max_instance_count  = 1
-    available_memory    = "512M"
-    timeout_seconds     = 540
+    available_memory    = "256M"
+    timeout_seconds     = 60
     service_account_email = local.service_account
+    environment_variables = {
+      WORK_TOPIC = google_pubsub_topic.work.id
+    }
   }
   event_trigger {
     trigger_region = var.region
@@ -219,4 +278,58 @@ resource "google_cloudfunctions2_function" "function" {
       operator = "match-path-pattern" # This allows path patterns to be used in the value field
     }
   }
+}
+
+resource "google_cloudfunctions2_function" "worker" {
+  depends_on = [
+    google_cloudfunctions2_function.function,
+  ]
+  name = "shrinkify_worker"
+  location = var.region
+  project = var.project_id
+  build_config {
+    runtime     = "python310"
+    entry_point = "process_work"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.cf_zip_bucket.name
+        object = google_storage_bucket_object.source.name
+      }
+    }
+  }
+  service_config {
+    max_instance_count  = var.worker_instances
+    max_instance_request_concurrency = 1
+    available_memory    = "512M"
+    timeout_seconds     = 540
+    service_account_email = local.service_account
+    environment_variables = {
+      WORK_TOPIC = google_pubsub_topic.work.id
+    }
+  }
+}
+
+# Pushes the steps to the worker. Unlike an event trigger, the subscription can
+# dead letter a step once it failed work_max_delivery_attempts times.
+resource "google_pubsub_subscription" "work" {
+  name    = "${var.service_name}-work"
+  topic   = google_pubsub_topic.work.id
+  project = var.project_id
+  # As long as the worker may take on a step
+  ack_deadline_seconds = 600
+  push_config {
+    push_endpoint = google_cloudfunctions2_function.worker.service_config[0].uri
+    oidc_token {
+      service_account_email = local.service_account
+    }
+  }
+  # Failed steps are redelivered, every step is safe to run twice
+  retry_policy {
+    minimum_backoff = "10s"
+    maximum_backoff = "600s"
+  }
+  dead_letter_policy {
+    dead_letter_topic     = google_pubsub_topic.work_dead_letter.id
+    max_delivery_attempts = var.work_max_delivery_attempts
+  }
 }
\ No newline at end of file
@@ -15,6 +15,13 @@
 project_number=$(gcloud projects describe ${GOOGLE_CLOUD_PROJECT} --format="value(projectNumber)")
 service_account="serviceAccount:${project_number}-compute@developer.gserviceaccount.com"
 cf_name="shrinkify-cf"
+worker_name="shrinkify-worker"
+# Steps claim the tables they work on, so several can run at once
+worker_instances=10
+work_max_delivery_attempts=5
+work_topic="shrinkify-work"
+dead_letter_topic="shrinkify-work-dead-letter"
+pubsub_service_account="serviceAccount:service-${project_number}@gcp-sa-pubsub.iam.gserviceaccount.com"
 
 echo "Setting Project ID: ${GOOGLE_CLOUD_PROJECT}"
 gcloud config set project ${GOOGLE_CLOUD_PROJECT}
@@ -39,7 +46,62 @@ gcloud projects add-iam-policy-binding ${GOOGLE_CLOUD_PROJECT} \
     --member=$service_account \
     --role=roles/eventarc.eventReceiver
 
-echo "Creating cloud function..."
+echo "Creating work topics..."
+# Merge and finalize steps are published by the trigger function and pushed to the
+# worker function. Steps failing too often go to the dead letter topic, whose
+# subscription keeps them for a week.
+gcloud pubsub topics create $work_topic
+gcloud pubsub topics create $dead_letter_topic
+gcloud pubsub subscriptions create $dead_letter_topic \
+  --topic=$dead_letter_topic \
+  --message-retention-duration=7d
+gcloud projects add-iam-policy-binding ${GOOGLE_CLOUD_PROJECT} \
+    --member=$service_account \
+    --role=roles/pubsub.publisher
+gcloud projects add-iam-policy-binding ${GOOGLE_CLOUD_PROJECT} \
+    --member=$pubsub_service_account \
+    --role=roles/iam.serviceAccountTokenCreator
+
+echo "Creating cloud functions..."
+# The function imports the Vertex AI handler and launch scheduler of the app from its own source directory
+mkdir -p cloud_function/utils
+cp utils/vertex.py utils/scheduler.py utils/clients.py cloud_function/utils/
+gcloud functions deploy $worker_name \
+--gen2 \
+--region=us-central1 \
+--runtime=python39 \
+--source=./cloud_function/ \
+--entry-point=process_work \
+--trigger-http \
+--no-allow-unauthenticated \
+--set-env-vars=WORK_TOPIC=projects/${GOOGLE_CLOUD_PROJECT}/topics/$work_topic \
+--memory=512Mi \
+--timeout=540s \
+--max-instances=$worker_instances \
+--concurrency=1
+
+gcloud run services add-iam-policy-binding $worker_name \
+  --member=$service_account \
+  --role='roles/run.invoker' \
+  --region=us-central1
+
+# Failed steps are redelivered with backoff, every step is safe to run twice
+gcloud pubsub subscriptions create $work_topic \
+  --topic=$work_topic \
+  --push-endpoint=$(gcloud functions describe $worker_name --gen2 --region=us-central1 --format="value(serviceConfig.uri)") \
+  --push-auth-service-account=${project_number}-compute@developer.gserviceaccount.com \
+  --ack-deadline=600 \
+  --min-retry-delay=10s \
+  --max-retry-delay=600s \
+  --dead-letter-topic=$dead_letter_topic \
+  --max-delivery-attempts=$work_max_delivery_attempts
+gcloud pubsub topics add-iam-policy-binding $dead_letter_topic \
+  --member=$pubsub_service_account \
+  --role=roles/pubsub.publisher
+gcloud pubsub subscriptions add-iam-policy-binding $work_topic \
+  --member=$pubsub_service_account \
+  --role=roles/pubsub.subscriber
+
 gcloud functions deploy $cf_name \
 --gen2 \
 --region=us-central1 \
@@ -50,8 +112,10 @@ gcloud functions deploy $cf_name \
 --trigger-event-filters="type=google.cloud.audit.log.v1.written" \
 --trigger-event-filters="serviceName=bigquery.googleapis.com" \
 --trigger-event-filters="methodName=google.cloud.bigquery.v2.JobService.InsertJob" \
---trigger-event-filters-path-pattern="resourceName=/projects/${GOOGLE_CLOUD_PROJECT}/datasets/shrinkify_output/tables/results_*" \
---timeout=520s 
+--trigger-event-filters-path-pattern="resourceName=/projects/${GOOGLE_CLOUD_PROJECT}/datasets/shrinkify_output*/tables/results_*" \
+--set-env-vars=WORK_TOPIC=projects/${GOOGLE_CLOUD_PROJECT}/topics/$work_topic \
+--timeout=60s \
+--max-instances=1
 
 echo "Setting service account permissions..."
 gcloud run services add-iam-policy-binding $cf_name \
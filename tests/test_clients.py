@@ -0,0 +1,118 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextvars
+import threading
+
+import pytest
+
+from utils.bq import BigQueryInteractor
+from utils.clients import StubBigQueryClient, retry_with_backoff, wait_for_job
+
+_LATENCY_SECONDS = 1
+# Only bounds a broken test, the jobs never wait for it when they overlap
+_BARRIER_TIMEOUT_SECONDS = 30
+
+_sleep = asyncio.sleep
+_elapsed = contextvars.ContextVar('elapsed', default=0.0)
+
+
+class TaskClock():
+    """Time that only moves when a task sleeps. Every gathered task has a time of
+    its own, which the threads it starts read too. The delays are kept in sleeps."""
+    def __init__(self):
+        self.sleeps = []
+
+    def __call__(self):
+        return _elapsed.get()
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        _elapsed.set(_elapsed.get() + seconds)
+        await _sleep(0)
+
+
+class BarrierBigQueryClient(StubBigQueryClient):
+    """Only returns a submitted job once parties queries are being submitted at
+    once, so it fails unless they are"""
+    def __init__(self, parties, **kwargs):
+        super().__init__(**kwargs)
+        self.barrier = threading.Barrier(parties, timeout=_BARRIER_TIMEOUT_SECONDS)
+
+    def query(self, query, job_config=None):
+        job = super().query(query, job_config)
+        self.barrier.wait()
+        return job
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = TaskClock()
+    monkeypatch.setattr(asyncio, 'sleep', clock.sleep)
+    return clock
+
+
+def test_gathered_jobs_overlap(clock):
+    client = BarrierBigQueryClient(4, latency_seconds=_LATENCY_SECONDS, clock=clock)
+    bq = BigQueryInteractor(client)
+
+    async def run_jobs():
+        await asyncio.gather(
+            bq.create_cache_table('dataset', 'prediction_cache'),
+            bq.create_run_state_table('dataset', 'run_state'),
+            bq.run_query_async('SELECT 1'),
+            bq.run_query_async('SELECT 2'))
+
+    asyncio.run(run_jobs())
+
+    assert len(client.queries) == 4
+    assert client.max_running_jobs == 4
+    # Every job is polled until its own latency is over, backing off between polls
+    assert sorted(clock.sleeps) == [0.5] * 4 + [1] * 4
+
+
+def test_sequential_jobs_do_not_overlap(clock):
+    client = StubBigQueryClient(latency_seconds=0.2, clock=clock)
+    bq = BigQueryInteractor(client)
+
+    async def run_jobs():
+        for i in range(3):
+            await bq.run_query_async(f'SELECT {i}')
+
+    asyncio.run(run_jobs())
+    assert client.max_running_jobs == 1
+    assert clock.sleeps == [0.5] * 3
+
+
+def test_wait_for_job_backs_off_and_returns_the_rows(clock):
+    client = StubBigQueryClient(latency_seconds=10, result_rows=[('passed', 3)], clock=clock)
+
+    assert asyncio.run(wait_for_job(client.query('SELECT 1'))) == [('passed', 3)]
+    assert clock.sleeps == [0.5, 1, 2, 4, 5]
+
+
+def test_retry_with_backoff_raises_the_last_error(clock):
+    attempts = []
+
+    def fail():
+        attempts.append(len(attempts))
+        raise ConnectionError('unavailable')
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(retry_with_backoff(fail, 3, 1, 1.5, (ConnectionError,), clock.sleep))
+    assert attempts == [0, 1, 2]
+    assert len(clock.sleeps) == 2
+    assert 0 <= clock.sleeps[0] <= 1
+    assert 0 <= clock.sleeps[1] <= 1.5
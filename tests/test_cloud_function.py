@@ -0,0 +1,121 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+pytest.importorskip('functions_framework')
+
+from benchmarks.pipeline import load_cloud_function
+from utils.local import LocalBigQueryInteractor, LocalCloudBackend, local_prediction_handler
+from utils.scheduler import LaunchScheduler
+
+_DATASET = 'shrinkify_output'
+
+
+@pytest.fixture
+def cloud_function():
+    """The Cloud Function on a dataset where results_0 is complete and sub_table_1 is next"""
+    module = load_cloud_function()
+    bq = LocalBigQueryInteractor(export_dir=None)
+    bq.set_dataset_labels(_DATASET, {'concurrent_jobs': '1'})
+    bq.create_table(_DATASET, 'prediction_cache', ['cache_key', 'short_title'], [])
+    bq.create_table(_DATASET, 'run_state', ['sub_table', 'status', 'row_count', 'token_count', 'error',
+                                             'started_at', 'finished_at'], [])
+    for sub_table in range(2):
+        bq.create_table(_DATASET, f'sub_table_{sub_table}', ['cache_key', 'prompt'],
+                        [{'cache_key': f'key_{sub_table}', 'prompt': 'Title: '}])
+    bq.create_table(_DATASET, 'results_0', ['cache_key', 'prompt', 'prediction'],
+                    [{'cache_key': 'key_0', 'prompt': 'Title: ', 'prediction': 'Short'}])
+    module._BACKEND = LocalCloudBackend(bq, local_prediction_handler(bq))
+    return module, bq
+
+
+def test_duplicate_steps_launch_the_next_job_once(cloud_function):
+    module, bq = cloud_function
+    work = {'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}
+
+    module.handle_work(work, 'message-1')
+    module.handle_work(work, 'message-2')
+
+    assert bq.pending_jobs.qsize() == 1
+    assert bq.get_table_row_count(_DATASET, 'prediction_cache') == 1
+
+
+def test_claims_of_another_step_are_left_alone(cloud_function):
+    module, bq = cloud_function
+    bq.claim_table(_DATASET, 'claim_results_0', 'message-1')
+
+    module.handle_work({'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}, 'message-2')
+
+    assert bq.table_exists(_DATASET, 'results_0')
+    assert bq.pending_jobs.empty()
+
+
+def test_redelivered_step_keeps_its_claims(cloud_function):
+    module, bq = cloud_function
+    bq.claim_table(_DATASET, 'claim_results_0', 'message-1')
+
+    module.handle_work({'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}, 'message-1')
+
+    assert not bq.table_exists(_DATASET, 'results_0')
+    assert bq.pending_jobs.qsize() == 1
+
+
+def test_failed_export_keeps_the_results_table_for_the_retry(cloud_function):
+    module, bq = cloud_function
+    work = {'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}
+    exported = []
+
+    def export(part, cache_keys_table_id):
+        if not exported:
+            exported.append(None)
+            raise RuntimeError('Export failed')
+        exported.append(part)
+    bq.procedures[(_DATASET, 'export_shrinkify')] = export
+
+    with pytest.raises(RuntimeError):
+        module.handle_work(work, 'message-1')
+    assert bq.table_exists(_DATASET, 'results_0')
+    assert bq.pending_jobs.empty()
+
+    module.handle_work(work, 'message-1')
+    assert exported[-1] == 'results_0'
+    assert not bq.table_exists(_DATASET, 'results_0')
+    assert bq.pending_jobs.qsize() == 1
+
+
+def test_retried_step_does_not_launch_the_next_job_again(cloud_function):
+    module, bq = cloud_function
+    # The first attempt claimed results_0 and launched sub_table_1, then stopped
+    bq.claim_table(_DATASET, 'claim_results_0', 'message-1')
+    local_prediction_handler(bq)(f'bq://local-project.{_DATASET}.sub_table_1',
+                                 f'bq://local-project.{_DATASET}.results_1').init_batch_prediction()
+
+    module.handle_work({'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}, 'message-1')
+
+    assert not bq.table_exists(_DATASET, 'results_0')
+    assert bq.pending_jobs.qsize() == 1
+
+
+def test_handover_waits_for_the_job_quota(cloud_function):
+    module, bq = cloud_function
+    # A job of another run takes the only slot of the project
+    local_prediction_handler(bq)('bq://local-project.other_run.sub_table_0',
+                                 'bq://local-project.other_run.results_0').init_batch_prediction()
+    module._SCHEDULER = LaunchScheduler(max_jobs=1, max_wait_seconds=0)
+
+    module.handle_work({'action': 'merge', 'dataset_id': _DATASET, 'results_table_id': 'results_0'}, 'message-1')
+
+    assert bq.pending_jobs.qsize() == 1
+    assert [event['status'] for event in bq.read_rows(_DATASET, 'run_state')] == ['merged', 'failed']
@@ -0,0 +1,60 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+from utils.config import Variant
+from utils.local import LocalBigQueryInteractor
+
+_SOURCE = 'source'
+_OUTPUT = 'shrinkify_output'
+_COLUMNS = ['title', 'description']
+_DESCRIPTION = 'Soft and warm. ' * 20
+
+
+def create_feed(bq, previous_table_id=None, max_value_chars=200):
+    variant = Variant(30)
+    variant.fingerprint = 'prompt'
+    asyncio.run(bq.create_feed_table([variant], _SOURCE, 'feed', _OUTPUT, 'feed', _COLUMNS, 'id',
+                                     previous_table_id, max_value_chars))
+    return bq.read_rows(_OUTPUT, 'feed')
+
+
+def create_source(bq, descriptions):
+    bq.create_table(_SOURCE, 'feed', ['id'] + _COLUMNS, [
+        {'id': str(i), 'title': f'Wool Sweater {i}', 'description': description}
+        for i, description in enumerate(descriptions)])
+
+
+def finished_run(bq):
+    """Source and previous output table of a run over 5 rows with long descriptions"""
+    create_source(bq, [_DESCRIPTION] * 5)
+    bq.create_table(_OUTPUT, 'previous', ['id', 'content_hash'], [
+        {'id': row['id'], 'content_hash': row['content_hash']} for row in create_feed(bq)])
+
+
+def test_changes_past_the_value_cut_are_processed():
+    bq = LocalBigQueryInteractor(export_dir=None)
+    finished_run(bq)
+    create_source(bq, [_DESCRIPTION + 'Now in blue.'] + [_DESCRIPTION] * 4)
+
+    assert [row['id'] for row in create_feed(bq, 'previous')] == ['0']
+
+
+def test_changing_the_value_cut_does_not_change_rows():
+    bq = LocalBigQueryInteractor(export_dir=None)
+    finished_run(bq)
+
+    assert create_feed(bq, 'previous', max_value_chars=100) == []
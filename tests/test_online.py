@@ -0,0 +1,164 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import online
+from utils.online import _MODEL_PARAMETERS, FakeTextModel, MicroBatcher
+from utils.vertex import _MODEL_PARAMETERS as _BATCH_MODEL_PARAMETERS
+
+_CONFIG = {
+    'industry': 'retail',
+    'product_type': 'shoes',
+    'char_limit': 20,
+    'columns': ['title', 'brand'],
+    'examples': [{'title': 'Acme Ultra Comfort Running Shoes', 'brand': 'Acme', 'Short Title': 'Acme Running Shoes'}],
+}
+
+
+class RecordingModel():
+    """Echoes the prompts, keeping the batch sizes and the most calls in flight at once"""
+    def __init__(self, latency_seconds=0.05, error=None):
+        self.latency_seconds = latency_seconds
+        self.error = error
+        self.batch_sizes = []
+        self.max_running = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def predict_batch(self, prompts):
+        with self._lock:
+            self.batch_sizes.append(len(prompts))
+            self._running += 1
+            self.max_running = max(self.max_running, self._running)
+        time.sleep(self.latency_seconds)
+        with self._lock:
+            self._running -= 1
+        if self.error:
+            raise self.error
+        return [prompt.upper() for prompt in prompts]
+
+
+def test_micro_batcher_groups_concurrent_prompts():
+    model = RecordingModel()
+    batcher = MicroBatcher(model, max_batch_size=8, max_wait_seconds=0.2, max_concurrent_calls=2)
+    prompts = [f'prompt {i}' for i in range(32)]
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        short_titles = list(executor.map(lambda prompt: batcher.predict([prompt], timeout=5)[0], prompts))
+
+    assert short_titles == [prompt.upper() for prompt in prompts]
+    assert max(model.batch_sizes) <= 8
+    assert len(model.batch_sizes) < len(prompts)
+    assert batcher.stats.to_dict()['requests'] == 32
+
+
+def test_micro_batcher_sends_partial_batch_after_max_wait():
+    batcher = MicroBatcher(RecordingModel(latency_seconds=0), max_batch_size=16, max_wait_seconds=0.05)
+    started = time.monotonic()
+    assert batcher.predict(['single'], timeout=5) == ['SINGLE']
+    assert time.monotonic() - started < 1
+
+
+def test_micro_batcher_limits_concurrent_calls():
+    model = RecordingModel(latency_seconds=0.1)
+    batcher = MicroBatcher(model, max_batch_size=1, max_wait_seconds=0, max_concurrent_calls=2)
+    batcher.predict([f'prompt {i}' for i in range(8)], timeout=5)
+    assert model.max_running <= 2
+
+
+def test_micro_batcher_fails_every_prompt_of_a_failed_batch():
+    batcher = MicroBatcher(RecordingModel(error=RuntimeError('quota')), max_batch_size=4, max_wait_seconds=0.05)
+    futures = [batcher.submit(f'prompt {i}') for i in range(4)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match='quota'):
+            future.result(timeout=5)
+
+
+def test_micro_batcher_fails_prompts_without_a_prediction():
+    model = RecordingModel(latency_seconds=0)
+    model.predict_batch = lambda prompts: [prompt.upper() for prompt in prompts[:2]]
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_seconds=0.05)
+    futures = [batcher.submit(f'prompt {i}') for i in range(4)]
+
+    assert [future.result(timeout=5) for future in futures[:2]] == ['PROMPT 0', 'PROMPT 1']
+    for future in futures[2:]:
+        with pytest.raises(RuntimeError, match='2 predictions for 4 prompts'):
+            future.result(timeout=5)
+
+
+def test_online_and_batch_model_parameters_match():
+    assert {name: str(value) for name, value in _MODEL_PARAMETERS.items()} == _BATCH_MODEL_PARAMETERS
+
+
+@pytest.fixture
+def server_url(tmp_path):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(_CONFIG))
+    config = online.load_config(config_path)
+    online.ShrinkifyHandler.config = config
+    online.ShrinkifyHandler.prompt_base = online.create_prompt_base(config)
+    online.ShrinkifyHandler.batcher = MicroBatcher(FakeTextModel(config.char_limit, latency_seconds=0),
+                                                   max_wait_seconds=0.01)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), online.ShrinkifyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def _request(url, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_shorten_returns_a_short_title_per_row(server_url):
+    rows = [{'title': 'Acme Ultra Comfort Trail Running Shoes', 'brand': 'Acme'},
+            {'title': 'Globex Waterproof Hiking Boots', 'brand': 'Globex'}]
+    status, body = _request(server_url + '/shorten', {'rows': rows})
+    assert status == 200
+    assert len(body['short_titles']) == 2
+    assert all(0 < len(short_title) <= 20 for short_title in body['short_titles'])
+
+
+def test_shorten_rejects_invalid_requests(server_url):
+    status, body = _request(server_url + '/shorten', {'titles': []})
+    assert status == 400
+    assert 'Invalid request' in body['error']
+
+
+def test_metrics_count_requests(server_url):
+    _request(server_url + '/shorten', {'rows': [{'title': 'Acme Shoes', 'brand': 'Acme'}]})
+    status, body = _request(server_url + '/metrics')
+    assert status == 200
+    assert body['requests'] == 1
+
+
+def test_unknown_paths_are_not_found(server_url):
+    assert _request(server_url + '/predict', {'rows': []})[0] == 404
+    assert _request(server_url + '/health')[0] == 404
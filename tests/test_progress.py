@@ -0,0 +1,57 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from utils.progress import FAILED, MERGED, PREDICTING, QUEUED, RunProgress
+
+
+def event(sub_table, status, minute, **fields):
+    return {'sub_table': sub_table, 'status': status, 'row_count': 100 if status == QUEUED else None,
+            'started_at': f'2024-01-01T00:{minute:02d}:00+00:00', 'finished_at': None, 'error': None, **fields}
+
+
+def failed_and_resumed(*later_events):
+    """Sub table 0 merged after 10 minutes, sub table 1 failed to launch and was resumed"""
+    return RunProgress([
+        event(0, QUEUED, 0), event(1, QUEUED, 0),
+        event(0, PREDICTING, 1),
+        event(1, FAILED, 1, error='ResourceExhausted: 429'),
+        event(0, MERGED, 11, finished_at='2024-01-01T00:12:00+00:00'),
+        event(1, PREDICTING, 20),
+        *later_events,
+    ], concurrent_jobs=1)
+
+
+def test_resumed_sub_table_is_predicting_again():
+    progress = failed_and_resumed()
+
+    assert progress.status(1) == PREDICTING
+    assert progress.count(FAILED) == 0
+    assert progress.errors == {}
+    # One wave of the 10 minute job and 1 minute merge left
+    assert progress.eta_seconds == 660
+
+
+def test_failed_again_after_resume():
+    progress = failed_and_resumed(event(1, FAILED, 21, error='ResourceExhausted: 429 again'))
+
+    assert progress.status(1) == FAILED
+    assert progress.errors == {1: 'ResourceExhausted: 429 again'}
+
+
+def test_merged_is_final():
+    progress = failed_and_resumed(event(1, MERGED, 30), event(1, FAILED, 31, error='Late launch error'))
+
+    assert progress.status(1) == MERGED
+    assert progress.fraction_done == 1.0
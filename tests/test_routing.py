@@ -0,0 +1,70 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import pytest
+
+from utils.config import Config, Variant
+from utils.local import LocalBigQueryInteractor
+from utils.routing import MODEL, RULES, route_title
+
+
+def test_qualifiers_after_for_are_kept():
+    assert route_title('Shampoo for Dry Hair 500 ml', 26) == (RULES, 'Shampoo for Dry Hair 500ml')
+    assert route_title('Shampoo for Dry Hair 500 ml', 20) == (MODEL, None)
+
+
+def test_repeated_numbers_are_kept():
+    assert route_title('2 x 2 Lego Brick', 14) == (MODEL, None)
+
+
+def test_repeated_brand_is_dropped():
+    assert route_title('Acme Running Shoes by Acme', 20) == (RULES, 'Acme Running Shoes')
+    assert route_title('3M Tape 3M', 8) == (RULES, '3M Tape')
+
+
+def test_rules_keep_at_least_half_the_title():
+    assert route_title('Blue Shirt - Long Sleeve Cotton Regular Fit', 12) == (MODEL, None)
+    assert route_title('Blue Cotton Shirt - Long Sleeve', 20) == (RULES, 'Blue Cotton Shirt')
+
+
+def create_config(**overrides):
+    config_dict = {'industry': 'Retail', 'product_type': 'Shoes', 'char_limit': 30, 'source_dataset': 'source',
+                   'source_table': 'feed', 'columns': ['brand', 'title'], **overrides}
+    return Config.from_dict(config_dict)
+
+
+def test_routing_is_off_without_a_title_column():
+    assert not create_config().routing
+    assert create_config(title_column='title').routing
+    with pytest.raises(ValueError):
+        create_config(routing=True)
+    with pytest.raises(ValueError):
+        create_config(title_column='description')
+
+
+def test_feed_routes_the_title_column():
+    bq = LocalBigQueryInteractor(export_dir=None)
+    bq.create_table('source', 'feed', ['brand', 'title'], [
+        {'brand': 'Acme', 'title': 'Acme Men\'s Ultra Comfort Running Shoes with Breathable Mesh Upper'}])
+    variant = Variant(30)
+    variant.fingerprint = 'prompt'
+    variant.routing = True
+    variant.title_column = 'title'
+    asyncio.run(bq.create_feed_table([variant], 'source', 'feed', 'output', 'feed', ['brand', 'title']))
+
+    # The brand fits the char limit, but isn't the title
+    assert bq.read_rows('output', 'feed')[0]['route'] == MODEL
@@ -0,0 +1,182 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+exceptions = pytest.importorskip('google.api_core.exceptions')
+
+from utils.scheduler import _MAX_LISTING_SECONDS, LaunchScheduler, TokenBucket
+
+
+class FakeClock():
+    """Time that only moves when the scheduler sleeps, the delays are kept in sleeps"""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        # Lets the other launches run, like a real sleep
+        await asyncio.sleep(0)
+
+
+class FakeJobs():
+    """Batch prediction handler of a project with the given unfinished jobs. A submitted
+    job is listed after listing_delay listings, a finishing one is gone after its delay."""
+    def __init__(self, running=(), listing_delay=0):
+        self.running = list(running)
+        self.listing_delay = listing_delay
+        self.submitted = []
+        # Raised by the next submissions
+        self.errors = []
+        self._listing = {}
+        self._finishing = {}
+
+    def finish(self, job_name, after):
+        self._finishing[job_name] = after
+
+    def init_batch_prediction(self):
+        if self.errors:
+            raise self.errors.pop(0)
+        job_name = f'job_{len(self.submitted)}'
+        self.submitted.append(job_name)
+        self._listing[job_name] = self.listing_delay
+        return job_name
+
+    def running_jobs(self):
+        for pending, listed in ((self._listing, True), (self._finishing, False)):
+            for job_name in list(pending):
+                if pending[job_name]:
+                    pending[job_name] -= 1
+                    continue
+                del pending[job_name]
+                if listed:
+                    self.running.append(job_name)
+                else:
+                    self.running.remove(job_name)
+        return list(self.running)
+
+
+def create_scheduler(clock, max_jobs=None, tokens_per_minute=None, max_wait_seconds=600):
+    return LaunchScheduler(max_jobs, tokens_per_minute, max_wait_seconds, clock=clock, sleep=clock.sleep)
+
+
+def test_token_bucket_refills_with_the_clock():
+    clock = FakeClock()
+    bucket = TokenBucket(600, clock)
+
+    assert bucket.wait_seconds(600) == 0
+    bucket.take(600)
+    assert bucket.wait_seconds(60) == pytest.approx(6)
+    clock.now += 6
+    assert bucket.wait_seconds(60) == 0
+    # Larger than the bucket, waits for a full one
+    assert bucket.wait_seconds(6000) == pytest.approx(54)
+
+
+def test_launches_wait_for_the_token_budget():
+    clock = FakeClock()
+    jobs = FakeJobs()
+    scheduler = create_scheduler(clock, tokens_per_minute=600)
+
+    async def launch_all():
+        return [await scheduler.launch(jobs, 600), await scheduler.launch(jobs, 300)]
+
+    assert asyncio.run(launch_all()) == ['job_0', 'job_1']
+    assert clock.sleeps == [pytest.approx(30)]
+
+
+def test_launches_wait_for_a_job_slot():
+    clock = FakeClock()
+    jobs = FakeJobs(running=['other_run'])
+    jobs.finish('other_run', after=2)
+    scheduler = create_scheduler(clock, max_jobs=1)
+
+    assert asyncio.run(scheduler.launch(jobs)) == 'job_0'
+    # Two jittered polls of the job listing, the second one twice as long
+    assert len(clock.sleeps) == 2
+    assert 7.5 <= clock.sleeps[0] <= 15
+    assert 15 <= clock.sleeps[1] <= 30
+    assert scheduler.to_dict()['max_wait_seconds'] == pytest.approx(sum(clock.sleeps), abs=1e-3)
+
+
+def test_concurrent_launches_hold_the_slot_until_the_job_is_listed():
+    clock = FakeClock()
+    jobs = FakeJobs(listing_delay=3)
+    scheduler = create_scheduler(clock, max_jobs=1, max_wait_seconds=100)
+
+    async def launch_all():
+        return await asyncio.gather(scheduler.launch(jobs), scheduler.launch(jobs), return_exceptions=True)
+
+    launched, waited = asyncio.run(launch_all())
+
+    assert launched == 'job_0'
+    assert isinstance(waited, TimeoutError)
+    assert jobs.submitted == ['job_0']
+
+
+def test_slot_wait_does_not_take_tokens():
+    clock = FakeClock()
+    scheduler = create_scheduler(clock, max_jobs=1, tokens_per_minute=600, max_wait_seconds=0)
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(scheduler.launch(FakeJobs(running=['other_run']), 600))
+
+    assert scheduler.bucket.tokens == 600
+    assert scheduler.to_dict()['failed'] == 1
+
+
+def test_job_that_is_never_listed_gives_its_slot_back():
+    clock = FakeClock()
+    jobs = FakeJobs(listing_delay=1000)
+    scheduler = create_scheduler(clock, max_jobs=1, max_wait_seconds=0)
+
+    async def launch_all():
+        return [await scheduler.launch(jobs), await scheduler.launch(jobs)]
+
+    assert asyncio.run(launch_all()) == ['job_0', 'job_1']
+    assert clock.now >= 2 * _MAX_LISTING_SECONDS
+
+
+def test_quota_errors_are_retried_with_backoff():
+    clock = FakeClock()
+    jobs = FakeJobs()
+    jobs.errors = [exceptions.ResourceExhausted('quota'), exceptions.ServiceUnavailable('unavailable')]
+    scheduler = create_scheduler(clock)
+
+    assert asyncio.run(scheduler.launch(jobs)) == 'job_0'
+    assert len(clock.sleeps) == 2
+    assert 0 <= clock.sleeps[0] <= 10
+    assert 0 <= clock.sleeps[1] <= 20
+
+
+def test_other_errors_fail_the_launch_and_free_the_slot():
+    clock = FakeClock()
+    jobs = FakeJobs()
+    jobs.errors = [exceptions.PermissionDenied('denied')]
+    scheduler = create_scheduler(clock, max_jobs=1, max_wait_seconds=0)
+
+    with pytest.raises(exceptions.PermissionDenied):
+        asyncio.run(scheduler.launch(jobs))
+    assert not clock.sleeps
+
+    assert asyncio.run(scheduler.launch(jobs)) == 'job_0'
+    assert scheduler.to_dict()['failed'] == 1
+    assert scheduler.to_dict()['launched'] == 1
@@ -12,12 +12,80 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import datetime
+import json
 from google.cloud import bigquery
-from google.cloud.exceptions import Conflict
+from google.cloud.exceptions import Conflict, NotFound
+from utils.clients import get_bigquery_client, wait_for_job
+from utils.progress import FINALIZED, QUEUED
+from utils.prompt import tokens_for_chars_sql
+from utils.routing import MODEL, ROUTES, route_sql, routed_title_sql, title_stages_sql
+
+# Rows and bytes TABLESAMPLE aims to read when sampling example rows
+_SAMPLE_ROWS = 1000
+_SAMPLE_BYTES = 64 * 1024 * 1024
+# Holds all shards while the sub tables are written. Named outside the sub table
+# prefix, so a run that dies before dropping it never looks like it has sub tables left.
+_STAGING_TABLE = 'staging_sub_tables'
+
+# EXPORT DATA options of the supported export formats
+_EXPORT_FORMAT_OPTIONS = {
+    'parquet': {'format': 'PARQUET', 'compression': 'SNAPPY', 'extension': 'parquet', 'options': ''},
+    'csv': {'format': 'CSV', 'compression': 'GZIP', 'extension': 'csv.gz', 'options': ',\n                    header = true'},
+    'jsonl': {'format': 'JSON', 'compression': 'GZIP', 'extension': 'jsonl.gz', 'options': ''},
+}
+
+
+def _fit_to_length_sql(text, char_limit):
+    """SQL expression keeping the leading words of text that fit char_limit,
+    cutting the first word if even it doesn't fit"""
+    return f"""IFNULL((
+                    SELECT STRING_AGG(word, ' ' ORDER BY position)
+                    FROM (
+                        SELECT word, position,
+                            SUM(LENGTH(word) + 1) OVER (ORDER BY position) - 1 AS title_length
+                        FROM UNNEST(SPLIT({text}, ' ')) AS word WITH OFFSET AS position
+                    )
+                    WHERE title_length <= {char_limit}
+                ), LEFT({text}, {char_limit}))"""
+
+
+def _results_sql(feed_table_ref, cache_table_ref, columns_to_select, variants, feed_filter=None):
+    """Every feed row, or those matching feed_filter, with the length checked short
+    title of each variant, see create_finalize_procedure"""
+    fields = []
+    joins = []
+    for i, variant in enumerate(variants):
+        routed_title = f"feed.{variant.column('routed_title')}"
+        model_title = f"NULLIF(cache_{i}.short_title, '')"
+        title = f"CAST(feed.{variant.title_column} AS STRING)" if variant.title_column else "''"
+        fallback_title = f"IFNULL({model_title}, IFNULL({title}, ''))"
+        char_limit = variant.char_limit
+        fields.append(f"""
+                IFNULL({routed_title}, IF(LENGTH({model_title}) <= {char_limit}, {model_title},
+                   {_fit_to_length_sql(fallback_title, char_limit)})) AS {variant.column('short_title')},
+                CASE
+                    WHEN {routed_title} IS NOT NULL THEN 'passed'
+                    WHEN {model_title} IS NULL THEN 'missing'
+                    WHEN LENGTH({model_title}) <= {char_limit} THEN 'passed'
+                    ELSE 'shortened'
+                END AS {variant.column('length_check')},""")
+        joins.append(f"""
+            LEFT JOIN `{cache_table_ref}` AS cache_{i}
+            ON cache_{i}.cache_key = feed.{variant.column('cache_key')}""")
+    routed_titles = ', '.join(variant.column('routed_title') for variant in variants)
+    feed = f"(SELECT * FROM `{feed_table_ref}` WHERE {feed_filter})" if feed_filter else f"`{feed_table_ref}`"
+    return f"""
+            SELECT
+                feed.* EXCEPT({routed_titles}),{''.join(fields)}
+                CURRENT_DATE() AS processed_date
+            FROM {feed} AS feed{''.join(joins)}"""
+
 
 class BigQueryInteractor:
-    def __init__(self):
-        self.client = bigquery.Client()
+    def __init__(self, client=None):
+        self.client = client or get_bigquery_client()
 
     def get_datasets(self):
         datasets = list(self.client.list_datasets())
@@ -33,14 +101,77 @@ class BigQueryInteractor:
         table = self.client.get_table(table_ref)
         return [field.name for field in table.schema]
 
+    def sample_rows(self, dataset_id, table_id, columns, num_rows, stratify_column=None):
+        """Returns num_rows random rows of the columns, reading only a sample of
+        the table's storage blocks instead of sorting the whole table.
+
+        With stratify_column, rows with different values of it are picked first,
+        so the rows cover as many of its values as possible.
+        """
+        table = self.client.get_table(self.client.dataset(dataset_id).table(table_id))
+        table_ref = f'`{table.project}.{table.dataset_id}.{table.table_id}`'
+        percent = 100
+        if table.table_type == 'TABLE' and table.num_rows:
+            # Blocks are sampled, so aim for enough rows and bytes to hold num_rows in most draws
+            percent = min(100, max(100 * max(_SAMPLE_ROWS, num_rows) / table.num_rows,
+                                   100 * _SAMPLE_BYTES / max(table.num_bytes or 1, 1)))
+
+        selected_columns = ', '.join(columns)
+        while True:
+            # Views and external tables can't be sampled by block
+            source = table_ref if percent >= 100 else f'{table_ref} TABLESAMPLE SYSTEM ({percent:.6f} PERCENT)'
+            if stratify_column:
+                query = f"""
+                SELECT {selected_columns} FROM (
+                    SELECT {selected_columns},
+                        ROW_NUMBER() OVER (PARTITION BY {stratify_column} ORDER BY RAND()) AS stratum_rank
+                    FROM {source}
+                )
+                ORDER BY stratum_rank, RAND()
+                LIMIT {num_rows}
+                """
+            else:
+                query = f"SELECT {selected_columns} FROM {source} ORDER BY RAND() LIMIT {num_rows}"
+            rows = list(self.run_query(query))
+            if len(rows) >= num_rows or percent >= 100:
+                return rows
+            # The sampled blocks happened to hold too few rows, sample more of them
+            percent = min(100, percent * 10)
+
+    def get_table_names(self, dataset_id):
+        """Sorted names of every table in the dataset, in a single query instead of paging through list_tables"""
+        rows = self.run_query(f"""
+        SELECT table_name
+        FROM `{self.client.project}.{dataset_id}.INFORMATION_SCHEMA.TABLES`
+        ORDER BY table_name
+        """)
+        return [row.table_name for row in rows]
+
     def run_query(self, sql_query):
         query_job = self.client.query(sql_query)
         return query_job.result()
 
+    async def run_query_async(self, sql_query):
+        """Submits the query and polls it, so other jobs can run meanwhile"""
+        query_job = await asyncio.to_thread(self.client.query, sql_query)
+        return await wait_for_job(query_job)
+
     def get_table_row_count(self, dataset_id, table_id):
+        """Rows of the table. Views and external tables have no row count in their
+        metadata, so their rows are counted with a query."""
         table_ref = self.client.dataset(dataset_id).table(table_id)
         table = self.client.get_table(table_ref)
-        return table.num_rows
+        if table.num_rows is not None:
+            return table.num_rows
+        return list(self.run_query(f'SELECT COUNT(*) FROM `{table_ref}`'))[0][0]
+
+    def table_exists(self, dataset_id, table_id):
+        table_ref = self.client.dataset(dataset_id).table(table_id)
+        try:
+            self.client.get_table(table_ref)
+            return True
+        except NotFound:
+            return False
 
     def get_project_id(self):
         return self.client.project
@@ -55,58 +186,578 @@ class BigQueryInteractor:
         except Conflict as e:
             return dataset_id
     
-    def extract_and_save_to_new_table(
+    def get_dataset_labels(self, dataset_id):
+        return self.client.get_dataset(dataset_id).labels
+
+    def get_table_modified(self, dataset_id, table_id):
+        table_ref = self.client.dataset(dataset_id).table(table_id)
+        return self.client.get_table(table_ref).modified
+
+    def procedure_exists(self, dataset_id, procedure_id):
+        try:
+            self.client.get_routine(f'{self.client.project}.{dataset_id}.{procedure_id}')
+            return True
+        except NotFound:
+            return False
+
+    def drop_table(self, dataset_id, table_id):
+        table_ref = self.client.dataset(dataset_id).table(table_id)
+        self.client.delete_table(table_ref, not_found_ok=True)
+
+    def claim_table(self, dataset_id, table_id, claimant, stale_seconds=None):
+        """Creates the empty table, described by claimant, like the Cloud Function's claims.
+        Returns whether it was created or already held by claimant. With stale_seconds,
+        a claim of another claimant that is older is taken over."""
+        table_ref = self.client.dataset(dataset_id).table(table_id)
+        table = bigquery.Table(table_ref)
+        table.description = claimant
+        try:
+            self.client.create_table(table)
+            return True
+        except Conflict:
+            existing = self.client.get_table(table_ref)
+        if existing.description == claimant:
+            return True
+        age = datetime.datetime.now(datetime.timezone.utc) - existing.created
+        if stale_seconds is None or age.total_seconds() < stale_seconds:
+            return False
+        self.client.delete_table(table_ref, not_found_ok=True)
+        return self.claim_table(dataset_id, table_id, claimant)
+
+    def set_dataset_labels(self, dataset_id, labels):
+        dataset = self.client.get_dataset(dataset_id)
+        dataset.labels = {**dataset.labels, **labels}
+        return self.client.update_dataset(dataset, ['labels'])
+
+    async def create_feed_table(
         self,
-        prompt_base,
+        variants,
         source_dataset_id,
         source_table_id,
         output_dataset_id,
-        output_table_id,
+        feed_table_id,
         columns_to_select,
-        start_index,
-        end_index
+        key_column=None,
+        previous_table_id=None,
+        max_value_chars=200,
+        max_context_chars=None
     ):
-        
+        """Copies the selected columns of the source table together with the
+        prompt context and the prediction cache key of every row, one per variant.
+
+        When previous_table_id is given, only rows whose key_column is new or
+        whose selected column values changed since the previous run's output
+        are copied. The content hash only covers the column values, so new
+        examples or prompt settings don't make every row look changed.
+        """
+
+        # Create a reference to the destination table
+        feed_table_ref = self.client.dataset(
+            output_dataset_id).table(feed_table_id)
+
+        feed_query = self._feed_query(variants, source_dataset_id, source_table_id,
+                                      output_dataset_id, columns_to_select, key_column,
+                                      previous_table_id, max_value_chars, max_context_chars)
+        # Output tables of earlier versions have no content hash, all their rows count as changed once
+        add_content_hash = ''
+        if previous_table_id:
+            previous_table_ref = self.client.dataset(
+                output_dataset_id).table(previous_table_id)
+            add_content_hash = f"""
+        ALTER TABLE `{previous_table_ref}` ADD COLUMN IF NOT EXISTS content_hash STRING;"""
+        query = f"""{add_content_hash}
+        CREATE OR REPLACE TABLE `{feed_table_ref}` AS{feed_query};
+        """
+        await self.run_query_async(query)
+
+    async def dry_run_feed_table(
+        self,
+        variants,
+        source_dataset_id,
+        source_table_id,
+        output_dataset_id,
+        columns_to_select,
+        key_column=None,
+        previous_table_id=None,
+        max_value_chars=200,
+        max_context_chars=None
+    ):
+        """Bytes the feed table query of create_feed_table would scan, without running it"""
+        if previous_table_id and 'content_hash' not in self.get_column_names(output_dataset_id, previous_table_id):
+            # create_feed_table processes every row of such a previous run, see there
+            previous_table_id = None
+        feed_query = self._feed_query(variants, source_dataset_id, source_table_id,
+                                      output_dataset_id, columns_to_select, key_column,
+                                      previous_table_id, max_value_chars, max_context_chars)
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        query_job = await asyncio.to_thread(self.client.query, feed_query, job_config=job_config)
+        return query_job.total_bytes_processed
+
+    def _feed_query(self, variants, source_dataset_id, source_table_id, output_dataset_id,
+                    columns_to_select, key_column, previous_table_id, max_value_chars,
+                    max_context_chars=None):
         # Create a reference to the source table
         source_table_ref = self.client.dataset(
             source_dataset_id).table(source_table_id)
 
-        # Create a reference to the destination table
-        output_table_ref = self.client.dataset(
-            output_dataset_id).table(output_table_id)
+        # Basic query to select columns, the key is kept even if it's not part of the prompt
+        key_columns = [key_column] if key_column and key_column not in columns_to_select else []
+        selected_columns = ', '.join(key_columns + columns_to_select)
+
+        # Creating the compact dictionary-like string with "Context: " prefix,
+        # empty values are dropped and long values truncated
+        column_values = ", ".join(
+            [f"IF(IFNULL(CAST({col} AS STRING), '') = '', NULL, CONCAT('{col}: ', LEFT(CAST({col} AS STRING), {max_value_chars})))"
+             for col in columns_to_select])
+        dict_representation = f"CONCAT('Context: {{', ARRAY_TO_STRING([{column_values}], ', '), '}}')"
+        if max_context_chars is not None:
+            # The values are cut at max_context_chars, so the columns selected last go first,
+            # see prompt.serialize_context
+            dict_representation = f"""CONCAT('Context: {{', IFNULL((
+                    SELECT STRING_AGG(LEFT(value, {max_context_chars} - preceding_chars), ', ' ORDER BY position)
+                    FROM (
+                        SELECT value, position, IFNULL(SUM(LENGTH(value) + 2) OVER (
+                            ORDER BY position ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS preceding_chars
+                        FROM UNNEST([{column_values}]) AS value WITH OFFSET AS position
+                        WHERE value IS NOT NULL
+                    )
+                    WHERE preceding_chars < {max_context_chars}
+                ), ''), '}}')"""
+
+        # Rows sharing the same prompt and context share the same cache key
+        cache_keys = ", ".join(
+            f"TO_HEX(SHA256(CONCAT('{variant.fingerprint}', column_values_dict))) AS {variant.column('cache_key')}"
+            for variant in variants)
+
+        # Titles that fit, or fit after the rules of utils/routing.py, skip the model
+        routes = ", ".join(
+            f"{route_sql('title_stages', variant.char_limit)} AS {variant.column('route')}, "
+            f"{routed_title_sql('title_stages', variant.char_limit)} AS {variant.column('routed_title')}"
+            if variant.routing else
+            f"'{MODEL}' AS {variant.column('route')}, CAST(NULL AS STRING) AS {variant.column('routed_title')}"
+            for variant in variants)
 
-        # Basic query to select columns
-        selected_columns = ', '.join(columns_to_select)
+        # Only the selected column values decide whether a row changed, as they are in the
+        # source, not as cut for the prompt, so edits past the cut count and new cuts don't
+        content_hash = f'TO_HEX(SHA256(TO_JSON_STRING(STRUCT({selected_columns})))) AS content_hash'
 
-        # Creating the dictionary-like string with "Context: " prefix
-        dict_representation = "CONCAT('Context: {', " + ", ', ', ".join(
-            [f"'{col}: ', CAST({col} AS STRING)" for col in columns_to_select]) + ", '}')"
+        changed_rows_filter = ''
+        if previous_table_id:
+            previous_table_ref = self.client.dataset(
+                output_dataset_id).table(previous_table_id)
+            changed_rows_filter = f"""
+        WHERE NOT EXISTS (
+            SELECT 1 FROM `{previous_table_ref}` AS previous
+            WHERE previous.{key_column} = feed_row.{key_column}
+                AND previous.content_hash = feed_row.content_hash
+        )"""
 
-        # Creating the prompt string
-        prompt_string = f"CONCAT(\"\"\"{prompt_base}\"\"\", {dict_representation}, ' Short title: ')"
+        selected_rows = f"""(
+                SELECT 
+                    {selected_columns},
+                    {dict_representation} AS column_values_dict
+                FROM 
+                    `{source_table_ref}`
+            )"""
+
+        if any(variant.routing for variant in variants):
+            selected_rows = f"({title_stages_sql(variants[0].title_column, selected_rows)})"
+        else:
+            selected_rows = f"(SELECT *, CAST(NULL AS ARRAY<STRING>) AS title_stages FROM {selected_rows})"
+
+        return f"""
+        SELECT * FROM (
+            SELECT * EXCEPT(title_stages), {content_hash}, {cache_keys}, {routes}
+            FROM {selected_rows}
+        ) AS feed_row{changed_rows_filter}"""
+
+    async def create_run_state_table(self, output_dataset_id, run_state_table_id):
+        """Creates an empty run state table for a new run, see utils/progress.py"""
+        run_state_table_ref = self.client.dataset(
+            output_dataset_id).table(run_state_table_id)
 
-        # Complete query with row number
         query = f"""
-        CREATE TABLE `{output_table_ref}` AS
-        WITH NumberedRows AS (
-            SELECT 
-                *,
-                ROW_NUMBER() OVER() as rownum
-            FROM 
-                `{source_table_ref}`
+        CREATE OR REPLACE TABLE `{run_state_table_ref}` (
+            sub_table INT64,
+            status STRING,
+            row_count INT64,
+            token_count INT64,
+            error STRING,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
         )
+        """
+        await self.run_query_async(query)
+
+    def _queued_run_state_sql(self, output_dataset_id, run_state_table_id, staging_table_ref):
+        if not run_state_table_id:
+            return ''
+        run_state_table_ref = self.client.dataset(
+            output_dataset_id).table(run_state_table_id)
+        return f"""
+        INSERT INTO `{run_state_table_ref}` (sub_table, status, row_count, token_count, started_at)
+        SELECT shard_id, '{QUEUED}', COUNT(*), {tokens_for_chars_sql('SUM(LENGTH(prompt))')}, CURRENT_TIMESTAMP()
+        FROM `{staging_table_ref}`
+        GROUP BY shard_id;
+"""
+
+    async def record_run_state(self, dataset_id, run_state_table_id, events):
+        """Appends events, dicts keyed by the run state columns, to the run state table.
+        The events are passed as a single JSON parameter, so errors need no escaping."""
+        run_state_table_ref = self.client.dataset(
+            dataset_id).table(run_state_table_id)
+
+        query = f"""
+        INSERT INTO `{run_state_table_ref}`
+            (sub_table, status, row_count, token_count, error, started_at, finished_at)
+        SELECT
+            CAST(JSON_VALUE(event, '$.sub_table') AS INT64),
+            JSON_VALUE(event, '$.status'),
+            CAST(JSON_VALUE(event, '$.row_count') AS INT64),
+            CAST(JSON_VALUE(event, '$.token_count') AS INT64),
+            JSON_VALUE(event, '$.error'),
+            TIMESTAMP(JSON_VALUE(event, '$.started_at')),
+            TIMESTAMP(JSON_VALUE(event, '$.finished_at'))
+        FROM UNNEST(JSON_QUERY_ARRAY(@events)) AS event
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('events', 'STRING', json.dumps(events, default=str))])
+        query_job = await asyncio.to_thread(self.client.query, query, job_config=job_config)
+        await wait_for_job(query_job)
+
+    def get_run_state(self, dataset_id, run_state_table_id):
+        """Returns every event of the run as dicts, or an empty list before the run created the table"""
+        if not self.table_exists(dataset_id, run_state_table_id):
+            return []
+        run_state_table_ref = self.client.dataset(
+            dataset_id).table(run_state_table_id)
+        return [dict(row.items()) for row in self.run_query(f"SELECT * FROM `{run_state_table_ref}`")]
+
+    async def create_cache_table(self, output_dataset_id, cache_table_id):
+        """Creates the persistent prediction cache, if it doesn't exist yet"""
+        cache_table_ref = self.client.dataset(
+            output_dataset_id).table(cache_table_id)
+
+        query = f"""
+        CREATE TABLE IF NOT EXISTS `{cache_table_ref}` (
+            cache_key STRING,
+            short_title STRING
+        )
+        CLUSTER BY cache_key
+        """
+        await self.run_query_async(query)
+
+    async def get_cache_miss_count(self, output_dataset_id, feed_table_id, cache_table_id, variants):
+        """Returns the number of distinct prompts of all variants that have no cached prediction"""
+        cache_table_ref = self.client.dataset(
+            output_dataset_id).table(cache_table_id)
+
+        query = f"""
+        SELECT COUNT(DISTINCT cache_key) AS misses
+        FROM ({self._cache_keys_sql(output_dataset_id, feed_table_id, variants)}
+        )
+        WHERE cache_key NOT IN (SELECT cache_key FROM `{cache_table_ref}`)
+        """
+        rows = await self.run_query_async(query)
+        return list(rows)[0].misses
+
+    def _cache_keys_sql(self, output_dataset_id, feed_table_id, variants):
+        """The cache key, variant index and context of every variant of every feed row routed to the model"""
+        feed_table_ref = self.client.dataset(
+            output_dataset_id).table(feed_table_id)
+        return '\n            UNION ALL'.join(f"""
+            SELECT {variant.column('cache_key')} AS cache_key, {i} AS variant, column_values_dict
+            FROM `{feed_table_ref}`
+            WHERE {variant.column('route')} = '{MODEL}'""" for i, variant in enumerate(variants))
+
+    async def get_route_counts(self, output_dataset_id, feed_table_id, variants):
+        """Returns the number of feed rows per route, see utils/routing.py, of every variant's short title column"""
+        feed_table_ref = self.client.dataset(
+            output_dataset_id).table(feed_table_id)
+        query = '\n        UNION ALL'.join(f"""
+        SELECT '{variant.column('short_title')}' AS variant, {variant.column('route')} AS route, COUNT(*) AS row_count
+        FROM `{feed_table_ref}`
+        GROUP BY route""" for variant in variants)
+        route_counts = {variant.column('short_title'): dict.fromkeys(ROUTES, 0) for variant in variants}
+        for row in await self.run_query_async(query):
+            route_counts[row.variant][row.route] = row.row_count
+        return route_counts
+
+    async def get_average_length(self, dataset_id, table_id, column):
+        table_ref = self.client.dataset(dataset_id).table(table_id)
+        rows = await self.run_query_async(f"SELECT AVG(LENGTH({column})) AS length FROM `{table_ref}`")
+        return list(rows)[0].length
+
+    async def extract_and_save_to_sub_tables(
+        self,
+        variants,
+        output_dataset_id,
+        feed_table_id,
+        cache_table_id,
+        sub_table_prefix,
+        num_sub_tables,
+        run_state_table_id=None
+    ):
+        """Splits the cache misses of all variants of the feed into num_sub_tables
+        prompt tables in a single scan.
+
+        Every distinct cache key gets a deterministic shard id from the hash of its
+        context and is written once to a staging table partitioned by that id, so
+        all variants of a row are predicted in the same sub table. Each
+        sub table is then read from its own partition only, so the bytes
+        scanned stay flat as the number of sub tables grows.
+
+        When run_state_table_id is given, the row and token count of every sub
+        table is recorded there as queued, from the same staging table.
+        """
+
+        # Create a reference to the cache table
+        cache_table_ref = self.client.dataset(
+            output_dataset_id).table(cache_table_id)
+
+        # Create a reference to the staging table holding all shards
+        staging_table_ref = self.client.dataset(
+            output_dataset_id).table(_STAGING_TABLE)
+
+        # Creating the prompt string of each variant
+        prompt_string = "CASE variant" + ''.join(
+            f"\n                WHEN {i} THEN CONCAT(\"\"\"{variant.prompt_base}\"\"\", column_values_dict, ' Short title: ')"
+            for i, variant in enumerate(variants)) + "\n            END"
+
+        # Stable shard id, a cache key and the other variants of its row always land in the same sub table.
+        # ABS would overflow on the smallest INT64, so the remainder is made positive instead.
+        shard_id = f"MOD(MOD(FARM_FINGERPRINT(column_values_dict), {num_sub_tables}) + {num_sub_tables}, {num_sub_tables})"
+
+        # One scan of the feed, then one partition read per sub table
+        query = f"""
+        CREATE OR REPLACE TABLE `{staging_table_ref}`
+        PARTITION BY RANGE_BUCKET(shard_id, GENERATE_ARRAY(0, {num_sub_tables}, 1))
+        AS
         SELECT 
-            {selected_columns},
-            {dict_representation} AS column_values_dict,
-            {prompt_string} AS prompt
-        FROM 
-            NumberedRows
-        WHERE 
-            rownum BETWEEN {start_index} AND {end_index}
+            cache_key,
+            {prompt_string} AS prompt,
+            {shard_id} AS shard_id
+        FROM (
+            SELECT cache_key, ANY_VALUE(variant) AS variant, ANY_VALUE(column_values_dict) AS column_values_dict
+            FROM ({self._cache_keys_sql(output_dataset_id, feed_table_id, variants)}
+            )
+            WHERE cache_key NOT IN (SELECT cache_key FROM `{cache_table_ref}`)
+            GROUP BY cache_key
+        );
+
+        FOR shard IN (SELECT id FROM UNNEST(GENERATE_ARRAY(0, {num_sub_tables} - 1)) AS id) DO
+            EXECUTE IMMEDIATE FORMAT(\"\"\"
+                CREATE OR REPLACE TABLE `{output_dataset_id}.{sub_table_prefix}%d` AS
+                SELECT * EXCEPT(shard_id) FROM `{staging_table_ref}` WHERE shard_id = %d
+            \"\"\", shard.id, shard.id);
+        END FOR;
+{self._queued_run_state_sql(output_dataset_id, run_state_table_id, staging_table_ref)}
+        DROP TABLE `{staging_table_ref}`;
+        """
+
+        # Run the whole sharding script as a single job
+        await self.run_query_async(query)
+
+    async def create_finalize_procedure(
+        self,
+        output_dataset_id,
+        procedure_id,
+        feed_table_id,
+        cache_table_id,
+        output_table_id,
+        columns_to_select,
+        key_column=None,
+        incremental=False,
+        source_dataset_id=None,
+        source_table_id=None,
+        variants=None,
+        run_state_table_id=None
+    ):
+        """Stores the SQL that joins the cached short titles back to every feed row
+        as a procedure, so the Cloud Function can run it once all sub tables are done.
+
+        Every variant gets its own short title and length check columns. Short titles
+        are length checked in the same pass. Titles over the variant's char limit are
+        shortened by dropping trailing words, and rows without a prediction fall back
+        to the first selected column shortened the same way. The procedure returns
+        the number of rows per length_check outcome of the first variant. When run_state_table_id is
+        given, the procedure records the run as finalized there.
+
+        Full runs recreate the output table, partitioned by the date rows were
+        processed and clustered by key_column (or the cache key). Incremental runs
+        MERGE the changed rows into it by key_column and drop the rows that left
+        the source table.
+        """
+        feed_table_ref = self.client.dataset(
+            output_dataset_id).table(feed_table_id)
+        cache_table_ref = self.client.dataset(
+            output_dataset_id).table(cache_table_id)
+        output_table_ref = self.client.dataset(
+            output_dataset_id).table(output_table_id)
+
+        results = _results_sql(feed_table_ref, cache_table_ref, columns_to_select, variants)
+
+        if not incremental:
+            # Replacing a table with a different partitioning isn't allowed, so drop it first
+            statements = f"""
+            DROP TABLE IF EXISTS `{output_table_ref}`;
+            CREATE TABLE `{output_table_ref}`
+            PARTITION BY processed_date
+            CLUSTER BY {key_column or 'cache_key'}
+            AS{results};"""
+        else:
+            source_table_ref = self.client.dataset(
+                source_dataset_id).table(source_table_id)
+            key_columns = [key_column] if key_column not in columns_to_select else []
+            variant_columns = [variant.column(name) for variant in variants
+                               for name in ['cache_key', 'route', 'short_title', 'length_check']]
+            output_columns = key_columns + columns_to_select + ['column_values_dict', 'content_hash'] + \
+                variant_columns + ['processed_date']
+            # Variants and routes added since the output table was created get their columns
+            add_columns = ', '.join(f'ADD COLUMN IF NOT EXISTS {col} STRING'
+                                    for col in ['content_hash'] + variant_columns)
+            update_columns = ', '.join(f'{col} = results.{col}' for col in output_columns)
+            insert_values = ', '.join(f'results.{col}' for col in output_columns)
+            statements = f"""
+            ALTER TABLE `{output_table_ref}` {add_columns};
+
+            MERGE `{output_table_ref}` AS output
+            USING ({results}
+            ) AS results
+            ON output.{key_column} = results.{key_column}
+            WHEN MATCHED THEN
+                UPDATE SET {update_columns}
+            WHEN NOT MATCHED THEN
+                INSERT ({', '.join(output_columns)}) VALUES ({insert_values});
+
+            DELETE FROM `{output_table_ref}`
+            WHERE {key_column} NOT IN (
+                SELECT {key_column} FROM `{source_table_ref}` WHERE {key_column} IS NOT NULL);"""
+
+        if run_state_table_id:
+            run_state_table_ref = self.client.dataset(
+                output_dataset_id).table(run_state_table_id)
+            statements = f"""
+            DECLARE started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP();
+{statements}
+
+            INSERT INTO `{run_state_table_ref}` (status, started_at, finished_at)
+            VALUES ('{FINALIZED}', started_at, CURRENT_TIMESTAMP());"""
+
+        # Report the outcome of the length check for the rows of this run
+        statements += f"""
+
+            SELECT length_check, COUNT(*) AS row_count
+            FROM `{output_table_ref}`
+            WHERE processed_date = CURRENT_DATE()
+            GROUP BY length_check;"""
+
+        query = f"""
+        CREATE OR REPLACE PROCEDURE `{output_dataset_id}.{procedure_id}`()
+        BEGIN{statements}
+        END
         """
+        await self.run_query_async(query)
+
+    async def merge_results(self, dataset_id, results_table_ids, cache_table_id):
+        """Same MERGE as the Cloud Function's merge_results, for results tables it missed"""
+        source_tables = '\n            UNION ALL\n            '.join(
+            f"SELECT cache_key, predictions FROM `{self.client.dataset(dataset_id).table(table_id)}`"
+            for table_id in results_table_ids)
+        cache_table_ref = self.client.dataset(dataset_id).table(cache_table_id)
+
+        query = f"""
+        MERGE `{cache_table_ref}` AS cache
+        USING (
+            SELECT cache_key, ANY_VALUE(TRIM(STRING(predictions[0].content))) AS short_title
+            FROM (
+            {source_tables}
+            )
+            WHERE STRING(predictions[0].content) IS NOT NULL
+            GROUP BY cache_key
+        ) AS results
+        ON cache.cache_key = results.cache_key
+        WHEN NOT MATCHED THEN
+            INSERT (cache_key, short_title) VALUES (results.cache_key, results.short_title)
+        """
+        await self.run_query_async(query)
+
+    async def create_export_procedure(
+        self,
+        output_dataset_id,
+        procedure_id,
+        feed_table_id,
+        cache_table_id,
+        columns_to_select,
+        variants,
+        export_uri=None,
+        export_format='parquet',
+        export_columns=None
+    ):
+        """Stores the SQL that exports the finished part of the run to Cloud Storage
+        as a procedure, or drops it when export_uri isn't set.
+
+        CALL procedure_id('<part>', '<table>') exports the feed rows whose cache key
+        of any variant is in the table, with the same short titles as the final table, to
+        export_uri/<part>-*. The Cloud Function calls it for every results table it
+        merges, so the export streams shard by shard as predictions complete and
+        never goes through the memory of the caller. All variants of a row are
+        predicted in the same sub table, and the part exported from the cache table
+        only holds rows with every variant routed to the model cached, including the
+        rows the model isn't needed for, so each row is exported once. The feed is
+        semi-joined to the cache keys of the part first, so only the rows of the part
+        are joined to the cache.
+        """
+        procedure_ref = f'{output_dataset_id}.{procedure_id}'
+        if not export_uri:
+            await self.run_query_async(f"DROP PROCEDURE IF EXISTS `{procedure_ref}`")
+            return
+
+        feed_table_ref = self.client.dataset(
+            output_dataset_id).table(feed_table_id)
+        cache_table_ref = self.client.dataset(
+            output_dataset_id).table(cache_table_id)
+        format_options = _EXPORT_FORMAT_OPTIONS[export_format]
+        selected_columns = ', '.join(export_columns) if export_columns else '* EXCEPT(column_values_dict, content_hash)'
+        export = f"""
+                EXPORT DATA OPTIONS (
+                    uri = '{export_uri.rstrip('/')}/%s-*.{format_options['extension']}',
+                    format = '{format_options['format']}',
+                    compression = '{format_options['compression']}',
+                    overwrite = true{format_options['options']}
+                ) AS
+                SELECT {selected_columns}
+                FROM ("""
+        # Only the variants routed to the model have a cache key in any part
+        cached_rows = ' AND '.join(
+            f"({variant.column('route')} != '{MODEL}' OR {variant.column('cache_key')} IN "
+            f"(SELECT cache_key FROM `{cache_table_ref}`))" for variant in variants)
+        part_rows = ' OR '.join(
+            f"({variant.column('route')} = '{MODEL}' AND {variant.column('cache_key')} IN "
+            f"(SELECT cache_key FROM `{output_dataset_id}.%s`))" for variant in variants)
+        cached_results = _results_sql(feed_table_ref, cache_table_ref, columns_to_select, variants, cached_rows)
+        part_results = _results_sql(feed_table_ref, cache_table_ref, columns_to_select, variants, part_rows)
+        part_tables = ', '.join(['cache_keys_table'] * len(variants))
+
+        query = f"""
+        CREATE OR REPLACE PROCEDURE `{procedure_ref}`(part STRING, cache_keys_table STRING)
+        BEGIN
+            IF cache_keys_table = '{cache_table_id}' THEN
+                EXECUTE IMMEDIATE FORMAT(\"\"\"{export}{cached_results}
+                )
+                \"\"\", part);
+            ELSE
+                EXECUTE IMMEDIATE FORMAT(\"\"\"{export}{part_results}
+                )
+                \"\"\", part, {part_tables});
+            END IF;
+        END
+        """
+        await self.run_query_async(query)
+
+    async def call_export_procedure(self, dataset_id, procedure_id, part, cache_keys_table_id):
+        return await self.run_query_async(
+            f"CALL `{dataset_id}.{procedure_id}`('{part}', '{cache_keys_table_id}')")
 
-        # Create a query job to extract data from the source table
-        query_job = self.client.query(query)
-        # Write the query results to the destination table
-        # job_config = bigquery.QueryJobConfig(destination=destination_table_ref)
-        query_job.result()
+    async def call_procedure(self, dataset_id, procedure_id):
+        return await self.run_query_async(f"CALL `{dataset_id}.{procedure_id}`()")
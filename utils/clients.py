@@ -0,0 +1,138 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared, lazily created GCP clients, non-blocking job polling and retries.
+# Clients are created on first use and reused by every caller in the process,
+# i.e. all Streamlit sessions share a single BigQuery client.
+# Also deployed with the Cloud Function, so only the standard library is imported
+# at load time.
+
+import asyncio
+import random
+import threading
+import time
+
+_INITIAL_POLL_SECONDS = 0.5
+_MAX_POLL_SECONDS = 5
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_or_create(key, factory):
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_bigquery_client():
+    def create_client():
+        from google.cloud import bigquery
+        return bigquery.Client()
+    return _get_or_create('bigquery', create_client)
+
+
+def get_prediction_client(location):
+    def create_client():
+        from google.cloud import aiplatform
+        return aiplatform.gapic.PredictionServiceClient(
+            client_options={'api_endpoint': f'{location}-aiplatform.googleapis.com'})
+    return _get_or_create(f'prediction_{location}', create_client)
+
+
+def set_bigquery_client(client):
+    """Replaces the shared BigQuery client, i.e. with a StubBigQueryClient"""
+    with _clients_lock:
+        _clients['bigquery'] = client
+
+
+async def retry_with_backoff(function, attempts, initial_seconds, max_seconds, retry_on=(Exception,),
+                             sleep=asyncio.sleep):
+    """Runs the blocking function in a thread until it succeeds, waiting a
+    jittered, exponentially growing delay between attempts. Errors other than
+    retry_on are raised right away, otherwise the last error is raised."""
+    for attempt in range(attempts):
+        try:
+            return await asyncio.to_thread(function)
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(initial_seconds * 2 ** attempt, max_seconds))
+            print(f'Attempt {attempt + 1} failed, retrying in {delay:.1f}s: {e}')
+            await sleep(delay)
+
+
+async def wait_for_job(job):
+    """Polls a submitted job until it's done without blocking the event loop,
+    backing off between polls. Raises the job's error, if any."""
+    poll_seconds = _INITIAL_POLL_SECONDS
+    while not await asyncio.to_thread(job.done):
+        await asyncio.sleep(poll_seconds)
+        poll_seconds = min(poll_seconds * 2, _MAX_POLL_SECONDS)
+    return await asyncio.to_thread(job.result)
+
+
+class StubQueryJob():
+    """Query job that finishes latency_seconds after it was submitted"""
+    def __init__(self, client, query, rows):
+        self.client = client
+        self.query = query
+        self.rows = rows
+        self.submitted = client.clock()
+
+    def done(self):
+        finished = self.client.clock() - self.submitted >= self.client.latency_seconds
+        if finished:
+            self.client._finish(self)
+        return finished
+
+    def result(self):
+        remaining = self.client.latency_seconds - (self.client.clock() - self.submitted)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.client._finish(self)
+        return self.rows
+
+
+class StubBigQueryClient():
+    """Local stand-in for bigquery.Client to exercise the job concurrency
+    without GCP. Every query takes latency_seconds and returns result_rows,
+    and the highest number of jobs running at once is kept in max_running_jobs.
+    clock is only replaced by tests."""
+    def __init__(self, project='stub-project', latency_seconds=1, result_rows=None, clock=time.monotonic):
+        self.project = project
+        self.latency_seconds = latency_seconds
+        self.clock = clock
+        self.result_rows = result_rows or []
+        self.queries = []
+        self.max_running_jobs = 0
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        from google.cloud import bigquery
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def query(self, query, job_config=None):
+        job = StubQueryJob(self, query, self.result_rows)
+        with self._lock:
+            self.queries.append(query)
+            self._running.add(job)
+            self.max_running_jobs = max(self.max_running_jobs, len(self._running))
+        return job
+
+    def _finish(self, job):
+        with self._lock:
+            self._running.discard(job)
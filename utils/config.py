@@ -12,12 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+
+from utils.vertex import MAX_CHAR_LIMIT
 
 _OUTPUT_DATASET = 'shrinkify_output'
+# Runs with a run ID get their own "shrinkify_output_<run_id>" dataset, so several
+# feeds can be processed at once. Must fit in a BigQuery dataset name.
+_RUN_ID_PATTERN = re.compile(r'^[A-Za-z0-9_]{1,64}$')
+_EXPORT_FORMATS = ['parquet', 'csv', 'jsonl']
 _OUTPUT_TABLE = 'shrinkify_final'
+_DEFAULT_CONCURRENT_JOBS = 4
+# Upper bound on batch prediction jobs in flight, keep within the project's quota.
+_MAX_CONCURRENT_JOBS = 8
+# Tokens of the whole prompt of a row, instructions, few-shot examples and the row's context
+_DEFAULT_TOKEN_BUDGET = 1000
+# Longer column values are truncated in the prompt context
+_DEFAULT_MAX_VALUE_CHARS = 200
+
+class Variant:
+    """A short title to generate for every row. The first variant of a run is the
+    Config's char limit in the feed's language, written to "short_title". Every
+    other variant gets its own columns, i.e. "short_title_45" or "short_title_30_german"."""
+    def __init__(self, char_limit, language=None):
+        if language and not re.match(r'^[A-Za-z ]+$', language):
+            raise ValueError("Variant language can only contain letters and spaces.")
+        if not 0 < int(char_limit) <= MAX_CHAR_LIMIT:
+            raise ValueError(f"Char limits must be between 1 and {MAX_CHAR_LIMIT}.")
+        self.char_limit = int(char_limit)
+        self.language = language or None
+        self.suffix = None
+        # Set when the run starts, see main.prepare_variants
+        self.prompt_base = None
+        self.fingerprint = None
+        self.routing = False
+        self.title_column = None
+
+    def column(self, name):
+        return f'{name}_{self.suffix}' if self.suffix else name
+
+    @classmethod
+    def from_dict(cls, variant_dict):
+        return cls(variant_dict['char_limit'], variant_dict.get('language'))
+
+    def to_dict(self):
+        return {'char_limit': self.char_limit, 'language': self.language}
+
+
+def get_output_dataset(run_id=None):
+    """Dataset holding the tables of the run, and the cache shared by runs with the same ID"""
+    return f'{_OUTPUT_DATASET}_{run_id}' if run_id else _OUTPUT_DATASET
+
 
 class Config:
-    def __init__(self, industry, product_type, char_limit, source_dataset, source_table, columns, examples_df) -> None:
+    def __init__(self, industry, product_type, char_limit, source_dataset, source_table, columns, examples_df,
+                 concurrent_jobs=_DEFAULT_CONCURRENT_JOBS, key_column=None, incremental=False,
+                 token_budget=_DEFAULT_TOKEN_BUDGET, max_value_chars=_DEFAULT_MAX_VALUE_CHARS,
+                 run_id=None, export_uri=None, export_format=_EXPORT_FORMATS[0], export_title_only=False,
+                 max_cost_usd=None, variants=None, routing=False, derive_variants=False,
+                 title_column=None) -> None:
+        if incremental and not key_column:
+            raise ValueError("Incremental runs require a key column.")
+        if run_id and not _RUN_ID_PATTERN.match(run_id):
+            raise ValueError("Run ID can only contain letters, numbers and underscores.")
+        if export_uri and not export_uri.startswith('gs://'):
+            raise ValueError("Export URI must be a gs:// path.")
+        if export_format not in _EXPORT_FORMATS:
+            raise ValueError(f"Export format must be one of {', '.join(_EXPORT_FORMATS)}.")
+        if export_title_only and not key_column:
+            raise ValueError("Exporting only short titles requires a key column.")
+        if title_column and title_column not in columns:
+            raise ValueError("Title column must be one of the selected columns.")
+        if routing and not title_column:
+            raise ValueError("Skipping the model for short titles requires a title column.")
         self.industry = industry
         self.product_type = product_type
         self.char_limit = char_limit
@@ -25,9 +92,36 @@ class Config:
         self.source_table = source_table
         self.columns = columns
         self.examples_df = examples_df
-        self.output_dataset = _OUTPUT_DATASET
+        self.run_id = run_id or None
+        self.output_dataset = get_output_dataset(self.run_id)
         self.output_table = _OUTPUT_TABLE
         self._num_sub_tables = 0
+        self.concurrent_jobs = concurrent_jobs
+        self.key_column = key_column
+        self.incremental = incremental
+        self.token_budget = token_budget
+        self.max_value_chars = max_value_chars
+        self.export_uri = export_uri or None
+        self.export_format = export_format
+        self.export_title_only = export_title_only
+        # Runs estimated to cost more are stopped before any prediction
+        self.max_cost_usd = max_cost_usd or None
+        self.variants = [Variant(char_limit)] + [
+            variant if isinstance(variant, Variant) else Variant.from_dict(variant) for variant in variants or []]
+        for variant in self.variants[1:]:
+            variant.suffix = str(variant.char_limit) + (
+                '_' + variant.language.lower().replace(' ', '_') if variant.language else '')
+        if len({(variant.char_limit, variant.language) for variant in self.variants}) < len(self.variants):
+            raise ValueError("Variants must differ in char limit or language.")
+        # Titles that fit the char limit, or fit after simple rules, skip the model.
+        # Only the title column is routed, never the first selected column by default.
+        self.title_column = title_column or None
+        self.routing = routing
+        # Shorter variants are cut from the longest one in their language, see main.prepare_variants
+        self.derive_variants = derive_variants
+        self.route_counts = {}
+        self.tokens_per_row = 0
+        self.run_plan = None
 
     @property
     def num_sub_tables(self):
@@ -39,6 +133,23 @@ class Config:
             raise ValueError("Sub tables number cannot be nagative.")
         self._num_sub_tables = value
 
+    @property
+    def concurrent_jobs(self):
+        return self._concurrent_jobs
+
+    @concurrent_jobs.setter
+    def concurrent_jobs(self, value):
+        if value < 1:
+            raise ValueError("Concurrent jobs number must be at least 1.")
+        self._concurrent_jobs = min(value, _MAX_CONCURRENT_JOBS)
+
+    @property
+    def export_columns(self):
+        """Columns of the exported files, None for all of the final table's"""
+        if not self.export_title_only:
+            return None
+        return [self.key_column] + [variant.column('short_title') for variant in self.variants]
+
     @classmethod
     def from_dict(cls, config_dict):
         return cls(
@@ -49,6 +160,20 @@ class Config:
             config_dict.get('source_table'),
             config_dict.get('columns'),
             config_dict.get('examples_df'),
+            config_dict.get('concurrent_jobs', _DEFAULT_CONCURRENT_JOBS),
+            config_dict.get('key_column'),
+            config_dict.get('incremental', False),
+            config_dict.get('token_budget', _DEFAULT_TOKEN_BUDGET),
+            config_dict.get('max_value_chars', _DEFAULT_MAX_VALUE_CHARS),
+            config_dict.get('run_id'),
+            config_dict.get('export_uri'),
+            config_dict.get('export_format', _EXPORT_FORMATS[0]),
+            config_dict.get('export_title_only', False),
+            config_dict.get('max_cost_usd'),
+            config_dict.get('variants'),
+            config_dict.get('routing', bool(config_dict.get('title_column'))),
+            config_dict.get('derive_variants', False),
+            config_dict.get('title_column'),
         )
 
     def to_dict(self):
@@ -61,5 +186,19 @@ class Config:
             'output_dataset': self.output_dataset,
             'output_table': self.output_table,
             'columns': self.columns,
-            'examples_df': self.examples_df
+            'examples_df': self.examples_df,
+            'concurrent_jobs': self.concurrent_jobs,
+            'key_column': self.key_column,
+            'incremental': self.incremental,
+            'token_budget': self.token_budget,
+            'max_value_chars': self.max_value_chars,
+            'run_id': self.run_id,
+            'export_uri': self.export_uri,
+            'export_format': self.export_format,
+            'export_title_only': self.export_title_only,
+            'max_cost_usd': self.max_cost_usd,
+            'variants': [variant.to_dict() for variant in self.variants[1:]],
+            'routing': self.routing,
+            'derive_variants': self.derive_variants,
+            'title_column': self.title_column
         }
\ No newline at end of file
@@ -0,0 +1,576 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local, offline backends for benchmarking and regression testing the pipeline
+# without a GCP project. LocalBigQueryInteractor mirrors the BigQueryInteractor
+# methods the pipeline uses on top of SQLite, and LocalBatchPredictionHandler
+# mirrors VertexBatchPredictionHandler with a deterministic local model.
+# LocalCloudBackend runs the steps of cloud_function/main.py on top of both.
+
+import asyncio
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+from utils.online import FakeTextModel
+from utils.progress import FINALIZED, QUEUED, RUN_STATE_COLUMNS
+from utils.prompt import fit_to_length, serialize_context, tokens_for_chars
+from utils.routing import MODEL, ROUTES, route_stages, title_stages
+
+
+def _timed(method):
+    """Adds the run time of the method to the backend's stage timings, and
+    attributes the chars it reads to the same stage"""
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            with self._stage(method.__name__):
+                return await method(self, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _quote_columns(columns):
+    return ', '.join('"' + col + '"' for col in columns)
+
+
+class _Stage():
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.backend._current_stage
+        self.backend._current_stage = self.name
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.backend.stage_seconds[self.name] += time.perf_counter() - self.started
+        self.backend._current_stage = self.previous
+
+
+class LocalBigQueryInteractor():
+    """SQLite stand-in for BigQueryInteractor. Tables are stored as
+    "<dataset>.<table>" and procedures as Python callables. The chars of the
+    values read per stage only show which stages read the most, they aren't
+    the bytes BigQuery would scan."""
+    def __init__(self, path=':memory:', project_id='local-project', export_dir='local_exports'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.project_id = project_id
+        self.labels = defaultdict(dict)
+        self.modified = {}
+        self.export_dir = export_dir
+        self.exported_rows = {}
+        self.procedures = {}
+        self.pending_jobs = queue.Queue()
+        self.stage_seconds = defaultdict(float)
+        self.chars_read = defaultdict(int)
+        self._current_stage = None
+        self._lock = threading.RLock()
+
+    def _stage(self, name):
+        return _Stage(self, name)
+
+    def _name(self, dataset_id, table_id):
+        return f'"{dataset_id}.{table_id}"'
+
+    def create_table(self, dataset_id, table_id, columns, rows):
+        """Replaces the table with the given rows, a list of dicts keyed by the columns"""
+        name = self._name(dataset_id, table_id)
+        with self._lock:
+            self.connection.execute(f'DROP TABLE IF EXISTS {name}')
+            self.connection.execute(f'CREATE TABLE {name} ({_quote_columns(columns)})')
+            self.connection.executemany(
+                f'INSERT INTO {name} VALUES ({", ".join("?" * len(columns))})',
+                ([row.get(col) for col in columns] for row in rows))
+            self.connection.commit()
+        self.modified[(dataset_id, table_id)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def read_rows(self, dataset_id, table_id, columns=None):
+        name = self._name(dataset_id, table_id)
+        with self._lock:
+            cursor = self.connection.execute(
+                f'SELECT {_quote_columns(columns) if columns else "*"} FROM {name}')
+            names = [description[0] for description in cursor.description]
+            rows = [dict(zip(names, values)) for values in cursor.fetchall()]
+        self.chars_read[self._current_stage] += sum(
+            len(str(value)) for row in rows for value in row.values() if value is not None)
+        return rows
+
+    def drop_table(self, dataset_id, table_id):
+        with self._lock:
+            self.connection.execute(f'DROP TABLE IF EXISTS {self._name(dataset_id, table_id)}')
+            self.connection.commit()
+
+    def claim_table(self, dataset_id, table_id, claimant, stale_seconds=None):
+        """Same as BigQueryInteractor.claim_table, the claimant is the table's only row"""
+        with self._lock:
+            if self.table_exists(dataset_id, table_id):
+                (existing,) = self.connection.execute(
+                    f'SELECT claimant FROM {self._name(dataset_id, table_id)}').fetchone()
+                if existing == claimant:
+                    return True
+                age = datetime.datetime.now(datetime.timezone.utc) - self.modified[(dataset_id, table_id)]
+                if stale_seconds is None or age.total_seconds() < stale_seconds:
+                    return False
+            self.create_table(dataset_id, table_id, ['claimant'], [{'claimant': claimant}])
+            return True
+
+    def list_tables(self, dataset_id):
+        with self._lock:
+            names = self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                (f'{dataset_id}.%',)).fetchall()
+        return [name[len(dataset_id) + 1:] for (name,) in names]
+
+    def get_tables(self, dataset_id):
+        return self.list_tables(dataset_id)
+
+    def get_project_id(self):
+        return self.project_id
+
+    def create_dataset(self, dataset_id, location="us-central1"):
+        return dataset_id
+
+    def table_exists(self, dataset_id, table_id):
+        return table_id in self.list_tables(dataset_id)
+
+    def get_table_row_count(self, dataset_id, table_id):
+        with self._lock:
+            return self.connection.execute(
+                f'SELECT COUNT(*) FROM {self._name(dataset_id, table_id)}').fetchone()[0]
+
+    def get_dataset_labels(self, dataset_id):
+        return self.labels[dataset_id]
+
+    def get_table_modified(self, dataset_id, table_id):
+        return self.modified[(dataset_id, table_id)]
+
+    def set_dataset_labels(self, dataset_id, labels):
+        self.labels[dataset_id].update(labels)
+
+    @_timed
+    async def create_feed_table(self, variants, source_dataset_id, source_table_id,
+                                output_dataset_id, feed_table_id, columns_to_select,
+                                key_column=None, previous_table_id=None, max_value_chars=200,
+                                max_context_chars=None):
+        key_columns = [key_column] if key_column and key_column not in columns_to_select else []
+        selected_columns = key_columns + columns_to_select
+
+        previous = {}
+        if previous_table_id:
+            previous = {row[key_column]: row.get('content_hash') for row in self.read_rows(
+                output_dataset_id, previous_table_id)}
+
+        feed = []
+        for row in self.read_rows(source_dataset_id, source_table_id, selected_columns):
+            row['column_values_dict'] = serialize_context(row, columns_to_select, max_value_chars,
+                                                          max_context_chars)
+            # Of the source values, like bq._feed_query, not the context cut to max_value_chars
+            row['content_hash'] = hashlib.sha256(json.dumps(
+                [row[column] for column in selected_columns], default=str).encode('utf-8')).hexdigest()
+            for variant in variants:
+                row[variant.column('cache_key')] = hashlib.sha256(
+                    (variant.fingerprint + row['column_values_dict']).encode('utf-8')).hexdigest()
+            # Variants share the title column, see main.prepare_variants
+            title = row[variants[0].title_column] if variants[0].title_column else None
+            stages = title_stages(str(title)) if title is not None else None
+            for variant in variants:
+                route, routed_title = route_stages(stages, variant.char_limit) \
+                    if variant.routing and stages else (MODEL, None)
+                row[variant.column('route')] = route
+                row[variant.column('routed_title')] = routed_title
+            if previous_table_id and previous.get(row[key_column]) == row['content_hash']:
+                continue
+            feed.append(row)
+        self.create_table(output_dataset_id, feed_table_id,
+                          selected_columns + ['column_values_dict', 'content_hash'] +
+                          [variant.column('cache_key') for variant in variants] +
+                          [variant.column(name) for variant in variants for name in ['route', 'routed_title']], feed)
+
+    @_timed
+    async def create_run_state_table(self, output_dataset_id, run_state_table_id):
+        self.create_table(output_dataset_id, run_state_table_id, RUN_STATE_COLUMNS, [])
+
+    @_timed
+    async def record_run_state(self, dataset_id, run_state_table_id, events):
+        self._append_rows(dataset_id, run_state_table_id, RUN_STATE_COLUMNS, events)
+
+    def get_run_state(self, dataset_id, run_state_table_id):
+        if not self.table_exists(dataset_id, run_state_table_id):
+            return []
+        return self.read_rows(dataset_id, run_state_table_id)
+
+    def _append_rows(self, dataset_id, table_id, columns, rows):
+        with self._lock:
+            self.connection.executemany(
+                f'INSERT INTO {self._name(dataset_id, table_id)} ({_quote_columns(columns)}) '
+                f'VALUES ({", ".join("?" * len(columns))})',
+                ([row.get(col) for col in columns] for row in rows))
+            self.connection.commit()
+
+    @_timed
+    async def create_cache_table(self, output_dataset_id, cache_table_id):
+        if not self.table_exists(output_dataset_id, cache_table_id):
+            self.create_table(output_dataset_id, cache_table_id, ['cache_key', 'short_title'], [])
+
+    @_timed
+    async def get_average_length(self, dataset_id, table_id, column):
+        lengths = [len(row[column] or '') for row in self.read_rows(dataset_id, table_id, [column])]
+        return sum(lengths) / len(lengths) if lengths else None
+
+    def _cache_misses(self, output_dataset_id, feed_table_id, cache_table_id, variants):
+        """Context and prompt of every cache key of any variant routed to the model without a cached prediction"""
+        cached = {row['cache_key'] for row in self.read_rows(output_dataset_id, cache_table_id, ['cache_key'])}
+        misses = {}
+        for row in self.read_rows(output_dataset_id, feed_table_id):
+            for variant in variants:
+                cache_key = row[variant.column('cache_key')]
+                if row[variant.column('route')] == MODEL and cache_key not in cached and cache_key not in misses:
+                    misses[cache_key] = (row['column_values_dict'],
+                                         f"{variant.prompt_base}{row['column_values_dict']} Short title: ")
+        return misses
+
+    @_timed
+    async def get_cache_miss_count(self, output_dataset_id, feed_table_id, cache_table_id, variants):
+        return len(self._cache_misses(output_dataset_id, feed_table_id, cache_table_id, variants))
+
+    @_timed
+    async def get_route_counts(self, output_dataset_id, feed_table_id, variants):
+        route_counts = {variant.column('short_title'): dict.fromkeys(ROUTES, 0) for variant in variants}
+        for row in self.read_rows(output_dataset_id, feed_table_id):
+            for variant in variants:
+                route_counts[variant.column('short_title')][row[variant.column('route')]] += 1
+        return route_counts
+
+    @_timed
+    async def extract_and_save_to_sub_tables(self, variants, output_dataset_id, feed_table_id,
+                                             cache_table_id, sub_table_prefix, num_sub_tables,
+                                             run_state_table_id=None):
+        shards = defaultdict(list)
+        misses = self._cache_misses(output_dataset_id, feed_table_id, cache_table_id, variants)
+        for cache_key, (context, prompt) in misses.items():
+            shard = int(hashlib.sha256(context.encode('utf-8')).hexdigest()[:15], 16) % num_sub_tables
+            shards[shard].append({'cache_key': cache_key, 'prompt': prompt})
+        for shard in range(num_sub_tables):
+            self.create_table(output_dataset_id, f'{sub_table_prefix}{shard}',
+                              ['cache_key', 'prompt'], shards[shard])
+        if run_state_table_id:
+            queued_at = _now()
+            self._append_rows(output_dataset_id, run_state_table_id, RUN_STATE_COLUMNS, [
+                {'sub_table': shard, 'status': QUEUED, 'row_count': len(rows), 'started_at': queued_at,
+                 'token_count': tokens_for_chars(sum(len(row['prompt']) for row in rows))}
+                for shard, rows in shards.items()])
+
+    @_timed
+    async def create_finalize_procedure(self, output_dataset_id, procedure_id, feed_table_id,
+                                        cache_table_id, output_table_id, columns_to_select,
+                                        key_column=None, incremental=False,
+                                        source_dataset_id=None, source_table_id=None,
+                                        variants=None, run_state_table_id=None):
+        self.procedures[(output_dataset_id, procedure_id)] = functools.partial(
+            self._finalize, output_dataset_id, feed_table_id, cache_table_id, output_table_id,
+            columns_to_select, key_column, incremental, source_dataset_id, source_table_id, variants,
+            run_state_table_id)
+
+    @_timed
+    async def call_procedure(self, dataset_id, procedure_id):
+        return self.procedures[(dataset_id, procedure_id)]()
+
+    @_timed
+    async def create_export_procedure(self, output_dataset_id, procedure_id, feed_table_id,
+                                      cache_table_id, columns_to_select, variants, export_uri=None,
+                                      export_format='parquet', export_columns=None):
+        self.procedures.pop((output_dataset_id, procedure_id), None)
+        if export_uri:
+            self.procedures[(output_dataset_id, procedure_id)] = functools.partial(
+                self._export, output_dataset_id, feed_table_id, cache_table_id, columns_to_select,
+                variants, export_uri, export_format, export_columns)
+
+    @_timed
+    async def call_export_procedure(self, dataset_id, procedure_id, part, cache_keys_table_id):
+        return self.procedures[(dataset_id, procedure_id)](part, cache_keys_table_id)
+
+    def procedure_exists(self, dataset_id, procedure_id):
+        return (dataset_id, procedure_id) in self.procedures
+
+    def _export(self, output_dataset_id, feed_table_id, cache_table_id, columns_to_select, variants,
+                export_uri, export_format, export_columns, part, cache_keys_table_id):
+        """Writes the part to export_dir, with gs://bucket/path mapped to export_dir/bucket/path"""
+        import pandas as pd
+
+        cache_keys = {row['cache_key'] for row in self.read_rows(
+            output_dataset_id, cache_keys_table_id, ['cache_key'])}
+        combine = all if cache_keys_table_id == cache_table_id else any
+
+        def in_part(row):
+            return combine(row[variant.column('cache_key')] in cache_keys for variant in variants
+                           if row[variant.column('route')] == MODEL)
+
+        rows = self._results(output_dataset_id, feed_table_id, cache_table_id, columns_to_select, variants, in_part)
+        df = pd.DataFrame(rows).drop(columns=['column_values_dict', 'content_hash'], errors='ignore')
+        if export_columns:
+            df = df.reindex(columns=export_columns)
+
+        directory = os.path.join(self.export_dir, export_uri[len('gs://'):].rstrip('/'))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{part}-000000000000')
+        if export_format == 'parquet':
+            df.to_parquet(path + '.parquet', compression='snappy', index=False)
+        elif export_format == 'csv':
+            df.to_csv(path + '.csv.gz', compression='gzip', index=False)
+        else:
+            df.to_json(path + '.jsonl.gz', orient='records', lines=True, compression='gzip')
+        self.exported_rows[(output_dataset_id, part)] = len(df)
+
+    def _finalize(self, output_dataset_id, feed_table_id, cache_table_id, output_table_id,
+                  columns_to_select, key_column, incremental, source_dataset_id, source_table_id,
+                  variants, run_state_table_id):
+        """Returns (length_check, row_count) rows like the BigQuery procedure"""
+        started_at = _now()
+        results = self._results(output_dataset_id, feed_table_id, cache_table_id, columns_to_select, variants)
+        length_checks = defaultdict(int)
+        for row in results:
+            length_checks[row['length_check']] += 1
+        if results:
+            self._write_output(output_dataset_id, output_table_id, key_column, incremental,
+                               source_dataset_id, source_table_id, results)
+        if run_state_table_id:
+            self._append_rows(output_dataset_id, run_state_table_id, RUN_STATE_COLUMNS, [
+                {'status': FINALIZED, 'started_at': started_at, 'finished_at': _now()}])
+        return list(length_checks.items())
+
+    def _results(self, output_dataset_id, feed_table_id, cache_table_id, columns_to_select, variants,
+                 feed_filter=None):
+        """Every feed row, or those feed_filter keeps, with the length checked short
+        title of each variant, like bq._results_sql"""
+        cache = {row['cache_key']: row['short_title']
+                 for row in self.read_rows(output_dataset_id, cache_table_id)}
+        results = [row for row in self.read_rows(output_dataset_id, feed_table_id)
+                   if feed_filter is None or feed_filter(row)]
+        processed_date = datetime.date.today().isoformat()
+        for row in results:
+            for variant in variants:
+                char_limit = variant.char_limit
+                routed_title = row.pop(variant.column('routed_title'))
+                model_title = cache.get(row[variant.column('cache_key')]) or None
+                if routed_title is not None:
+                    length_check = 'passed'
+                    short_title = routed_title
+                elif model_title is None:
+                    length_check = 'missing'
+                    title = row[variant.title_column] if variant.title_column else None
+                    short_title = fit_to_length(str(title or ''), char_limit)
+                elif len(model_title) <= char_limit:
+                    length_check = 'passed'
+                    short_title = model_title
+                else:
+                    length_check = 'shortened'
+                    short_title = fit_to_length(model_title, char_limit)
+                row[variant.column('short_title')] = short_title
+                row[variant.column('length_check')] = length_check
+            row['processed_date'] = processed_date
+        return results
+
+    def _write_output(self, output_dataset_id, output_table_id, key_column, incremental,
+                      source_dataset_id, source_table_id, results):
+        columns = list(results[0])
+
+        if incremental:
+            source_keys = {row[key_column] for row in self.read_rows(
+                source_dataset_id, source_table_id, [key_column])}
+            merged = {row[key_column]: row for row in self.read_rows(output_dataset_id, output_table_id)}
+            merged.update({row[key_column]: row for row in results})
+            results = [row for key, row in merged.items() if key in source_keys]
+        self.create_table(output_dataset_id, output_table_id, columns, results)
+
+    @_timed
+    def run_prediction_job(self, model):
+        """Runs the next queued batch prediction job, writing its results
+        table like Vertex does. Returns the job, or None if none is queued."""
+        try:
+            dataset_id, sub_table_id, results_table_id = self.pending_jobs.get_nowait()
+        except queue.Empty:
+            return None
+        rows = self.read_rows(dataset_id, sub_table_id)
+        predictions = model.predict_batch([row['prompt'] for row in rows])
+        for row, prediction in zip(rows, predictions):
+            row['prediction'] = prediction
+        self.create_table(dataset_id, results_table_id, ['cache_key', 'prompt', 'prediction'], rows)
+        return dataset_id, sub_table_id, results_table_id
+
+    @_timed
+    async def merge_results(self, dataset_id, results_table_ids, cache_table_id):
+        """Same as the Cloud Function's merge_results"""
+        cached = {row['cache_key'] for row in self.read_rows(dataset_id, cache_table_id, ['cache_key'])}
+        new_rows = {}
+        for results_table_id in results_table_ids:
+            for row in self.read_rows(dataset_id, results_table_id, ['cache_key', 'prediction']):
+                if row['prediction'] is not None and row['cache_key'] not in cached:
+                    new_rows.setdefault(row['cache_key'], row['prediction'].strip())
+        with self._lock:
+            self.connection.executemany(
+                f'INSERT INTO {self._name(dataset_id, cache_table_id)} VALUES (?, ?)', new_rows.items())
+            self.connection.commit()
+
+
+class LocalBatchPredictionHandler():
+    """Same interface as VertexBatchPredictionHandler, queues the job on a
+    LocalBigQueryInteractor for the benchmark driver to run"""
+    def __init__(self, backend, dataset, destination_uri_prefix):
+        # Both are bq://project.dataset.table URIs
+        _, self.dataset_id, self.sub_table_id = dataset[len('bq://'):].split('.')
+        self.results_table_id = destination_uri_prefix[len('bq://'):].split('.')[-1]
+        self.backend = backend
+
+    def init_batch_prediction(self):
+        self.backend.pending_jobs.put((self.dataset_id, self.sub_table_id, self.results_table_id))
+        return f'{self.dataset_id}.{self.results_table_id}'
+
+    def is_running(self):
+        return (self.dataset_id, self.sub_table_id, self.results_table_id) in self.backend.pending_jobs.queue
+
+    def running_jobs(self):
+        return [f'{dataset_id}.{results_table_id}'
+                for dataset_id, _, results_table_id in list(self.backend.pending_jobs.queue)]
+
+
+class LocalWorkQueue():
+    """Stand-in for the Pub/Sub topic between cloud_function/main.py:cloud_agent and
+    process_work. Work whose handler raises is redelivered with the same message ID,
+    up to max_attempts times."""
+    def __init__(self, max_attempts=5):
+        self.max_attempts = max_attempts
+        self.messages = queue.Queue()
+        self.published = 0
+        self.redelivered = 0
+        self.dropped = 0
+
+    def publish(self, work):
+        """Returns the message ID"""
+        self.published += 1
+        message_id = str(self.published)
+        self.messages.put((work, message_id, 1))
+        return message_id
+
+    @property
+    def depth(self):
+        return self.messages.qsize()
+
+    def process(self, handler):
+        """Handles the queued work in order, including the work published meanwhile.
+        The handler gets the work and its message ID."""
+        while True:
+            try:
+                work, message_id, attempt = self.messages.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                handler(work, message_id)
+            except Exception as e:
+                print(f'Work {work} failed on attempt {attempt}: {e}')
+                if attempt < self.max_attempts:
+                    self.redelivered += 1
+                    self.messages.put((work, message_id, attempt + 1))
+                else:
+                    self.dropped += 1
+
+
+class LocalPublisher():
+    """Same interface as pubsub_v1.PublisherClient, the Cloud Function's publisher
+    in the benchmark, publishes the work to a LocalWorkQueue"""
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+
+    def publish(self, topic, data):
+        future = Future()
+        future.set_result(self.work_queue.publish(json.loads(data)))
+        return future
+
+
+class LocalCloudBackend():
+    """Same interface as cloud_function/main.py:BigQueryBackend on a LocalBigQueryInteractor.
+    Only the SQL of each call is replaced, SQLite can't run BigQuery's, so the
+    function's own steps decide what is merged, exported, dropped and launched."""
+    def __init__(self, backend, prediction_handler):
+        self.backend = backend
+        self.project = backend.get_project_id()
+        self.prediction_handler = prediction_handler
+
+    def list_tables(self, dataset_id):
+        return self.backend.list_tables(dataset_id)
+
+    def table_exists(self, dataset_id, table_id):
+        return self.backend.table_exists(dataset_id, table_id)
+
+    def get_table_row_count(self, dataset_id, table_id):
+        return self.backend.get_table_row_count(dataset_id, table_id)
+
+    def get_dataset_labels(self, dataset_id):
+        return self.backend.get_dataset_labels(dataset_id)
+
+    def claim_table(self, dataset_id, table_id, claimant):
+        return self.backend.claim_table(dataset_id, table_id, claimant)
+
+    def procedure_exists(self, dataset_id, procedure_id):
+        return self.backend.procedure_exists(dataset_id, procedure_id)
+
+    def merge_results(self, dataset_id, results_table_ids, cache_table_id):
+        asyncio.run(self.backend.merge_results(dataset_id, results_table_ids, cache_table_id))
+
+    def export_results(self, dataset_id, procedure_id, results_table_ids):
+        for table_id in results_table_ids:
+            asyncio.run(self.backend.call_export_procedure(dataset_id, procedure_id, table_id, table_id))
+
+    def drop_tables(self, dataset_id, table_ids):
+        for table_id in table_ids:
+            self.backend.drop_table(dataset_id, table_id)
+
+    def record_run_state(self, dataset_id, run_state_table_id, events):
+        asyncio.run(self.backend.record_run_state(dataset_id, run_state_table_id, events))
+
+    def call_procedure(self, dataset_id, procedure_id, timeout):
+        return dict(asyncio.run(self.backend.call_procedure(dataset_id, procedure_id)))
+
+    def get_token_count(self, dataset_id, run_state_table_id, sub_table):
+        return max((event['token_count'] or 0 for event in self.backend.get_run_state(dataset_id, run_state_table_id)
+                    if event['sub_table'] == sub_table and event['status'] == QUEUED), default=0)
+
+
+def local_prediction_handler(backend):
+    """Returns a handler class bound to the backend, to pass to main.run_async"""
+    return functools.partial(LocalBatchPredictionHandler, backend)
+
+
+def create_local_model(char_limit):
+    """Deterministic model, keeps the context values that fit the char limit"""
+    return FakeTextModel(char_limit, latency_seconds=0)
@@ -0,0 +1,101 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cached dataset, table and column browsing for the app. The table names of a
+# dataset are read with one INFORMATION_SCHEMA query and kept for a while, so
+# searching datasets with thousands of tables stays fast. Searches match the cached
+# names in process rather than running a LIKE query per search, which is fine up
+# to some hundred thousand tables. The columns are only read for the tables that
+# are selected. A single MetadataBrowser is meant to be shared by all sessions of the app.
+
+import threading
+import time
+from collections import OrderedDict
+
+_TTL_SECONDS = 600
+# Datasets and tables kept in the cache at once, the least recently used are evicted first
+_MAX_CACHED_DATASETS = 50
+_MAX_CACHED_TABLES = 500
+_MAX_SEARCH_RESULTS = 100
+
+
+class TTLCache:
+    """Thread safe cache whose entries expire after ttl_seconds, holding up to max_entries"""
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns the cached value of key, calling load() if it's missing or expired"""
+        with self._lock:
+            if key in self._entries:
+                loaded_at, value = self._entries[key]
+                if time.monotonic() - loaded_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return value
+        value = load()
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_matching(self, matches):
+        """Drops the entries whose key matches"""
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                del self._entries[key]
+
+
+class MetadataBrowser:
+    def __init__(self, bq, ttl_seconds=_TTL_SECONDS, max_datasets=_MAX_CACHED_DATASETS,
+                 max_tables=_MAX_CACHED_TABLES):
+        self.bq = bq
+        self.cache = TTLCache(ttl_seconds, max_datasets + 1)
+        self.column_cache = TTLCache(ttl_seconds, max_tables)
+
+    def get_datasets(self):
+        return self.cache.get(('datasets',), self.bq.get_datasets)
+
+    def get_table_names(self, dataset_id):
+        return self.cache.get(('tables', dataset_id), lambda: self.bq.get_table_names(dataset_id))
+
+    def search_tables(self, dataset_id, text='', limit=_MAX_SEARCH_RESULTS):
+        """Tables of the dataset containing text, those starting with it first"""
+        text = text.lower()
+        matches = [table for table in self.get_table_names(dataset_id) if text in table.lower()]
+        matches.sort(key=lambda table: not table.lower().startswith(text))
+        return matches[:limit]
+
+    def get_column_names(self, dataset_id, table_id):
+        return self.column_cache.get((dataset_id, table_id), lambda: self.bq.get_column_names(dataset_id, table_id))
+
+    def refresh(self, dataset_id=None):
+        """Drops the cached names of the dataset, or of everything"""
+        if dataset_id is None:
+            self.cache.invalidate()
+            self.column_cache.invalidate()
+        else:
+            self.cache.invalidate(('tables', dataset_id))
+            self.column_cache.invalidate_matching(lambda key: key[0] == dataset_id)
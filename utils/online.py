@@ -0,0 +1,176 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils.clients import get_prediction_client
+from utils.prompt import chars_for_tokens
+from utils.vertex import _LOCATION, _TEXT_MODEL
+from utils.vertex import _MODEL_PARAMETERS as _BATCH_MODEL_PARAMETERS
+
+# The same model parameters as batch prediction, which takes them as strings, as numbers
+_MODEL_PARAMETERS = {name: json.loads(value) for name, value in _BATCH_MODEL_PARAMETERS.items()}
+_MAX_BATCH_SIZE = 16
+_MAX_WAIT_SECONDS = 0.05
+_MAX_CONCURRENT_CALLS = 4
+_MAX_LATENCY_SAMPLES = 10000
+
+
+class VertexOnlineModel():
+    """Online text-bison predictions, sending a whole micro-batch as the
+    instances of a single request"""
+    def __init__(self, project_id, location=_LOCATION):
+        self.client = get_prediction_client(location)
+        self.endpoint = f'projects/{project_id}/locations/{location}/{_TEXT_MODEL}'
+        self.model_parameters = _MODEL_PARAMETERS
+
+    def predict_batch(self, prompts):
+        from google.protobuf import json_format
+        from google.protobuf.struct_pb2 import Value
+
+        instances = [json_format.ParseDict({'prompt': prompt}, Value()) for prompt in prompts]
+        parameters = json_format.ParseDict(self.model_parameters, Value())
+        response = self.client.predict(endpoint=self.endpoint, instances=instances, parameters=parameters)
+        return [prediction['content'].strip() for prediction in response.predictions]
+
+
+class FakeTextModel():
+    """Local stand-in for VertexOnlineModel, for offline runs and benchmarks.
+    Keeps the context values that fit the char limit after a fixed delay.
+    When model_parameters is set, the output is cut at maxOutputTokens like the real model's."""
+    def __init__(self, char_limit, latency_seconds=0.2):
+        self.char_limit = char_limit
+        self.latency_seconds = latency_seconds
+        self.model_parameters = None
+
+    def predict_batch(self, prompts):
+        time.sleep(self.latency_seconds)
+        return [self._shorten(prompt) for prompt in prompts]
+
+    def _shorten(self, prompt):
+        context = prompt.rsplit('Context:', 1)[-1].rsplit('Short title:', 1)[0]
+        short_title = ''
+        words = [word for word in context.strip(' {}').split() if not word.endswith(':')]
+        for word in words:
+            candidate = f'{short_title} {word}'.strip()
+            if len(candidate) > self.char_limit:
+                break
+            short_title = candidate
+        if self.model_parameters:
+            return short_title[:chars_for_tokens(int(self.model_parameters['maxOutputTokens']))]
+        return short_title
+
+
+class LatencyStats():
+    """Thread safe request latency and throughput counters"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._requests = 0
+        self._batches = 0
+        self._started = time.monotonic()
+
+    def record_request(self, latency_seconds):
+        with self._lock:
+            self._requests += 1
+            self._latencies.append(latency_seconds)
+            if len(self._latencies) > _MAX_LATENCY_SAMPLES:
+                self._latencies = self._latencies[-_MAX_LATENCY_SAMPLES:]
+
+    def record_batch(self):
+        with self._lock:
+            self._batches += 1
+
+    def to_dict(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            elapsed = time.monotonic() - self._started
+            return {
+                'requests': self._requests,
+                'batches': self._batches,
+                'p50_ms': _percentile(latencies, 50) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+                'requests_per_second': self._requests / elapsed if elapsed else 0,
+            }
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))
+    return sorted_values[index]
+
+
+class MicroBatcher():
+    """Groups prompts submitted from many threads into micro-batches.
+
+    A batch is sent to the model once it holds max_batch_size prompts or the
+    oldest prompt in it has waited max_wait_seconds, with at most
+    max_concurrent_calls model calls in flight.
+    """
+    def __init__(self, model, max_batch_size=_MAX_BATCH_SIZE, max_wait_seconds=_MAX_WAIT_SECONDS,
+                 max_concurrent_calls=_MAX_CONCURRENT_CALLS, stats=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.stats = stats or LatencyStats()
+        self._queue = queue.Queue()
+        self._calls = threading.BoundedSemaphore(max_concurrent_calls)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_calls)
+        self._worker = threading.Thread(target=self._collect_batches, daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt):
+        future = Future()
+        self._queue.put((prompt, future, time.monotonic()))
+        return future
+
+    def predict(self, prompts, timeout=None):
+        futures = [self.submit(prompt) for prompt in prompts]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def _collect_batches(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0][2] + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Blocks when max_concurrent_calls batches are already in flight
+            self._calls.acquire()
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        try:
+            short_titles = self.model.predict_batch([prompt for prompt, _, _ in batch])
+            self.stats.record_batch()
+            for (_, future, submitted), short_title in zip(batch, short_titles):
+                future.set_result(short_title)
+                self.stats.record_request(time.monotonic() - submitted)
+            if len(short_titles) < len(batch):
+                raise RuntimeError(f'The model returned {len(short_titles)} predictions for {len(batch)} prompts')
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._calls.release()
@@ -0,0 +1,127 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Chooses the sub table size of a run and estimates how long it will take and cost.
+# The timing constants are rough averages observed for text-bison batch jobs.
+
+import math
+
+from utils.prompt import chars_for_tokens
+
+# Batch prediction jobs accept up to 30k instances. Hash sharding sizes vary
+# slightly around the planned size, so leave some headroom.
+_MAX_ROWS_PER_SUB_TABLE = 28000
+# Below this, the per job overhead dominates and splitting further doesn't pay off
+_MIN_ROWS_PER_SUB_TABLE = 2000
+# Keeps very long prompts from making a single job run for hours
+_MAX_TOKENS_PER_SUB_TABLE = 10000000
+# Queueing and provisioning time of a batch prediction job
+_JOB_OVERHEAD_SECONDS = 300
+_TOKENS_PER_SECOND_PER_JOB = 5000
+# List prices at the time of writing, PaLM text models are billed per 1000 characters
+_PREDICTION_USD_PER_1K_INPUT_CHARS = 0.00025
+_PREDICTION_USD_PER_1K_OUTPUT_CHARS = 0.0005
+_BIGQUERY_USD_PER_TIB = 6.25
+
+
+def prediction_usd(input_chars, output_chars):
+    """List price of predicting prompts totalling input_chars into output_chars"""
+    return (input_chars * _PREDICTION_USD_PER_1K_INPUT_CHARS
+            + output_chars * _PREDICTION_USD_PER_1K_OUTPUT_CHARS) / 1000
+
+
+class RunPlan:
+    def __init__(self, rows, tokens_per_row, concurrent_jobs, rows_per_sub_table, num_sub_tables):
+        self.rows = rows
+        self.tokens_per_row = tokens_per_row
+        self.concurrent_jobs = concurrent_jobs
+        self.rows_per_sub_table = rows_per_sub_table
+        self.num_sub_tables = num_sub_tables
+
+    @property
+    def waves(self):
+        """Number of rounds of concurrent jobs the run goes through"""
+        return math.ceil(self.num_sub_tables / self.concurrent_jobs)
+
+    @property
+    def estimated_seconds(self):
+        if not self.num_sub_tables:
+            return 0
+        job_seconds = self.rows_per_sub_table * self.tokens_per_row / _TOKENS_PER_SECOND_PER_JOB
+        return self.waves * (_JOB_OVERHEAD_SECONDS + job_seconds)
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'tokens_per_row': self.tokens_per_row,
+            'concurrent_jobs': self.concurrent_jobs,
+            'rows_per_sub_table': self.rows_per_sub_table,
+            'num_sub_tables': self.num_sub_tables,
+            'waves': self.waves,
+            'estimated_seconds': round(self.estimated_seconds),
+        }
+
+    def __str__(self):
+        return (f'{self.rows} rows in {self.num_sub_tables} jobs of up to {self.rows_per_sub_table} rows, '
+                f'{self.concurrent_jobs} at a time, ~{math.ceil(self.estimated_seconds / 60)} minutes')
+
+
+def plan_run(rows, tokens_per_row, concurrent_jobs):
+    """Splits rows evenly across the concurrent jobs when the feed is small enough,
+    otherwise uses the largest sub tables a job can take. Never creates empty sub tables."""
+    if not rows:
+        return RunPlan(0, tokens_per_row, concurrent_jobs, 0, 0)
+
+    max_rows = min(_MAX_ROWS_PER_SUB_TABLE, _MAX_TOKENS_PER_SUB_TABLE // max(tokens_per_row, 1))
+    rows_per_sub_table = math.ceil(rows / concurrent_jobs)
+    rows_per_sub_table = max(min(rows_per_sub_table, max_rows), min(_MIN_ROWS_PER_SUB_TABLE, max_rows))
+
+    num_sub_tables = math.ceil(rows / rows_per_sub_table)
+    # Spread the rows evenly over the sub tables the plan needs anyway
+    rows_per_sub_table = math.ceil(rows / num_sub_tables)
+    return RunPlan(rows, tokens_per_row, concurrent_jobs, rows_per_sub_table, num_sub_tables)
+
+
+class RunEstimate:
+    """Cost of a run plan. Output is assumed to use the whole char limit."""
+    def __init__(self, plan, bytes_scanned, char_limit):
+        self.plan = plan
+        self.bytes_scanned = bytes_scanned
+        self.char_limit = char_limit
+
+    @property
+    def prediction_usd(self):
+        input_chars = self.plan.rows * chars_for_tokens(self.plan.tokens_per_row)
+        output_chars = self.plan.rows * self.char_limit
+        return prediction_usd(input_chars, output_chars)
+
+    @property
+    def bigquery_usd(self):
+        return self.bytes_scanned / 2 ** 40 * _BIGQUERY_USD_PER_TIB
+
+    @property
+    def usd(self):
+        return self.prediction_usd + self.bigquery_usd
+
+    def to_dict(self):
+        return {
+            **self.plan.to_dict(),
+            'bytes_scanned': self.bytes_scanned,
+            'prediction_usd': round(self.prediction_usd, 2),
+            'bigquery_usd': round(self.bigquery_usd, 2),
+            'usd': round(self.usd, 2),
+        }
+
+    def __str__(self):
+        return f'~${self.usd:.2f} ({self.plan.rows} rows to predict, {self.bytes_scanned / 2 ** 30:.1f} GiB scanned), {self.plan}'
@@ -0,0 +1,158 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Progress of a run, read from the "run_state" table. The table is append only:
+# the sharding job, main, the Cloud Function and the finalize procedure each add
+# an event row when a sub table changes status, so concurrent writers never conflict.
+#
+#   queued      sub table created, started_at is when sharding finished
+#   predicting  batch prediction job submitted
+#   merged      results merged into the cache, from started_at to finished_at
+#   failed      the next batch prediction job couldn't be submitted, see error
+#   finalized   final table written, sub_table is NULL
+#
+# A sub table has the status of its latest event, so one resume relaunched after it
+# failed is predicting again. Merged is final, whatever is recorded after it.
+
+import datetime
+import math
+
+QUEUED = 'queued'
+PREDICTING = 'predicting'
+MERGED = 'merged'
+FAILED = 'failed'
+FINALIZED = 'finalized'
+
+RUN_STATE_COLUMNS = ['sub_table', 'status', 'row_count', 'token_count', 'error', 'started_at', 'finished_at']
+
+# Breaks ties between events recorded at the same time
+_STATUS_ORDER = [QUEUED, PREDICTING, FAILED, MERGED]
+_EARLIEST = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+def _to_datetime(value):
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def _event_order(event):
+    started_at = _to_datetime(event['started_at'])
+    return started_at or _EARLIEST, _STATUS_ORDER.index(event['status'])
+
+
+def _average(values):
+    return sum(values) / len(values) if values else None
+
+
+class RunProgress:
+    def __init__(self, events, concurrent_jobs):
+        self.concurrent_jobs = concurrent_jobs
+        self.events = {}
+        self.finalized = False
+        for event in events:
+            if event['status'] == FINALIZED:
+                self.finalized = True
+                continue
+            # The latest event of every status, i.e. of the last launch of the sub table
+            events = self.events.setdefault(event['sub_table'], {})
+            if event['status'] not in events or _event_order(event) >= _event_order(events[event['status']]):
+                events[event['status']] = event
+
+    @property
+    def num_sub_tables(self):
+        return len(self.events)
+
+    def status(self, sub_table):
+        events = self.events[sub_table]
+        if MERGED in events:
+            return MERGED
+        return max(events.values(), key=_event_order)['status']
+
+    def count(self, status):
+        return sum(self.status(sub_table) == status for sub_table in self.events)
+
+    @property
+    def total_rows(self):
+        return sum(events[QUEUED]['row_count'] or 0 for events in self.events.values() if QUEUED in events)
+
+    @property
+    def merged_rows(self):
+        return sum(events[QUEUED]['row_count'] or 0 for sub_table, events in self.events.items()
+                   if QUEUED in events and self.status(sub_table) == MERGED)
+
+    @property
+    def fraction_done(self):
+        if self.finalized:
+            return 1.0
+        return self.merged_rows / self.total_rows if self.total_rows else 0.0
+
+    @property
+    def errors(self):
+        return {sub_table: events[FAILED]['error'] for sub_table, events in self.events.items()
+                if self.status(sub_table) == FAILED}
+
+    def _stage_durations(self, start_status, start_field, end_status, end_field):
+        durations = []
+        for events in self.events.values():
+            if start_status in events and end_status in events:
+                start = _to_datetime(events[start_status][start_field])
+                end = _to_datetime(events[end_status][end_field])
+                if start and end:
+                    durations.append((end - start).total_seconds())
+        return durations
+
+    @property
+    def stage_seconds(self):
+        """Average seconds a sub table spends waiting for a job, being predicted and being merged"""
+        return {
+            'queued': _average(self._stage_durations(QUEUED, 'started_at', PREDICTING, 'started_at')),
+            'predicting': _average(self._stage_durations(PREDICTING, 'started_at', MERGED, 'started_at')),
+            'merging': _average(self._stage_durations(MERGED, 'started_at', MERGED, 'finished_at')),
+        }
+
+    @property
+    def eta_seconds(self):
+        """Remaining waves of jobs times the average job, None until a sub table was merged"""
+        if self.finalized:
+            return 0
+        stages = self.stage_seconds
+        if stages['predicting'] is None:
+            return None
+        remaining = self.num_sub_tables - self.count(MERGED) - self.count(FAILED)
+        waves = math.ceil(remaining / self.concurrent_jobs)
+        return waves * (stages['predicting'] + (stages['merging'] or 0))
+
+    def to_dict(self):
+        return {
+            'sub_tables': self.num_sub_tables,
+            'merged': self.count(MERGED),
+            'predicting': self.count(PREDICTING),
+            'failed': self.count(FAILED),
+            'fraction_done': round(self.fraction_done, 3),
+            'eta_seconds': self.eta_seconds if self.eta_seconds is None else round(self.eta_seconds),
+            'stage_seconds': {stage: value if value is None else round(value, 3)
+                              for stage, value in self.stage_seconds.items()},
+            'finalized': self.finalized,
+        }
+
+    def __str__(self):
+        text = f'{self.count(MERGED)}/{self.num_sub_tables} sub tables done'
+        if self.count(FAILED):
+            text += f', {self.count(FAILED)} failed'
+        if self.finalized:
+            return text + ', final table written'
+        if self.eta_seconds is not None:
+            text += f', ~{math.ceil(self.eta_seconds / 60)} minutes left'
+        return text
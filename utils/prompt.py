@@ -0,0 +1,132 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Token budget aware prompt building. The prompt base (instructions and examples)
+# is prepended to every row, so every token saved here is saved on each prediction.
+# The token budget covers the whole prompt of a row: the examples leave room for
+# the row's context, and the context is cut to what's left of the budget, dropping
+# the columns selected last first.
+# Only depends on the standard library, so online.py can build prompts without the GCP SDKs.
+
+import json
+
+# PaLM models average roughly 4 characters per token for English text
+_CHARS_PER_TOKEN = 4
+# Part of the token budget kept free for the context of a row when choosing the examples
+_CONTEXT_TOKENS = 250
+# Context every row keeps even when the instructions alone use up the budget
+_MIN_CONTEXT_TOKENS = 50
+
+
+def estimate_tokens(text):
+    return tokens_for_chars(len(text))
+
+
+def tokens_for_chars(chars):
+    return -(-int(chars) // _CHARS_PER_TOKEN)
+
+
+def chars_for_tokens(tokens):
+    return tokens * _CHARS_PER_TOKEN
+
+
+def tokens_for_chars_sql(chars):
+    """BigQuery expression of tokens_for_chars"""
+    return f'CAST(CEIL({chars} / {_CHARS_PER_TOKEN}) AS INT64)'
+
+
+def serialize_context(row, columns, max_value_chars, max_context_chars=None):
+    """Compact "Context: {col: value, ...}" representation of a row.
+    Empty values are dropped and long values truncated, matching the feed SQL.
+    With max_context_chars, the values are cut there, so the last columns go first."""
+    values = []
+    for col in columns:
+        value = row.get(col)
+        if value is None or str(value) == '':
+            continue
+        values.append(f'{col}: {str(value)[:max_value_chars]}')
+    if max_context_chars is not None:
+        kept = []
+        length = 0
+        for value in values:
+            if length >= max_context_chars:
+                break
+            kept.append(value[:max_context_chars - length])
+            length += len(value) + len(', ')
+        values = kept
+    return 'Context: {' + ', '.join(values) + '}'
+
+
+def max_context_chars(token_budget, prompt_bases):
+    """Chars the context values of a row can use for the prompt of every
+    prompt base to fit the token budget"""
+    base_tokens = max(estimate_tokens(create_prompt(prompt_base, {}, [], 0)) for prompt_base in prompt_bases)
+    return chars_for_tokens(max(token_budget - base_tokens, _MIN_CONTEXT_TOKENS))
+
+
+def select_examples(examples, token_budget):
+    """Returns the examples that fit the token budget, cheapest first,
+    in their original order. At least one example is always kept."""
+    by_cost = sorted(range(len(examples)), key=lambda i: estimate_tokens(examples[i]))
+    selected = []
+    used_tokens = 0
+    for i in by_cost:
+        tokens = estimate_tokens(examples[i])
+        if selected and used_tokens + tokens > token_budget:
+            break
+        selected.append(i)
+        used_tokens += tokens
+    return [examples[i] for i in sorted(selected)]
+
+
+def fit_to_length(text, char_limit):
+    """Keeps the leading words of text that fit char_limit, cutting the first
+    word if even it doesn't fit. Mirrors the length check of the finalize SQL."""
+    words = []
+    length = -1
+    for word in text.split(' '):
+        length += len(word) + 1
+        if length > char_limit:
+            break
+        words.append(word)
+    return ' '.join(words) if words else text[:char_limit]
+
+
+def create_prompt_base(config, variant=None):
+    examples = json.loads(config.examples_df.to_json(orient='records'))
+    char_limit = variant.char_limit if variant else config.char_limit
+
+    prompt = f"""You are a leading digital marketer working for a top {config.industry} company. You are an expert at generating high-performing short search ad titles ensuring that the ad titles only contain the important {config.product_type} information while keeping the title as short as possible and always less than  {char_limit} characters long. A user needs your help to shorten these {config.product_type} titles. Generate Short Title using the given "Context".
+When you're done, check the length of the suggested {config.product_type} title, and if it's longer than {char_limit} characters try to make it even shorter by removing more words.
+"""
+    if variant and variant.language:
+        prompt += f"Write the Short Title in {variant.language}.\n"
+    compiled_examples = []
+    for example in examples:
+        short_title = example.pop('Short Title')
+        example.pop('Character Count', None)
+        compiled_examples.append(f"""
+{serialize_context(example, list(example), config.max_value_chars)}
+Short Title: {short_title}
+""")
+
+    # Only keep the examples that fit what's left of the budget after the instructions and the context
+    examples_budget = config.token_budget - _CONTEXT_TOKENS - estimate_tokens(prompt)
+    prompt += ''.join(select_examples(compiled_examples, examples_budget))
+    return prompt
+
+
+def create_prompt(prompt_base, row, columns, max_value_chars, max_context_chars=None):
+    """Builds the prompt of a single row the same way the sharding SQL does"""
+    return f"{prompt_base}{serialize_context(row, columns, max_value_chars, max_context_chars)} Short title: "
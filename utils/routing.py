@@ -0,0 +1,141 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Routes every row of the feed before prediction. The title is the first selected column.
+#
+#   fits   the title is within the char limit and is used as is
+#   rules  the title fits after one or more of the rules below and is used shortened
+#   model  everything else, the only rows sent to batch prediction
+#
+# The rules are applied one after the other, and the first result that fits wins, so
+# the least lossy rules come first. Each rule is both a Python function (local backend,
+# estimates) and a BigQuery expression (feed table), kept side by side to stay in sync.
+
+import re
+
+FITS = 'fits'
+RULES = 'rules'
+MODEL = 'model'
+ROUTES = [FITS, RULES, MODEL]
+
+# (pattern, replacement) pairs, valid for both Python re and BigQuery RE2
+_UNITS = r'(?i)(\d)\s+(ml|l|g|kg|mg|cm|mm|m|oz|lb|lbs|in|ft|gb|tb|w|v|mah)\b'
+_BRACKETS = r'\s*[\(\[][^\)\]]*[\)\]]'
+_TRAILING_SEPARATED = r'\s+[-|–]\s+.*$'
+# Left dangling when the word after it is dropped, i.e. "Acme Shoes by Acme"
+_TRAILING_CONNECTOR = r'(?i)\s+(by|from|with|and|for|of|in|&|-)$'
+# Rules may only shorten the title to this share of its length, shorter
+# results likely lost what the title is about and go to the model
+_MIN_RETAINED_SHARE = 0.5
+
+
+def _letters(word):
+    return sum(char.isalpha() for char in word)
+
+
+def _dedupe_words(text):
+    """Drops repeated words of two or more letters, and repeats of the leading word,
+    i.e. a brand, keeping the first. Numbers and single letters are kept, as in "2 x 2"."""
+    words = text.split(' ')
+    seen = set()
+    kept = []
+    for word in words:
+        repeated = word.lower() in seen
+        seen.add(word.lower())
+        if repeated and (_letters(word) >= 2 or (word.lower() == words[0].lower() and _letters(word))):
+            continue
+        kept.append(word)
+    return re.sub(_TRAILING_CONNECTOR, '', ' '.join(kept)).strip()
+
+
+def _dedupe_words_sql(text):
+    return fr"""TRIM(REGEXP_REPLACE((
+        SELECT STRING_AGG(word, ' ' ORDER BY position)
+        FROM (
+            SELECT word, position,
+                ROW_NUMBER() OVER (PARTITION BY LOWER(word) ORDER BY position) > 1 AS is_repeated,
+                LOWER(word) = LOWER(FIRST_VALUE(word) OVER (ORDER BY position)) AS is_leading
+            FROM UNNEST(SPLIT({text}, ' ')) AS word WITH OFFSET AS position
+        )
+        WHERE NOT (is_repeated AND (REGEXP_CONTAINS(word, r'\pL.*\pL') OR (is_leading AND REGEXP_CONTAINS(word, r'\pL'))))
+        ), r'{_TRAILING_CONNECTOR}', ''))"""
+
+
+def _regex_rule(pattern, replacement=''):
+    return (lambda text: re.sub(pattern, replacement, text).strip(),
+            lambda text: f"TRIM(REGEXP_REPLACE({text}, r'{pattern}', r'{replacement}'))")
+
+
+_RULES = [
+    _regex_rule(r'\s+', ' '),
+    _regex_rule(_UNITS, r'\1\2'),
+    (_dedupe_words, _dedupe_words_sql),
+    _regex_rule(_BRACKETS),
+    _regex_rule(_TRAILING_SEPARATED),
+]
+
+
+def title_stages(title):
+    """The title followed by the result of every rule, each applied to the previous one"""
+    stages = [title]
+    for rule, _ in _RULES:
+        stages.append(rule(stages[-1]))
+    return stages
+
+
+def route_stages(stages, char_limit):
+    """Returns the route and short title of the title_stages of a title"""
+    for i, stage in enumerate(stages):
+        if 0 < len(stage) <= char_limit and (i == 0 or len(stage) >= _MIN_RETAINED_SHARE * len(stages[0])):
+            return (FITS if i == 0 else RULES), stage
+    return MODEL, None
+
+
+def route_title(title, char_limit):
+    """Returns the route of the title and its short title, None for the model route"""
+    if title is None:
+        return MODEL, None
+    return route_stages(title_stages(str(title)), char_limit)
+
+
+def title_stages_sql(title, source):
+    """Query of the source rows with a title_stages column, the BigQuery ARRAY of
+    title_stages, an empty title for NULL. Every stage is computed once, in its own
+    column, from the column of the previous one."""
+    columns = [f'title_stage_{i}' for i in range(len(_RULES) + 1)]
+    query = f"SELECT *, IFNULL(CAST({title} AS STRING), '') AS {columns[0]} FROM {source}"
+    for (_, rule_sql), column, next_column in zip(_RULES, columns, columns[1:]):
+        query = f"SELECT *, {rule_sql(column)} AS {next_column} FROM ({query})"
+    return f"SELECT * EXCEPT({', '.join(columns)}), [{', '.join(columns)}] AS title_stages FROM ({query})"
+
+
+def _stage_filter(stages, char_limit):
+    return (f'LENGTH(stage) BETWEEN 1 AND {char_limit} AND '
+            f'(position = 0 OR LENGTH(stage) >= {_MIN_RETAINED_SHARE} * LENGTH({stages}[OFFSET(0)]))')
+
+
+def route_sql(stages, char_limit):
+    """Route of the title, given the title_stages_sql column"""
+    return f"""IFNULL((
+            SELECT IF(position = 0, '{FITS}', '{RULES}') FROM UNNEST({stages}) AS stage WITH OFFSET AS position
+            WHERE {_stage_filter(stages, char_limit)} ORDER BY position LIMIT 1
+        ), '{MODEL}')"""
+
+
+def routed_title_sql(stages, char_limit):
+    """Short title of the fits and rules routes, NULL for the model route"""
+    return f"""(
+            SELECT stage FROM UNNEST({stages}) AS stage WITH OFFSET AS position
+            WHERE {_stage_filter(stages, char_limit)} ORDER BY position LIMIT 1
+        )"""
@@ -0,0 +1,209 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Quota aware launching of batch prediction jobs. All runs started from the same
+# process share one LaunchScheduler, which keeps the unfinished batch prediction
+# jobs of the project under the concurrent job quota and the prompt tokens submitted
+# under a tokens per minute budget. Launches over either limit wait in a queue, and
+# launches Vertex rejects anyway for quota or availability, i.e. with a 429 or 503,
+# are retried with jittered backoff. Other errors aren't retried, as the job of a
+# launch that timed out may have been created anyway.
+# A launch holds its job slot until its job shows up in the list of unfinished
+# jobs, so concurrent launches never count on a listing that doesn't have it yet.
+# Also deployed with the Cloud Function, so only the standard library is imported
+# at load time.
+
+import asyncio
+import random
+import threading
+import time
+
+from utils.clients import retry_with_backoff
+
+# Default quota of unfinished batch prediction jobs per project and region,
+# counting the jobs of every run and of other tools in the project
+_MAX_PROJECT_JOBS = 8
+_TOKENS_PER_MINUTE = 50000000
+# Launches give up when no job slot frees up within this time, resume.py picks them up
+_MAX_SLOT_WAIT_SECONDS = 600
+_INITIAL_SLOT_POLL_SECONDS = 15
+_MAX_SLOT_POLL_SECONDS = 120
+_LAUNCH_ATTEMPTS = 5
+_LAUNCH_INITIAL_BACKOFF_SECONDS = 10
+_LAUNCH_MAX_BACKOFF_SECONDS = 300
+# A job that isn't listed after this, i.e. it already failed, gives its slot back
+_MAX_LISTING_SECONDS = 60
+_LISTING_POLL_SECONDS = 2
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Refills tokens_per_minute tokens a minute, up to a minute's worth.
+    Not thread safe, LaunchScheduler holds its lock around every call."""
+    def __init__(self, tokens_per_minute, clock=time.monotonic):
+        self.capacity = tokens_per_minute
+        self.tokens = tokens_per_minute
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        current = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (current - self.updated) * self.capacity / 60)
+        self.updated = current
+
+    def wait_seconds(self, tokens):
+        """Seconds until tokens are available. Launches larger than the bucket wait for a full one."""
+        self._refill()
+        missing = min(tokens, self.capacity) - self.tokens
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, tokens):
+        self._refill()
+        self.tokens -= min(tokens, self.capacity)
+
+
+class LaunchScheduler:
+    """clock and sleep are only replaced by tests"""
+    def __init__(self, max_jobs=_MAX_PROJECT_JOBS, tokens_per_minute=_TOKENS_PER_MINUTE,
+                 max_wait_seconds=_MAX_SLOT_WAIT_SECONDS, attempts=_LAUNCH_ATTEMPTS,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.max_jobs = max_jobs
+        self.bucket = TokenBucket(tokens_per_minute, clock) if tokens_per_minute else None
+        self.max_wait_seconds = max_wait_seconds
+        self.attempts = attempts
+        self.clock = clock
+        self.sleep = sleep
+        self.queue_depth = 0
+        self.launched = 0
+        self.failed = 0
+        self.wait_seconds = []
+        # Launches past the job slot check whose job isn't listed yet
+        self._launching = 0
+        self._lock = threading.Lock()
+
+    async def launch(self, batch_predictions, tokens=0):
+        """Submits the job of batch_predictions once the quota allows it, returns its
+        name. Raises TimeoutError when no job slot frees up in time, or the last launch error."""
+        from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable, TooManyRequests
+
+        with self._lock:
+            self.queue_depth += 1
+        queued_at = self.clock()
+        try:
+            await self._wait_for_job_slot(batch_predictions)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+                self.queue_depth -= 1
+            raise
+
+        try:
+            # Tokens are only taken once the slot is claimed, so launches waiting
+            # for a slot don't use up the budget of the ones that can start
+            try:
+                await self._wait_for_tokens(tokens)
+            finally:
+                with self._lock:
+                    self.queue_depth -= 1
+            with self._lock:
+                self.wait_seconds.append(self.clock() - queued_at)
+            job_name = await retry_with_backoff(batch_predictions.init_batch_prediction, self.attempts,
+                                                _LAUNCH_INITIAL_BACKOFF_SECONDS, _LAUNCH_MAX_BACKOFF_SECONDS,
+                                                (ResourceExhausted, ServiceUnavailable, TooManyRequests),
+                                                self.sleep)
+            with self._lock:
+                self.launched += 1
+        except Exception:
+            with self._lock:
+                self.failed += 1
+                self._launching -= 1
+            raise
+        try:
+            await self._wait_for_listing(batch_predictions, job_name)
+        finally:
+            with self._lock:
+                self._launching -= 1
+        return job_name
+
+    async def _wait_for_tokens(self, tokens):
+        if not self.bucket or not tokens:
+            return
+        while True:
+            with self._lock:
+                wait = self.bucket.wait_seconds(tokens)
+                if not wait:
+                    self.bucket.take(tokens)
+                    return
+            await self.sleep(wait)
+
+    async def _wait_for_job_slot(self, batch_predictions):
+        """Polls the unfinished jobs of the project with jittered, growing delays
+        until the launch fits the job quota, and claims the slot"""
+        deadline = self.clock() + self.max_wait_seconds
+        poll_seconds = _INITIAL_SLOT_POLL_SECONDS
+        while True:
+            running = len(await asyncio.to_thread(batch_predictions.running_jobs)) if self.max_jobs else 0
+            with self._lock:
+                if not self.max_jobs or running + self._launching < self.max_jobs:
+                    self._launching += 1
+                    return
+            if self.clock() >= deadline:
+                raise TimeoutError(f'{running} batch prediction jobs are running, no slot '
+                                   f'of the {self.max_jobs} job quota freed up in {self.max_wait_seconds}s')
+            remaining = max(deadline - self.clock(), 0)
+            await self.sleep(min(random.uniform(poll_seconds / 2, poll_seconds), remaining))
+            poll_seconds = min(poll_seconds * 2, _MAX_SLOT_POLL_SECONDS)
+
+    async def _wait_for_listing(self, batch_predictions, job_name):
+        """Waits until the submitted job is listed with the unfinished jobs, so it's
+        counted there once the launch gives its slot back"""
+        if not self.max_jobs:
+            return
+        deadline = self.clock() + _MAX_LISTING_SECONDS
+        while job_name not in await asyncio.to_thread(batch_predictions.running_jobs):
+            if self.clock() >= deadline:
+                print(f'{job_name} is not listed after {_MAX_LISTING_SECONDS}s, releasing its job slot.')
+                return
+            await self.sleep(_LISTING_POLL_SECONDS)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'launched': self.launched,
+                'failed': self.failed,
+                'average_wait_seconds': round(sum(self.wait_seconds) / len(self.wait_seconds), 3)
+                if self.wait_seconds else None,
+                'max_wait_seconds': round(max(self.wait_seconds), 3) if self.wait_seconds else None,
+            }
+
+    def __str__(self):
+        stats = self.to_dict()
+        text = f"{stats['launched']} jobs launched, {stats['queue_depth']} waiting for quota"
+        if stats['failed']:
+            text += f", {stats['failed']} failed"
+        if stats['max_wait_seconds']:
+            text += f", waited up to {stats['max_wait_seconds']:.0f}s"
+        return text
+
+
+def get_launch_scheduler():
+    """The scheduler shared by every run in the process"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LaunchScheduler()
+        return _scheduler
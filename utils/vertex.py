@@ -12,28 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from vertexai.preview.language_models import TextGenerationModel
+# Also deployed with the Cloud Function, which has none of the app's dependencies,
+# so only the standard library is imported at load time.
+import hashlib
+import json
 
-_TEXT_MODEL = TextGenerationModel.from_pretrained("text-bison")
+_TEXT_MODEL = "publishers/google/models/text-bison"
+_LOCATION = "us-central1"
+# Jobs in these states still write their results table
+_UNFINISHED_JOB_STATES = ['JOB_STATE_QUEUED', 'JOB_STATE_PENDING', 'JOB_STATE_RUNNING']
+# Longest short title a run can ask for. Every token is at least a char, so an output
+# cut at maxOutputTokens is longer than any char limit and is shortened by dropping
+# words, the cut word first, instead of passing the length check half cut.
+MAX_CHAR_LIMIT = 60
 _MODEL_PARAMETERS = {
-    "maxOutputTokens": "8",
+    "maxOutputTokens": str(MAX_CHAR_LIMIT + 1),
     "temperature": "0.2",
     "topP": "0.95",
     "topK": "40",
 }
 
 
+def get_prompt_fingerprint(prompt_base):
+    """Hash of everything besides the row context that affects a prediction"""
+    fingerprint = json.dumps([_TEXT_MODEL, _MODEL_PARAMETERS, prompt_base], sort_keys=True)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
 class VertexBatchPredictionHandler():
     def __init__(self, dataset, destination_uri_prefix):
-        self.text_model = _TEXT_MODEL
+        # dataset is a bq://project.dataset.table URI
+        project_id = dataset[len('bq://'):].split('.')[0]
+        self.model_name = f'projects/{project_id}/locations/{_LOCATION}/{_TEXT_MODEL}'
         self.dataset = dataset
         self.destination_uri_prefix = destination_uri_prefix
         self.model_parameters = _MODEL_PARAMETERS
     
     def init_batch_prediction(self):
-        self.text_model.batch_predict(
-            dataset=self.dataset,
-            destination_uri_prefix=self.destination_uri_prefix,
-            model_parameters=self.model_parameters
+        """Submits the batch prediction job without waiting for it to finish,
+        so several jobs can be in flight at once. Returns the job's resource name."""
+        # The Vertex AI SDK is slow to import, only load it once a prediction is launched
+        from google.cloud import aiplatform
+
+        return aiplatform.BatchPredictionJob.submit(
+            model_name=self.model_name,
+            instances_format='bigquery',
+            predictions_format='bigquery',
+            bigquery_source=self.dataset,
+            bigquery_destination_prefix=self.destination_uri_prefix,
+            model_parameters=self.model_parameters,
+            location=_LOCATION
+        ).resource_name
+
+    def _unfinished_jobs(self):
+        from google.cloud import aiplatform
+
+        project_id = self.dataset[len('bq://'):].split('.')[0]
+        return aiplatform.BatchPredictionJob.list(
+            filter=' OR '.join(f'state="{state}"' for state in _UNFINISHED_JOB_STATES),
+            project=project_id,
+            location=_LOCATION
         )
-    
\ No newline at end of file
+
+    def is_running(self):
+        """Whether an unfinished batch prediction job already reads this sub table"""
+        return any(job.gca_resource.input_config.bigquery_source.input_uri == self.dataset
+                   for job in self._unfinished_jobs())
+
+    def running_jobs(self):
+        """Resource names of the unfinished batch prediction jobs of the project, of any run"""
+        return [job.resource_name for job in self._unfinished_jobs()]